@@ -0,0 +1,77 @@
+import os
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from app import event_documents
+
+# running many create/update/delete operations on live events as unordered bulk writes
+
+MAX_BULK_OPERATIONS = 5000 # most operations in one request
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 500)) # operations per bulk_write, so each write stays a bounded size
+
+
+# the write for one operation, raises ValueError if the operation is invalid
+def build_write(operation):
+    if operation.op == 'create':
+        if operation.event is None:
+            raise ValueError('event is required to create')
+        event = event_documents.prepare_event(operation.event, creating=True)
+        event['_id'] = ObjectId() # make the id here so it can be returned without reading the event back
+        return event['_id'], InsertOne(event)
+
+    if operation.id is None or not ObjectId.is_valid(operation.id):
+        raise ValueError('a valid id is required to ' + operation.op)
+    event_id = ObjectId(operation.id)
+    if operation.op == 'delete':
+        return event_id, DeleteOne({'_id': event_id})
+
+    event = event_documents.prepare_event(operation.event) if operation.event is not None else {}
+    if len(event) == 0:
+        raise ValueError('nothing to update')
+    return event_id, UpdateOne({'_id': event_id}, {'$set': event})
+
+# run the operations in chunks, returning a result for each operation in the same order
+async def run_bulk_operations(event_collection, operations, chunk_size:int=None):
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    results = []
+    for start in range(0, len(operations), chunk_size):
+        results += await run_chunk(event_collection, operations[start:start + chunk_size], start)
+    return results
+
+async def run_chunk(event_collection, operations, offset):
+    results = []
+    writes = [] # (result, write) of the valid operations
+    for i, operation in enumerate(operations):
+        result = {'index': offset + i, 'op': operation.op}
+        results.append(result)
+        try:
+            event_id, write = build_write(operation)
+        except ValueError as e:
+            result.update(status='error', error=str(e))
+            continue
+        result['id'] = str(event_id)
+        writes.append((result, write))
+
+    # unordered bulk writes only report totals, so find which updated and deleted events exist with one query
+    existing_ids = [ObjectId(result['id']) for result, write in writes if result['op'] != 'create']
+    existing = set()
+    if existing_ids:
+        existing = {str(event['_id']) async for event in event_collection.find({'_id': {'$in': existing_ids}}, {'_id': 1})}
+
+    write_errors = {}
+    if writes:
+        try:
+            await event_collection.bulk_write([write for result, write in writes], ordered=False)
+        except BulkWriteError as e: # the other writes still ran, the errors are per write
+            write_errors = {error['index']: error.get('errmsg', 'write failed') for error in e.details.get('writeErrors', [])}
+
+    statuses = {'create': 'created', 'update': 'updated', 'delete': 'deleted'}
+    for i, (result, write) in enumerate(writes):
+        if i in write_errors:
+            result.update(status='error', error=write_errors[i])
+        elif result['op'] != 'create' and result['id'] not in existing:
+            result.update(status='error', error='Event with that ID not found')
+        else:
+            result['status'] = statuses[result['op']]
+    return results
@@ -0,0 +1,70 @@
+import time
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+# in-process cache with least recently used eviction and a time to live for each entry
+class TTLCache:
+    def __init__(self, max_size:int=1024, ttl:float=300.0):
+        self.max_size = max_size # most entries to keep before evicting the least recently used
+        self.ttl = ttl # default seconds an entry stays fresh
+        self._entries = OrderedDict() # key -> (expires_at, value), oldest first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0 # entries removed to make room
+        self.expirations = 0 # entries removed because their ttl passed
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key) # mark as recently used
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl:float=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, _MISSING)
+            return default if entry is _MISSING else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key, _MISSING)
+        return entry is not _MISSING and entry[0] > time.monotonic()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / lookups) if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
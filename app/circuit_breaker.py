@@ -0,0 +1,53 @@
+import time
+
+
+# stops calls to an external API after repeated failures, so a struggling API gets time to recover
+# closed: calls go through; open: calls are rejected for reset_timeout seconds; half open: one trial call decides which it goes back to
+class CircuitBreaker:
+    def __init__(self, failure_threshold:int=5, reset_timeout:float=30.0):
+        self.failure_threshold = failure_threshold # consecutive failures that open the circuit
+        self.reset_timeout = reset_timeout # seconds the circuit stays open before a trial call
+        self.state = 'closed'
+        self.failures = 0 # consecutive failures
+        self.opened_at = None # when the circuit opened, or the trial call started
+        self.opens = 0 # times the circuit opened
+        self.rejections = 0 # calls rejected while open
+
+    # whether a call can be made now, a call allowed in the open state is the trial call
+    def allow(self):
+        if self.state == 'closed':
+            return True
+        # a trial call that never reported back (e.g. it was cancelled) doesn't keep the circuit half open forever
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+            self.opened_at = time.monotonic()
+            return True
+        self.rejections += 1
+        return False
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.opens += 1
+
+    # seconds until a trial call will be allowed, 0 if calls are allowed now
+    def retry_after(self):
+        if self.state == 'closed':
+            return 0.0
+        return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opens': self.opens,
+            'rejections': self.rejections,
+            'retry_after': self.retry_after(),
+        }
@@ -1,37 +1,293 @@
 import os
+import logging
+import time
+import asyncio
+import inspect
+import threading
 from typing import AsyncGenerator
 from dotenv import load_dotenv
-from pymongo import AsyncMongoClient
+from pymongo import AsyncMongoClient, IndexModel, GEOSPHERE, ASCENDING, TEXT
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
 from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI
 
-load_dotenv() # load environment variables from .env file
+# the one place the .env file is loaded, before the app modules are imported as they read their settings then
+load_dotenv()
+
+from app.telemetry import command_counter
+
+logger = logging.getLogger(__name__)
+
+
+# Connection pool listener that keeps counters for checkouts and wait times, so the pool can be sized under load
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock() # pymongo may publish events from its own threads
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections_open = 0 # connections currently held by the pool
+            self.connections_in_use = 0 # connections currently checked out
+            self.checkouts_started = 0 # total checkout attempts
+            self.checkouts = 0 # total successful checkouts
+            self.checkout_failures = 0 # total failed checkouts (timeouts, pool closed, connection errors)
+            self.wait_time_total = 0.0 # total seconds spent waiting for a connection
+            self.wait_time_max = 0.0 # longest single wait for a connection in seconds
+            self.pool_clears = 0 # number of times the pool was cleared
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'connections_open': self.connections_open,
+                'connections_in_use': self.connections_in_use,
+                'waiting': max(self.checkouts_started - self.checkouts - self.checkout_failures, 0),
+                'checkouts_started': self.checkouts_started,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'wait_time_avg_ms': (self.wait_time_total / self.checkouts * 1000) if self.checkouts else 0.0,
+                'wait_time_max_ms': self.wait_time_max * 1000,
+            }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_open = max(self.connections_open - 1, 0)
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self.checkouts_started += 1
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        duration = getattr(event, 'duration', None) or 0.0 # time spent waiting for the connection
+        with self._lock:
+            self.checkouts += 1
+            self.connections_in_use += 1
+            self.wait_time_total += duration
+            self.wait_time_max = max(self.wait_time_max, duration)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.connections_in_use = max(self.connections_in_use - 1, 0)
+
+
+pool_metrics = PoolMetrics()
+
+_client = None # the process wide client, created once and shared by every request (and warm Lambda invocations)
+_client_pid = None # process the client was made in, a forked child needs its own
+_client_loop = None # event loop the client was made on, a new loop (e.g. a new Mangum invocation) needs its own
+_last_used = 0.0 # when the client was made or last handed out, to notice a Lambda container that was frozen
+_replaced_clients = [] # clients left behind by an event loop change, closed by the next ensure_healthy_client
+_index_task = None
+_indexes_ensured = False
+
+client_metrics = {
+    'clients_created': 0,
+    'health_checks': 0,
+    'reconnects': 0,
+}
+
+
+# pool settings from the environment, only passing on the values that are set so pymongo defaults apply otherwise
+def get_client_options():
+    env_options = {
+        'maxPoolSize': ('MONGO_MAX_POOL_SIZE', int),
+        'minPoolSize': ('MONGO_MIN_POOL_SIZE', int),
+        'maxIdleTimeMS': ('MONGO_MAX_IDLE_TIME_MS', int),
+        'serverSelectionTimeoutMS': ('MONGO_SERVER_SELECTION_TIMEOUT_MS', int),
+        'waitQueueTimeoutMS': ('MONGO_WAIT_QUEUE_TIMEOUT_MS', int),
+        'connectTimeoutMS': ('MONGO_CONNECT_TIMEOUT_MS', int),
+    }
+    options = {}
+    for option, (env_name, cast) in env_options.items():
+        value = os.getenv(env_name)
+        if value:
+            options[option] = cast(value)
+    return options
+
+# get the shared client, creating it on first use (at startup in lifespan, or on a Lambda cold start)
+def get_client():
+    global _client, _client_pid, _client_loop, _last_used
+    loop = get_running_loop()
+    if _client is not None and _client_pid != os.getpid():
+        _client = None # the old client's connections belong to the parent process, leave them to it
+    elif _client is not None and loop is not None and _client_loop is not None and _client_loop is not loop:
+        _replaced_clients.append(_client) # closed later, closing is async and this isn't
+        _client = None
+    if _client is None:
+        _client = AsyncMongoClient(
+            os.getenv('MONGO_DB_CONNECTION_STRING'),
+            event_listeners=[pool_metrics, command_counter],
+            **get_client_options()
+        )
+        _client_pid = os.getpid()
+        _client_loop = loop
+        _last_used = time.monotonic() # a new client doesn't need a health check
+        client_metrics['clients_created'] += 1
+    return _client
+
+def get_running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError: # not called from a coroutine, e.g. a script setting up
+        return None
+
+# check the client still works if it's been idle, e.g. the Lambda container was frozen, and reconnect if it doesn't
+async def ensure_healthy_client():
+    global _client, _last_used
+    client = get_client()
+    if _replaced_clients:
+        await close_replaced_clients()
+    idle = time.monotonic() - _last_used
+    _last_used = time.monotonic()
+    if idle < float(os.getenv('MONGO_HEALTHCHECK_IDLE_SECONDS', 60)):
+        return client
+
+    client_metrics['health_checks'] += 1
+    try:
+        await asyncio.wait_for(client.admin.command('ping'), float(os.getenv('MONGO_HEALTHCHECK_TIMEOUT', 2)))
+        return client
+    except (PyMongoError, asyncio.TimeoutError) as e:
+        logger.warning('MongoDB health check failed, reconnecting: %s', e)
+    client_metrics['reconnects'] += 1
+    _client = None
+    try:
+        await client.close()
+    except Exception: # the stale client may not close cleanly, it's being replaced either way
+        pass
+    return get_client()
+
+# close the clients replaced after an event loop change, their old loop may be gone so failures are ignored
+async def close_replaced_clients():
+    while _replaced_clients:
+        client = _replaced_clients.pop()
+        try:
+            await asyncio.wait_for(client.close(), float(os.getenv('MONGO_HEALTHCHECK_TIMEOUT', 2)))
+        except Exception as e:
+            logger.debug('Closing a replaced client failed: %s', e)
+
+# get the database from the shared client
+def get_database():
+    return get_client()[os.getenv('MONGO_DB_NAME')]
+
+
+# indexes for each collection, created at startup
+INDEXES = {
+    'live_events': [
+        IndexModel([('geo', GEOSPHERE)], name='geo_2dsphere'), # for nearby events
+        # listing events, one index per filter and sort (see event_query.build_filter and SORT_FIELDS), equality first,
+        # then the sort with _id as the tie breaker, descending sorts walk the same indexes backwards
+        IndexModel([('event_date', ASCENDING), ('_id', ASCENDING)], name='event_date_id'),
+        IndexModel([('name_lower', ASCENDING), ('_id', ASCENDING)], name='name_lower_id'),
+        IndexModel([('locality', ASCENDING), ('_id', ASCENDING)], name='locality_id'),
+        IndexModel([('locality', ASCENDING), ('event_date', ASCENDING), ('_id', ASCENDING)], name='locality_event_date_id'),
+        IndexModel([('locality', ASCENDING), ('name_lower', ASCENDING), ('_id', ASCENDING)], name='locality_name_lower_id'),
+        IndexModel([('updated_at', ASCENDING), ('_id', ASCENDING)], name='updated_at_id'), # /events/changes
+        # /events/search, no language so band names made of stop words ("The The") can still be found
+        IndexModel([('name', TEXT), ('location_name', TEXT), ('description', TEXT)], name='search_text',
+                   weights={'name': 10, 'location_name': 5, 'description': 1}, default_language='none'),
+        IndexModel([('name_prefixes', ASCENDING), ('name_lower', ASCENDING), ('_id', ASCENDING)], name='name_prefixes_name_lower_id'), # autocomplete
+    ],
+    'event_tombstones': [
+        IndexModel([('deleted_at', ASCENDING), ('_id', ASCENDING)], name='deleted_at_id'), # /events/changes
+        IndexModel([('deleted_at', ASCENDING)], name='deleted_at_ttl', expireAfterSeconds=int(os.getenv('EVENT_TOMBSTONE_TTL', 30 * 86400))),
+    ],
+    'venues': [
+        IndexModel([('geo', GEOSPHERE), ('types', ASCENDING)], name='geo_2dsphere_types'), # local Places searches
+    ],
+    'venue_coverage': [
+        IndexModel([('cell', ASCENDING), ('search_type', ASCENDING)], name='cell_search_type'),
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'rate_limits': [
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0), # windows of shared rate limits
+    ],
+    'jobs': [
+        IndexModel([('status', ASCENDING), ('run_at', ASCENDING)], name='status_run_at'), # claiming the next visible job
+        IndexModel([('key', ASCENDING)], name='key_unique', unique=True, partialFilterExpression={'key': {'$type': 'string'}}), # idempotent enqueues
+        IndexModel([('finished_at', ASCENDING)], name='finished_at_ttl', expireAfterSeconds=int(os.getenv('JOBS_RETENTION', 7 * 24 * 3600))),
+    ],
+}
+
+# create the indexes, this is idempotent so it's safe to run on every startup
+async def ensure_indexes(db):
+    for collection_name, indexes in INDEXES.items():
+        await db.get_collection(collection_name).create_indexes(indexes)
+
+# create the indexes without holding up startup, failures are logged and retried on the next startup
+async def ensure_indexes_in_background(db):
+    global _indexes_ensured
+    try:
+        await ensure_indexes(db)
+        _indexes_ensured = True
+        logger.info('Indexes ensured')
+    except PyMongoError as e:
+        logger.error('Creating indexes failed: %s', e)
+
+# whether the indexes exist, queries only hint them once they do as a hint for a missing index is an error
+def indexes_ready():
+    return _indexes_ensured
+
+# start creating the indexes once per process, for when there's no lifespan (Lambda)
+def schedule_ensure_indexes(db):
+    global _index_task
+    if _indexes_ensured or (_index_task is not None and not _index_task.done()):
+        return _index_task
+    _index_task = asyncio.create_task(ensure_indexes_in_background(db))
+    return _index_task
+
+# run an aggregation and get the results as a list, pymongo's async collections return the cursor from a coroutine
+async def aggregate(collection, pipeline, **kwargs):
+    cursor = collection.aggregate(pipeline, **kwargs)
+    if inspect.isawaitable(cursor):
+        cursor = await cursor
+    return await cursor.to_list()
 
 
 # for the database connection
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     # Start the database connection
-    print(app)
-    print("MongoBD startup")
-    mongo_connection = connect_to_db()
-    print(mongo_connection)
-    #app.db = next(mongo_connection)
-    app.db = mongo_connection
+    logger.info("MongoDB startup")
+    app.db = get_database()
     app.client = app.db.client
-
+    index_task = schedule_ensure_indexes(app.db)
 
     yield
+    if index_task is not None and not index_task.done():
+        index_task.cancel()
     # Close the database connection
     await shutdown_db_client(app)
 
-# method to connect to the MongoDb Connection for dependency injection
-def connect_to_db():
-    print('DB Connection', os.getenv('MONGO_DB_CONNECTION_STRING'))
-    client = AsyncMongoClient(os.getenv('MONGO_DB_CONNECTION_STRING'))
-    print(client)
-    print('DB Name', os.getenv('MONGO_DB_NAME'))
+# method to get the MongoDb database for dependency injection, handles are cheap and all share the one client pool
+async def connect_to_db():
+    client = await ensure_healthy_client()
     db = client[os.getenv('MONGO_DB_NAME')]
+    schedule_ensure_indexes(db) # lifespan is off on Lambda, so make sure the indexes exist on the first request
     return db
 
 
@@ -39,5 +295,9 @@ def connect_to_db():
 
 # method to close the database connection
 async def shutdown_db_client(app):
-    await app.client.close()
-    print("Database disconnected.")
\ No newline at end of file
+    global _client
+    if _client is not None:
+        client = _client
+        _client = None
+        await client.close()
+    logger.info("Database disconnected")
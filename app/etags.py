@@ -0,0 +1,77 @@
+import os
+import hashlib
+from datetime import datetime, timezone
+from bson.objectid import ObjectId
+
+# ETags and cache headers for conditional requests on live events
+
+EVENT_CACHE_MAX_AGE = int(os.getenv('EVENT_CACHE_MAX_AGE', 30)) # seconds clients can use an event before revalidating
+CACHE_CONTROL = f'private, max-age={EVENT_CACHE_MAX_AGE}, must-revalidate'
+
+
+# milliseconds since the epoch, MongoDB stores dates to the millisecond and returns them without a timezone (UTC)
+def to_millis(dt):
+    if dt is None:
+        return 0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+# strong ETag of an event, from its id and when it was last updated
+def event_etag(event):
+    return '"%s-%x"' % (event['_id'], to_millis(event.get('updated_at') or event.get('created_at')))
+
+# get the id and updated_at of an event ETag, None if it isn't one
+def parse_event_etag(etag):
+    etag = etag.strip()
+    if etag.startswith('W/') or len(etag) < 2 or etag[0] != '"' or etag[-1] != '"': # weak ETags never match If-Match
+        return None
+    event_id, _, millis = etag[1:-1].partition('-')
+    try:
+        return ObjectId(event_id), datetime.fromtimestamp(int(millis, 16) / 1000, tz=timezone.utc)
+    except Exception:
+        return None
+
+# ETag of a list of events from the request's query and a cheap summary of the matching events
+def list_etag(query_params, summary):
+    query = '&'.join(f'{k}={v}' for k, v in sorted(query_params.multi_items()))
+    key = '%s|%d|%x|%s' % (query, summary.get('count', 0), to_millis(summary.get('updated_at')), summary.get('last_id'))
+    return '"l-%s"' % hashlib.sha1(key.encode()).hexdigest()[:24]
+
+# summary of a list of events for list_etag, the same as summary_pipeline gets from MongoDB
+def list_summary(events):
+    updated = [event['updated_at'] for event in events if event.get('updated_at') is not None]
+    return {
+        'count': len(events),
+        'updated_at': max(updated) if updated else None,
+        'last_id': events[-1]['_id'] if events else None,
+    }
+
+# aggregation stages summarizing the events matching a query for list_etag, without returning them
+def summary_pipeline(query, sort, limit=None):
+    pipeline = [{'$match': query}, {'$sort': dict(sort)}]
+    if limit is not None:
+        pipeline.append({'$limit': limit})
+    pipeline += [
+        {'$project': {'updated_at': 1}},
+        {'$group': {'_id': None, 'count': {'$sum': 1}, 'updated_at': {'$max': '$updated_at'}, 'last_id': {'$last': '$_id'}}},
+    ]
+    return pipeline
+
+# check an If-None-Match header against an ETag, weak comparison as it's for reads
+def none_match_fails(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+# the updated_at values an If-Match header allows for an event, None if any version is allowed
+def if_match_versions(if_match, event_id):
+    if if_match is None or if_match.strip() == '*':
+        return None
+    versions = []
+    for tag in if_match.split(','):
+        parsed = parse_event_etag(tag)
+        if parsed is not None and str(parsed[0]) == str(event_id):
+            versions.append(parsed[1])
+    return versions
@@ -0,0 +1,73 @@
+import os
+import logging
+import asyncio
+from pymongo.errors import PyMongoError, OperationFailure
+
+from app.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+# read-through cache of live event documents by id, invalidated by writes here and by change streams for other instances
+class EventCache:
+    def __init__(self, max_size:int=1024, ttl:float=60.0):
+        self.cache = TTLCache(max_size=max_size, ttl=ttl) # the ttl bounds staleness if an invalidation is ever missed
+        self.generation = 0 # bumped by every invalidation, so reads that raced a write aren't cached
+        self.invalidations = 0
+
+    def get(self, event_id):
+        return self.cache.get(str(event_id))
+
+    # cache an event read from the database, unless something was invalidated since the read started
+    def set(self, event, generation:int=None):
+        if generation is not None and generation != self.generation:
+            return
+        self.cache.set(str(event['_id']), event)
+
+    def invalidate(self, event_id):
+        self.generation += 1
+        self.invalidations += 1
+        self.cache.pop(str(event_id))
+
+    def clear(self):
+        self.generation += 1
+        self.cache.clear()
+
+    def stats(self):
+        return dict(self.cache.stats(), invalidations=self.invalidations)
+
+
+event_cache = EventCache(
+    max_size=int(os.getenv('EVENT_CACHE_MAX_SIZE', 1024)),
+    ttl=float(os.getenv('EVENT_CACHE_TTL', 60)),
+)
+
+CHANGE_STREAM_NOT_SUPPORTED = 40573 # change streams need a replica set or sharded cluster
+
+
+# evict cached events changed by any instance, runs until cancelled
+async def watch_event_changes(event_collection, cache:EventCache=event_cache, retry_delay:float=5.0):
+    pipeline = [
+        {'$match': {'operationType': {'$in': ['update', 'replace', 'delete', 'drop', 'rename', 'dropDatabase', 'invalidate']}}},
+        {'$project': {'operationType': 1, 'documentKey': 1}}, # only the id is needed, not the changed fields
+    ]
+    resume_token = None
+    while True:
+        try:
+            async with await event_collection.watch(pipeline, resume_after=resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    if 'documentKey' in change:
+                        cache.invalidate(change['documentKey']['_id'])
+                    else: # the collection went away
+                        cache.clear()
+                        resume_token = None
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_NOT_SUPPORTED:
+                logger.info('Change streams not supported, event cache relies on its ttl: %s', e)
+                return
+            logger.warning('Event change stream failed: %s', e)
+        except PyMongoError as e:
+            logger.warning('Event change stream failed: %s', e)
+        cache.clear() # changes may have been missed while the stream was down
+        await asyncio.sleep(retry_delay)
@@ -0,0 +1,101 @@
+import os
+import base64
+import json
+from datetime import datetime, timezone, timedelta
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from app.event_documents import now
+from app.etags import to_millis
+
+# delta sync for offline clients: the events created or updated since a token, and tombstones of the ones deleted
+#
+# changes are read in (updated_at, _id) order for events and (deleted_at, _id) order for tombstones, both indexed,
+# so a sync reads only what changed since the token however many events there are
+
+TOMBSTONES_COLLECTION = 'event_tombstones'
+TOMBSTONE_TTL = int(os.getenv('EVENT_TOMBSTONE_TTL', 30 * 86400)) # seconds deletions are kept, older tokens have to sync from scratch
+# changes newer than this many seconds aren't returned yet, so a write that picked its updated_at just before
+# the sync but landed just after it isn't skipped by the token
+SETTLE_TIME = float(os.getenv('EVENT_CHANGES_SETTLE', 2))
+
+
+# a token older than the tombstones, deletions since it may be lost so the client has to sync from scratch
+class TokenExpired(ValueError):
+    pass
+
+
+# encode a sync position as an opaque token, with no id everything at that time was seen
+def encode_token(changed_at, change_id=None):
+    position = {'t': to_millis(changed_at)}
+    if change_id is not None:
+        position['id'] = str(change_id)
+    raw = json.dumps(position, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+# decode a token made by encode_token to (changed_at, id), raises ValueError if it's not valid or TokenExpired if it's too old
+def decode_token(token):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        changed_at = datetime.fromtimestamp(position['t'] / 1000, tz=timezone.utc)
+        change_id = ObjectId(position['id']) if 'id' in position else None
+    except Exception as e:
+        raise ValueError('Invalid token') from e
+    if changed_at < now() - timedelta(seconds=TOMBSTONE_TTL):
+        raise TokenExpired('Token has expired, sync again without since')
+    return changed_at, change_id
+
+# filter for the changes after a position up to the settled time, on the time field of the collection
+def changes_filter(field, position, until):
+    query = {field: {'$lte': until}}
+    if position is None:
+        return query
+    changed_at, change_id = position
+    if change_id is None:
+        after = {field: {'$gt': changed_at}}
+    else:
+        after = {'$or': [{field: {'$gt': changed_at}}, {field: changed_at, '_id': {'$gt': change_id}}]}
+    return {'$and': [after, query]}
+
+
+# record deleted events so syncing clients remove them, tombstones are removed by a TTL index after TOMBSTONE_TTL
+async def record_deletions(db, event_ids):
+    if not event_ids:
+        return
+    deleted_at = now()
+    await db.get_collection(TOMBSTONES_COLLECTION).bulk_write([
+        UpdateOne({'_id': ObjectId(event_id)}, {'$set': {'deleted_at': deleted_at}}, upsert=True)
+        for event_id in event_ids
+    ], ordered=False)
+
+# the next changes after a token, or from the start without one
+# returns the changed events and deleted ids in the order they changed, the token to sync from next and if there are more
+async def get_changes(db, since=None, limit:int=500):
+    position = decode_token(since) if since else None
+    until = now() - timedelta(seconds=SETTLE_TIME)
+    window = limit + 1 # one extra to know if there are more
+
+    events = [event async for event in db.get_collection('live_events').find(changes_filter('updated_at', position, until))
+              .sort([('updated_at', 1), ('_id', 1)]).limit(window)]
+    tombstones = [tombstone async for tombstone in db.get_collection(TOMBSTONES_COLLECTION).find(changes_filter('deleted_at', position, until))
+                  .sort([('deleted_at', 1), ('_id', 1)]).limit(window)]
+
+    # merge the two in change order, and take the first page of both
+    changes = sorted(
+        [(event['updated_at'], event['_id'], event, False) for event in events] +
+        [(tombstone['deleted_at'], tombstone['_id'], tombstone, True) for tombstone in tombstones],
+        key=lambda change: (to_millis(change[0]), change[1]),
+    )
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if has_more:
+        changed_at, change_id = changes[-1][0], changes[-1][1]
+        next_token = encode_token(changed_at, change_id)
+    else: # caught up, the next sync starts after everything that had settled
+        next_token = encode_token(until)
+    return {
+        'events': [doc for changed_at, change_id, doc, deleted in changes if not deleted],
+        'deleted': [{'id': str(change_id), 'deleted_at': changed_at} for changed_at, change_id, doc, deleted in changes if deleted],
+        'next': next_token,
+        'has_more': has_more,
+    }
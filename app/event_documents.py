@@ -0,0 +1,104 @@
+import re
+from datetime import datetime, timezone
+
+# helpers for preparing live event documents before they're written to MongoDB
+
+MIN_PREFIX = 2 # shortest word prefix kept for autocomplete
+MAX_PREFIX = 15 # longest word prefix kept, longer search words are cut to this
+
+
+# current time in UTC to the millisecond, as precise as MongoDB stores it so ETags match what's stored
+def now():
+    dt = datetime.now(timezone.utc)
+    return dt.replace(microsecond=dt.microsecond // 1000 * 1000)
+
+# convert the event date string to a datetime, raises ValueError if it isn't a YYYY-MM-DD date
+def parse_event_date(event_date):
+    try:
+        return datetime.strptime(event_date, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('event_date must be a YYYY-MM-DD date')
+
+# document to write for a create or update, without unset fields, raises ValueError for invalid values
+def prepare_event(event, creating:bool=False):
+    #exclude None values from the live event
+    event = {
+        k: v for k, v in event.model_dump(by_alias=True).items() if v is not None
+    }
+    if 'event_date' in event: # convert string to date
+        event['event_date'] = parse_event_date(event['event_date'])
+    if creating:
+        event['created_at'] = now()
+    if creating or len(event) > 0: # nothing to update shouldn't touch the event
+        event['updated_at'] = event.get('created_at') or now()
+    return derive_fields(event)
+
+
+# get the coordinates from an event's location, which can be a Places result or plain coordinates
+def location_coords(location):
+    if not isinstance(location, dict):
+        return None
+    for candidate in (location.get('location'), location.get('coordinates'), location):
+        if not isinstance(candidate, dict):
+            continue
+        lat = candidate.get('latitude', candidate.get('lat'))
+        lng = candidate.get('longitude', candidate.get('lng'))
+        if is_number(lat) and is_number(lng) and -90 <= lat <= 90 and -180 <= lng <= 180:
+            return {'latitude': float(lat), 'longitude': float(lng)}
+    return None
+
+def is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+# GeoJSON point for an event's location, used by the 2dsphere index, None if the location has no coordinates
+def geo_point(location):
+    coords = location_coords(location)
+    if coords is None:
+        return None
+    return {'type': 'Point', 'coordinates': [coords['longitude'], coords['latitude']]} # GeoJSON is longitude first
+
+# city of an event's location in lower case for filtering, from Places address components or a plain locality
+def locality(location):
+    if not isinstance(location, dict):
+        return None
+    for component in location.get('addressComponents') or location.get('address_components') or []:
+        if isinstance(component, dict) and 'locality' in (component.get('types') or []):
+            name = component.get('longText') or component.get('long_name')
+            return name.strip().lower() if isinstance(name, str) else None
+    name = location.get('locality')
+    return name.strip().lower() if isinstance(name, str) else None
+
+# lower case name for case insensitive prefix filters and sorting
+def name_lower(name):
+    return name.lower() if isinstance(name, str) else None
+
+# display name of an event's location for the text index, from a Places result or a plain name
+def location_name(location):
+    if not isinstance(location, dict):
+        return None
+    name = location.get('displayName') or location.get('name')
+    if isinstance(name, dict): # Places gives a localized text
+        name = name.get('text')
+    return name if isinstance(name, str) else None
+
+# lower case words of a text, split on anything that isn't a letter or digit
+def words(text):
+    return re.findall(r'\w+', text.lower()) if isinstance(text, str) else []
+
+# the prefixes of every word of the name for autocomplete, e.g. "Jazz Fest" -> ja, jaz, jazz, fe, fes, fest
+def name_prefixes(name):
+    prefixes = set()
+    for word in words(name):
+        prefixes.update(word[:length] for length in range(MIN_PREFIX, min(len(word), MAX_PREFIX) + 1))
+    return sorted(prefixes)
+
+# add the fields derived from the fields being written, so they stay in sync on partial updates
+def derive_fields(event):
+    if 'location' in event:
+        event['geo'] = geo_point(event['location'])
+        event['locality'] = locality(event['location'])
+        event['location_name'] = location_name(event['location'])
+    if 'name' in event:
+        event['name_lower'] = name_lower(event['name'])
+        event['name_prefixes'] = name_prefixes(event['name'])
+    return event
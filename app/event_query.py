@@ -0,0 +1,141 @@
+import re
+import base64
+import json
+from datetime import datetime, time
+from bson.objectid import ObjectId
+
+from app.models import LiveEvent
+
+# helpers for building live event queries, keyset pagination and projections
+
+DEFAULT_SORT = '_id'
+DEFAULT_ORDER = 'asc'
+# sorts that can be used for keyset pagination and the document field each sorts by, _id is always the tie breaker
+SORT_FIELDS = {
+    '_id': '_id',
+    'event_date': 'event_date',
+    'name': 'name_lower', # case insensitive, and the same field the name prefix filter uses
+}
+
+
+# encode the position of the last document of a page as an opaque cursor
+def encode_cursor(doc, sort=DEFAULT_SORT):
+    position = {'id': str(doc['_id'])}
+    if sort != '_id':
+        value = doc.get(SORT_FIELDS[sort])
+        if isinstance(value, datetime): # datetimes aren't json serializable, so tag them
+            value = {'$date': value.isoformat()}
+        position['value'] = value
+    raw = json.dumps(position, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+# decode a cursor made by encode_cursor, raises ValueError if it's not a valid cursor
+def decode_cursor(cursor, sort=DEFAULT_SORT):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position = json.loads(raw)
+        position['id'] = ObjectId(position['id'])
+        if sort != '_id':
+            value = position['value'] # KeyError if the cursor was made for a different sort
+            if isinstance(value, dict) and '$date' in value:
+                position['value'] = datetime.fromisoformat(value['$date'])
+    except Exception as e:
+        raise ValueError('Invalid cursor') from e
+    return position
+
+# filter for the documents after the cursor position, in (sort, _id) order, ascending or descending
+def keyset_filter(position, sort=DEFAULT_SORT, order=DEFAULT_ORDER):
+    after = '$gt' if order == 'asc' else '$lt'
+    last_id = position['id']
+    if sort == '_id':
+        return {'_id': {after: last_id}}
+
+    field = SORT_FIELDS[sort]
+    value = position['value']
+    if value is None: # missing values sort first, so ascending everything with a value comes after, descending nothing does
+        same = {field: None, '_id': {after: last_id}}
+        return {'$or': [same, {field: {'$ne': None}}]} if order == 'asc' else same
+    conditions = [
+        {field: {after: value}},
+        {field: value, '_id': {after: last_id}},
+    ]
+    if order == 'desc': # comparisons never match missing values, so add them back as they sort last
+        conditions.append({field: None})
+    return {'$or': conditions}
+
+# sort specification for a keyset paginated query
+def sort_spec(sort=DEFAULT_SORT, order=DEFAULT_ORDER):
+    direction = 1 if order == 'asc' else -1
+    if sort == '_id':
+        return [('_id', direction)]
+    return [(SORT_FIELDS[sort], direction), ('_id', direction)]
+
+# filter for listing events by date range, case insensitive name prefix and locality, each backed by an index in db.INDEXES
+def build_filter(date_from=None, date_to=None, name=None, locality=None):
+    query = {}
+    if date_from or date_to: # event dates are stored as datetimes at midnight
+        query['event_date'] = {}
+        if date_from:
+            query['event_date']['$gte'] = datetime.combine(date_from, time.min)
+        if date_to:
+            query['event_date']['$lte'] = datetime.combine(date_to, time.min)
+    if name:
+        query['name_lower'] = {'$regex': '^' + re.escape(name.lower())} # an anchored prefix is an index range scan
+    if locality:
+        query['locality'] = locality.strip().lower()
+    return query
+
+# the sort a listing uses when none is asked for, the field its range filter is on so one index can filter and sort
+def default_sort(date_from=None, date_to=None, name=None):
+    if date_from or date_to:
+        return 'event_date'
+    if name:
+        return 'name'
+    return DEFAULT_SORT
+
+# raise ValueError for filters no index can serve in the sort's order without sorting in memory,
+# a range filter (from/to or name) has to be on the sort field, so only one can be used at a time
+def check_sort(sort, date_from=None, date_to=None, name=None):
+    ranges = [(param, field) for param, field, used in (('from/to', 'event_date', date_from or date_to), ('name', 'name', name)) if used]
+    if len(ranges) > 1:
+        raise ValueError('from/to and name can\'t be combined')
+    if ranges and ranges[0][1] != sort:
+        raise ValueError(f'{ranges[0][0]} can only be used with sort={ranges[0][1]}')
+
+# name of the index in db.INDEXES a checked listing uses, locality first as it's an equality, then the sort and _id
+def index_hint(sort=DEFAULT_SORT, locality=None):
+    if sort == '_id':
+        return 'locality_id' if locality else '_id_'
+    name = SORT_FIELDS[sort] + '_id'
+    return 'locality_' + name if locality else name
+
+# both filters, or whichever isn't empty
+def combine_filters(*queries):
+    queries = [query for query in queries if query]
+    if len(queries) > 1:
+        return {'$and': queries}
+    return queries[0] if queries else {}
+
+# parse a comma separated list of LiveEvent fields, raises ValueError for unknown fields
+def parse_fields(fields):
+    if not fields:
+        return None
+    names = {f.strip() for f in fields.split(',') if f.strip()}
+    unknown = names - set(LiveEvent.model_fields)
+    if unknown:
+        raise ValueError('Unknown fields: ' + ', '.join(sorted(unknown)))
+    return names | {'id'} # id is always returned
+
+# mongo projection for a set of LiveEvent fields, extra fields (e.g. the sort key for the cursor) can be added
+def build_projection(fields, extra=()):
+    if fields is None:
+        return None
+    projection = {}
+    for name in list(fields) + list(extra):
+        field = LiveEvent.model_fields.get(name)
+        projection[(field.alias if field and field.alias else name)] = 1
+    return projection
+
+# validate an event document from MongoDB and get the dict to encode with responses.dumps, only including the requested fields
+def serialize_event(doc, fields=None, model=LiveEvent):
+    return model.model_validate(doc).model_dump(exclude_none=True, include=fields)
@@ -0,0 +1,68 @@
+import base64
+import json
+from bson.objectid import ObjectId
+
+from app.db import aggregate
+from app.event_documents import words, MIN_PREFIX, MAX_PREFIX
+from app import event_query
+
+# searching live events by text, ranked by the weighted text index, or by word prefixes for autocomplete
+
+DEFAULT_FIELDS = {'id', 'name', 'event_date'} # enough for a typeahead list, more can be asked for with fields
+
+
+# encode the score and id of the last result of a text search page as an opaque cursor
+def encode_score_cursor(doc):
+    raw = json.dumps({'score': doc['score'], 'id': str(doc['_id'])}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+# decode a cursor made by encode_score_cursor to (score, id), raises ValueError if it's not a valid cursor
+def decode_score_cursor(cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return float(position['score']), ObjectId(position['id'])
+    except Exception as e:
+        raise ValueError('Invalid cursor') from e
+
+# the words of a query as indexed prefixes, raises ValueError if no word is long enough
+def query_prefixes(q):
+    prefixes = [word[:MAX_PREFIX] for word in words(q) if len(word) >= MIN_PREFIX]
+    if not prefixes:
+        raise ValueError(f'q needs a word of at least {MIN_PREFIX} characters')
+    return prefixes
+
+
+# events matching the query in the text index, best score first, with the score
+# returns the page and the cursor of the next page, None if it's the last
+async def text_search(event_collection, q, limit:int, cursor=None, fields=None):
+    pipeline = [
+        {'$match': {'$text': {'$search': q}}}, # $text has to be the first stage
+        {'$addFields': {'score': {'$meta': 'textScore'}}},
+    ]
+    if cursor:
+        score, last_id = decode_score_cursor(cursor)
+        pipeline.append({'$match': {'$or': [{'score': {'$lt': score}}, {'score': score, '_id': {'$gt': last_id}}]}})
+    pipeline += [
+        {'$sort': {'score': -1, '_id': 1}},
+        {'$limit': limit + 1}, # one extra to know if there's another page
+    ]
+    projection = event_query.build_projection(fields, extra=['score'])
+    if projection:
+        pipeline.append({'$project': projection})
+    events = await aggregate(event_collection, pipeline)
+    if len(events) > limit:
+        events = events[:limit]
+        return events, encode_score_cursor(events[-1])
+    return events, None
+
+# events with a word starting with each word of the query, in name order, for autocomplete
+async def prefix_search(event_collection, q, limit:int, cursor=None, fields=None):
+    query = {'name_prefixes': {'$all': query_prefixes(q)}} # the first word is an index range, the others are checked on the same keys
+    if cursor:
+        query = event_query.combine_filters(query, event_query.keyset_filter(event_query.decode_cursor(cursor, 'name'), 'name'))
+    projection = event_query.build_projection(fields, extra=['name_lower'])
+    events = [event async for event in event_collection.find(query, projection).sort(event_query.sort_spec('name')).limit(limit + 1)]
+    if len(events) > limit:
+        events = events[:limit]
+        return events, event_query.encode_cursor(events[-1], 'name')
+    return events, None
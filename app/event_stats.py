@@ -0,0 +1,62 @@
+import os
+from datetime import datetime, timezone, timedelta, time
+
+from app.cache import TTLCache
+from app.db import aggregate
+from app.event_cache import event_cache
+from app.single_flight import SingleFlight
+
+# counts of live events for dashboards, grouped by MongoDB in one aggregation and memoized until the next write
+
+MAX_LOCALITIES = 50 # cities with the most events to count, the rest are left out
+UNKNOWN_LOCALITY = 'unknown' # key for events without a locality
+
+stats_cache = TTLCache(max_size=16, ttl=float(os.getenv('EVENT_STATS_TTL', 30)))
+stats_single_flight = SingleFlight() # concurrent dashboard refreshes share one aggregation
+
+
+# one pass over live_events counting events by month, by locality, in the next days and in total
+def stats_pipeline(today, upcoming_days:int=7):
+    return [{'$facet': {
+        'per_month': [
+            {'$match': {'event_date': {'$ne': None}}},
+            {'$group': {'_id': {'$dateToString': {'format': '%Y-%m', 'date': '$event_date'}}, 'count': {'$sum': 1}}},
+            {'$sort': {'_id': 1}},
+        ],
+        'per_locality': [
+            {'$group': {'_id': '$locality', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1, '_id': 1}},
+            {'$limit': MAX_LOCALITIES},
+        ],
+        'upcoming': [
+            {'$match': {'event_date': {'$gte': today, '$lt': today + timedelta(days=upcoming_days)}}},
+            {'$count': 'count'},
+        ],
+        'total': [{'$count': 'count'}],
+    }}]
+
+# compact counts from the aggregation's single document
+def format_stats(result, upcoming_days:int=7):
+    return {
+        'total': result['total'][0]['count'] if result['total'] else 0,
+        'upcoming': {'days': upcoming_days, 'count': result['upcoming'][0]['count'] if result['upcoming'] else 0},
+        'per_month': {group['_id']: group['count'] for group in result['per_month']},
+        'per_locality': {(group['_id'] or UNKNOWN_LOCALITY): group['count'] for group in result['per_locality']},
+    }
+
+# the stats, from the cache unless an event changed since they were counted (event_cache.generation moves on every write)
+async def get_event_stats(event_collection, upcoming_days:int=7):
+    today = datetime.combine(datetime.now(timezone.utc).date(), time.min) # event dates are stored as datetimes at midnight
+    key = f'{today.date()}:{upcoming_days}'
+    cached = stats_cache.get(key)
+    if cached is not None and cached[0] == event_cache.generation:
+        return cached[1]
+
+    async def count():
+        generation = event_cache.generation
+        result = await aggregate(event_collection, stats_pipeline(today, upcoming_days))
+        stats = format_stats(result[0], upcoming_days)
+        if generation == event_cache.generation: # don't keep counts that raced a write
+            stats_cache.set(key, (generation, stats))
+        return stats
+    return await stats_single_flight.do(f'{key}:{event_cache.generation}', count) # a write since starts a new count
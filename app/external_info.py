@@ -1,12 +1,142 @@
 import os
-from dotenv import load_dotenv
-import requests
+import asyncio
+import logging
+import importlib
+from time import perf_counter
+from bson.objectid import ObjectId
+
+from app.cache import TTLCache
+from app.rate_limit import TokenBucket
+from app.event_cache import event_cache
+from app.event_documents import now
+from app.telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# the event fields sources can use to find their data
+EVENT_FIELDS = {'name': 1, 'event_date': 1, 'location': 1, 'locality': 1}
+
+
+# a source of external concert data, subclasses implement fetch
+class ExternalSource:
+    name = 'source' # key of the source's data in LiveEvent.data
+
+    def __init__(self, rate:float=None, burst:float=None, timeout:float=None, cache_ttl:float=None):
+        rate = float(os.getenv('EXTERNAL_INFO_RATE', 5)) if rate is None else rate
+        self.limiter = TokenBucket(rate, burst) if rate > 0 else None # requests per second to the source, 0 for no limit
+        self.timeout = float(os.getenv('EXTERNAL_INFO_TIMEOUT', 5)) if timeout is None else timeout # seconds before giving up on the source
+        self.cache_ttl = float(os.getenv('EXTERNAL_INFO_CACHE_TTL', 3600)) if cache_ttl is None else cache_ttl
+
+    # what the source's result depends on, events with the same key share a cached result, None to not cache
+    def cache_key(self, event):
+        return '%s|%s|%s' % (event.get('name'), event.get('event_date'), event.get('locality'))
+
+    # get the source's data for an event, None if it has nothing
+    async def fetch(self, event):
+        raise NotImplementedError
+
+
+# source answering from a dict or function, for tests and local development
+class LocalFakeSource(ExternalSource):
+    name = 'fake'
+
+    def __init__(self, result=None, delay:float=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.result = result if result is not None else (lambda event: {'name': event.get('name')})
+        self.delay = delay # seconds to take, to simulate a slow API
+        self.calls = 0
+
+    async def fetch(self, event):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result(event) if callable(self.result) else self.result
+
+
+# sources that can be named in EXTERNAL_INFO_SOURCES, others can be given as module:Class
+SOURCES = {
+    'fake': LocalFakeSource,
+}
+
+# create the sources from a comma separated list of names or module:Class paths
+def load_sources(names):
+    sources = []
+    for name in [name.strip() for name in (names or '').split(',') if name.strip()]:
+        if name in SOURCES:
+            source_class = SOURCES[name]
+        else:
+            module_name, _, class_name = name.partition(':')
+            source_class = getattr(importlib.import_module(module_name), class_name)
+        sources.append(source_class())
+    return sources
+
 
 #get concert data from a variety of external APIs
 class ExternalInfo:
 
-    def __init__(self):
-        load_dotenv() # load environment variable from .env
+    def __init__(self, sources=None, cache:TTLCache=None):
+        self.sources = sources if sources is not None else []
+        self.cache = cache if cache is not None else TTLCache(max_size=int(os.getenv('EXTERNAL_INFO_CACHE_SIZE', 1024)))
+
+    # get one source's data for an event, from the cache when it has it, None if the source failed or has nothing
+    async def get_info(self, source, event):
+        key = source.cache_key(event)
+        cache_key = (source.name, key)
+        cached = self.cache.get(cache_key, _MISSING) if key is not None else _MISSING
+        if cached is not _MISSING:
+            metrics.increment(f'external_info.{source.name}.cache_hits')
+            return cached
+
+        if source.limiter is not None and not await source.limiter.acquire(timeout=source.timeout): # the wait counts against the timeout
+            metrics.increment(f'external_info.{source.name}.rate_limited')
+            return None
+        start = perf_counter()
+        try:
+            result = await asyncio.wait_for(source.fetch(event), source.timeout)
+        except asyncio.TimeoutError:
+            metrics.increment(f'external_info.{source.name}.timeouts')
+            logger.warning('External info source %s timed out', source.name)
+            return None
+        except Exception as e: # one failing source shouldn't stop the others
+            metrics.increment(f'external_info.{source.name}.errors')
+            logger.warning('External info source %s failed: %s', source.name, e)
+            return None
+        finally:
+            metrics.observe(f'external_info.{source.name}', (perf_counter() - start) * 1000)
+
+        if key is not None:
+            self.cache.set(cache_key, result, ttl=source.cache_ttl)
+        return result
+
+    # every source's data for an event, fetched concurrently, by source name
+    async def enrich(self, event):
+        results = await asyncio.gather(*[self.get_info(source, event) for source in self.sources])
+        return {source.name: result for source, result in zip(self.sources, results) if result is not None}
+
+    # enrich a stored event and merge the results into its data with one $set, leaving other data as it is
+    async def enrich_event(self, event_collection, event_id, event=None):
+        event_id = ObjectId(event_id)
+        if event is None:
+            event = await event_collection.find_one({'_id': event_id}, EVENT_FIELDS)
+            if event is None: # deleted before it could be enriched
+                return {}
+        data = await self.enrich(event)
+        if data:
+            update = {f'data.{name}': value for name, value in data.items()}
+            update['updated_at'] = now()
+            await event_collection.update_one({'_id': event_id}, {'$set': update})
+            event_cache.invalidate(event_id)
+        return data
+
+    def stats(self):
+        return {
+            'sources': [source.name for source in self.sources],
+            'cache': self.cache.stats(),
+        }
+
 
-    def get_info(self, source):
-        print('retrieving from:', source)
\ No newline at end of file
+external_info = ExternalInfo(load_sources(os.getenv('EXTERNAL_INFO_SOURCES')))
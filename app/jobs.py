@@ -0,0 +1,197 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from datetime import timedelta
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError, PyMongoError
+
+from app.event_documents import now
+from app.external_info import external_info
+from app.telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+# a small job queue in the jobs collection, for slow work that shouldn't hold up a request
+#
+# a job is visible to workers once its run_at has passed; claiming it pushes run_at a visibility timeout ahead,
+# so a job whose worker died (or whose Lambda was frozen) is picked up again once that lease runs out
+
+JOBS_COLLECTION = 'jobs'
+VISIBILITY_TIMEOUT = float(os.getenv('JOBS_VISIBILITY_TIMEOUT', 60)) # seconds a claimed job is hidden from other workers
+MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', 5))
+RETRY_BACKOFF = float(os.getenv('JOBS_RETRY_BACKOFF', 2)) # seconds before the first retry, doubled every attempt
+RETRY_BACKOFF_MAX = float(os.getenv('JOBS_RETRY_BACKOFF_MAX', 300))
+POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', 1)) # seconds an idle worker waits before looking for jobs again
+
+# job type -> async fn(db, payload)
+HANDLERS = {}
+
+def job_handler(job_type):
+    def register(fn):
+        HANDLERS[job_type] = fn
+        return fn
+    return register
+
+
+# the job document for enqueue, the key makes enqueuing idempotent
+def new_job(job_type, payload, key=None, delay:float=0.0, max_attempts:int=None):
+    created_at = now()
+    job = {
+        '_id': ObjectId(),
+        'type': job_type,
+        'payload': payload,
+        'status': 'queued',
+        'attempts': 0,
+        'attempts_left': max_attempts or MAX_ATTEMPTS,
+        'run_at': created_at + timedelta(seconds=delay),
+        'created_at': created_at,
+        'updated_at': created_at,
+    }
+    if key is not None:
+        job['key'] = key
+    return job
+
+# add a job made by new_job, returns its id, or None if a job with the same key was already added
+async def enqueue(db, job):
+    try:
+        await db.get_collection(JOBS_COLLECTION).insert_one(job)
+    except DuplicateKeyError:
+        return None
+    metrics.increment(f'jobs.{job["type"]}.enqueued')
+    return job['_id']
+
+# add many jobs with one write, skipping any whose key was already added
+async def enqueue_many(db, jobs):
+    if not jobs:
+        return
+    try:
+        await db.get_collection(JOBS_COLLECTION).insert_many(jobs, ordered=False)
+    except BulkWriteError as e:
+        if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])): # duplicate keys are expected
+            raise
+    for job in jobs:
+        metrics.increment(f'jobs.{job["type"]}.enqueued')
+
+
+# take the next visible job, hiding it from other workers for the visibility timeout, None if there isn't one
+async def claim(db, visibility_timeout:float=None):
+    current = now()
+    job = await db.get_collection(JOBS_COLLECTION).find_one_and_update(
+        # running jobs past their lease were abandoned, and are retried if they have attempts left
+        {'status': {'$in': ['queued', 'running']}, 'run_at': {'$lte': current}, 'attempts_left': {'$gt': 0}},
+        {
+            '$set': {'status': 'running', 'run_at': current + timedelta(seconds=visibility_timeout or VISIBILITY_TIMEOUT), 'updated_at': current},
+            '$inc': {'attempts': 1, 'attempts_left': -1},
+        },
+        sort=[('run_at', 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+    if job is None: # only swept when idle, so it costs nothing while there are jobs to run
+        await fail_abandoned(db, current)
+    return job
+
+# mark jobs abandoned on their last attempt as failed, they can't be claimed again and would stay running forever
+async def fail_abandoned(db, current=None):
+    current = current or now()
+    await db.get_collection(JOBS_COLLECTION).update_many(
+        {'status': 'running', 'run_at': {'$lte': current}, 'attempts_left': {'$lte': 0}},
+        {'$set': {'status': 'failed', 'error': 'abandoned on its last attempt', 'finished_at': current, 'updated_at': current}},
+    )
+
+# full jitter exponential backoff before retrying a job
+def retry_delay(attempts):
+    return random.uniform(0, min(RETRY_BACKOFF * 2 ** (attempts - 1), RETRY_BACKOFF_MAX))
+
+# run a claimed job and record how it went, returns True if it succeeded
+async def run_job(db, job):
+    jobs = db.get_collection(JOBS_COLLECTION)
+    lease = {'_id': job['_id'], 'attempts': job['attempts']} # a worker that lost its lease mustn't overwrite the new one
+    handler = HANDLERS.get(job['type'])
+    start = time.perf_counter()
+    try:
+        if handler is None:
+            raise LookupError('no handler for job type ' + job['type'])
+        await handler(db, job['payload'])
+    except Exception as e:
+        finished = now()
+        metrics.increment(f'jobs.{job["type"]}.errors')
+        if job['attempts_left'] > 0 and handler is not None:
+            logger.warning('Job %s (%s) failed, retrying: %s', job['_id'], job['type'], e)
+            update = {'status': 'queued', 'run_at': finished + timedelta(seconds=retry_delay(job['attempts']))}
+        else:
+            logger.error('Job %s (%s) failed: %s', job['_id'], job['type'], e)
+            update = {'status': 'failed', 'finished_at': finished}
+        await jobs.update_one(lease, {'$set': dict(update, error=str(e), updated_at=finished)})
+        return False
+    finally:
+        metrics.observe(f'jobs.{job["type"]}', (time.perf_counter() - start) * 1000)
+
+    finished = now()
+    await jobs.update_one(lease, {'$set': {'status': 'done', 'finished_at': finished, 'updated_at': finished}})
+    metrics.increment(f'jobs.{job["type"]}.done')
+    return True
+
+# run jobs until there are none visible, or there isn't time for another, for a scheduled Lambda
+async def drain(db, time_budget:float=None, max_jobs:int=None, concurrency:int=1):
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    results = {'done': 0, 'failed': 0}
+
+    async def worker():
+        while max_jobs is None or results['done'] + results['failed'] < max_jobs:
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            job = await claim(db)
+            if job is None:
+                return
+            results['done' if await run_job(db, job) else 'failed'] += 1
+
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+    return results
+
+
+# pool of workers polling for jobs in the background of a long running server
+class JobWorkerPool:
+    def __init__(self, db, concurrency:int=2, poll_interval:float=None):
+        self.db = db
+        self.concurrency = concurrency
+        self.poll_interval = POLL_INTERVAL if poll_interval is None else poll_interval
+        self._tasks = []
+        self._stopping = False
+
+    def start(self):
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self.work()) for i in range(self.concurrency)]
+
+    # cancel the workers and wait for them, cancelling again every cancel_interval seconds
+    # as a cancel can be lost in the driver's waits (asyncio.wait_for on Python 3.11) while it's retrying server selection
+    async def stop(self, cancel_interval:float=1.0):
+        self._stopping = True
+        while self._tasks:
+            for task in self._tasks:
+                task.cancel()
+            done, pending = await asyncio.wait(self._tasks, timeout=cancel_interval)
+            self._tasks = list(pending)
+
+    async def work(self):
+        while not self._stopping: # a lost cancel still ends the worker at its next job
+            try:
+                job = await claim(self.db)
+                if job is not None:
+                    await run_job(self.db, job)
+                    continue
+            except PyMongoError as e: # the job's lease runs out and it's retried
+                logger.warning('Job worker failed: %s', e)
+            await asyncio.sleep(self.poll_interval * random.uniform(0.5, 1.5)) # jittered so idle workers don't poll in step
+
+
+# enrich a created event with external info
+@job_handler('enrich_event')
+async def enrich_event(db, payload):
+    await external_info.enrich_event(db.get_collection('live_events'), payload['event_id'])
+
+# job enriching an event, at most one per event
+def enrich_event_job(event_id):
+    return new_job('enrich_event', {'event_id': str(event_id)}, key=f'enrich_event:{event_id}')
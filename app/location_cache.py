@@ -0,0 +1,153 @@
+import os
+import logging
+import math
+from datetime import datetime, timezone, timedelta
+from pymongo.errors import PyMongoError
+
+from app.cache import TTLCache
+from app.db import get_database
+
+logger = logging.getLogger(__name__)
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+# encode coordinates as a geohash, each extra character makes the cell smaller (8 characters is about 38m x 19m)
+def geohash(lat:float, lng:float, precision:int=8):
+    return geohash_cell(lat, lng, precision)[0]
+
+# the geohash of coordinates and the (south, north) and (west, east) bounds of its cell
+def geohash_cell(lat:float, lng:float, precision:int=8):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True # bits alternate between longitude and latitude, starting with longitude
+    while len(chars) < precision:
+        value, value_range = (lng, lng_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5: # every 5 bits is one base32 character
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars), tuple(lat_range), tuple(lng_range)
+
+
+# cache of Places search results, keyed by geohash cell, search type and radius bucket
+# with an in-process tier and an optional Mongo tier shared between instances
+class LocationCache:
+    def __init__(self, max_size:int=2048, ttl:float=86400.0, precision:int=8, radius_bucket:float=25.0, collection_getter=None):
+        self.memory = TTLCache(max_size=max_size, ttl=ttl) # in-process tier
+        self.ttl = ttl
+        self.precision = precision # geohash characters used for the cell
+        self.radius_bucket = radius_bucket # radii are rounded up to a multiple of this many meters
+        self.collection_getter = collection_getter # returns the Mongo collection for the shared tier, None to disable it
+        self._indexes_created = False
+        self.hits = 0
+        self.misses = 0
+        self.mongo_hits = 0
+        self.mongo_errors = 0
+
+    # normalized key for a search, nearby coordinates with the same search type and similar radius share a key
+    def search_key(self, coords, search_type, search_radius:float):
+        cell = geohash(coords['latitude'], coords['longitude'], self.precision)
+        return f'{cell}:{search_type.name}:{self.bucket_radius(search_radius):g}'
+
+    # round a radius up to its bucket
+    def bucket_radius(self, search_radius:float):
+        return math.ceil(search_radius / self.radius_bucket) * self.radius_bucket
+
+    # the centre of the coordinates' cell and one of its corners, a search from the centre with the bucket radius
+    # plus the centre to corner distance covers the circle of every search sharing the key
+    def cell_center_and_corner(self, coords):
+        cell, (south, north), (west, east) = geohash_cell(coords['latitude'], coords['longitude'], self.precision)
+        center = {'latitude': (south + north) / 2, 'longitude': (west + east) / 2}
+        corner = {'latitude': south if abs(north) >= abs(south) else north, 'longitude': east} # degrees of longitude are longest nearest the equator, so that corner is furthest
+        return center, corner
+
+    async def get(self, key):
+        result = self.memory.get(key)
+        if result is None:
+            result = await self.get_shared(key)
+            if result is not None:
+                self.mongo_hits += 1
+                self.memory.set(key, result)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    async def set(self, key, result):
+        self.memory.set(key, result)
+        await self.set_shared(key, result)
+
+    # get a result from the Mongo tier
+    async def get_shared(self, key):
+        collection = self.get_collection()
+        if collection is None:
+            return None
+        try:
+            doc = await collection.find_one({'_id': key, 'expires_at': {'$gt': datetime.now(timezone.utc)}})
+        except PyMongoError as e: # the shared tier is best effort, fall through to the Places API
+            self.mongo_errors += 1
+            logger.warning('Location cache read failed: %s', e)
+            return None
+        return doc['result'] if doc else None
+
+    # save a result to the Mongo tier, expired documents are removed by a TTL index
+    async def set_shared(self, key, result):
+        collection = self.get_collection()
+        if collection is None:
+            return
+        try:
+            if not self._indexes_created:
+                await collection.create_index('expires_at', expireAfterSeconds=0)
+                self._indexes_created = True
+            await collection.replace_one(
+                {'_id': key},
+                {'result': result, 'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl)},
+                upsert=True
+            )
+        except PyMongoError as e:
+            self.mongo_errors += 1
+            logger.warning('Location cache write failed: %s', e)
+
+    def get_collection(self):
+        return self.collection_getter() if self.collection_getter else None
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / lookups) if lookups else 0.0,
+            'mongo_hits': self.mongo_hits,
+            'mongo_errors': self.mongo_errors,
+            'memory': self.memory.stats(),
+        }
+
+
+# the Mongo tier uses the shared database client
+def get_location_cache_collection():
+    return get_database().get_collection('location_cache')
+
+location_cache = LocationCache(
+    max_size=int(os.getenv('LOCATION_CACHE_MAX_SIZE', 2048)),
+    ttl=float(os.getenv('LOCATION_CACHE_TTL', 86400)),
+    precision=int(os.getenv('LOCATION_CACHE_PRECISION', 8)),
+    radius_bucket=float(os.getenv('LOCATION_CACHE_RADIUS_BUCKET', 25)),
+    collection_getter=get_location_cache_collection if os.getenv('LOCATION_CACHE_MONGO', '').lower() in ('1', 'true', 'yes') else None,
+)
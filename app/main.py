@@ -1,28 +1,60 @@
-from typing import Union
-from fastapi import FastAPI, Depends, HTTPException, Body
+import os
+from typing import Optional, Literal
+from fastapi import FastAPI, Depends, HTTPException, Body, Query
+from fastapi.responses import StreamingResponse, Response
 from typing_extensions import Annotated
 
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.encoders import jsonable_encoder
 from http import HTTPStatus
 
-from app.db import lifespan, connect_to_db
-from app.models import LiveEvent, UpdateLiveEvent
+from app.db import lifespan, connect_to_db, pool_metrics, client_metrics, aggregate, indexes_ready
+from app.models import LiveEvent, UpdateLiveEvent, NearbyLiveEvent, SearchLiveEvent, BulkEventOperation, BulkEventResult, Coordinates
+from app.bulk_events import run_bulk_operations, MAX_BULK_OPERATIONS
+from app.telemetry import RequestStats, request_stats, metrics, log_request, configure_logging
+from app.responses import ORJSONResponse, dumps
+from app.event_cache import event_cache, watch_event_changes
+from app.event_stats import get_event_stats, stats_cache
+from app.external_info import external_info
+from app import event_query, event_documents, event_changes, event_search, etags, jobs
 
-from app.maps_info import MapsInfo, SearchType
-from PIL import Image
+from app.maps_info import MapsInfo, SearchType, PlacesError, close_http_client, places_single_flight, places_limiter, places_shared_limiter, places_breaker
+from app.location_cache import location_cache
+from app.venues import venue_catalog
 from bson.objectid import ObjectId
-from pymongo import MongoClient, ReturnDocument
-import json
-import io
-from datetime import datetime, timezone
+from pymongo import ReturnDocument
+from datetime import date
+from contextlib import asynccontextmanager
 
 from mangum import Mangum # Use mangum for AWS
 from starlette.requests import Request
 import asyncio
+from time import perf_counter
 
-app = FastAPI(lifespan=lifespan) # start FastAPI with lifespan
-print('app:',app)
+configure_logging()
+
+# app startup and shutdown, around the database lifespan
+@asynccontextmanager
+async def app_lifespan(app: FastAPI):
+    async with lifespan(app):
+        watcher = None
+        if os.getenv('EVENT_CACHE_WATCH', 'true').lower() in ('1', 'true', 'yes'): # evict events changed by other instances
+            watcher = asyncio.create_task(watch_event_changes(app.db.get_collection("live_events")))
+        workers = None
+        if int(os.getenv('JOBS_WORKERS', 2)) > 0: # run queued jobs in this server, Lambda runs them with jobs_handler instead
+            workers = jobs.JobWorkerPool(app.db, concurrency=int(os.getenv('JOBS_WORKERS', 2)))
+            workers.start()
+        yield
+        if watcher is not None:
+            watcher.cancel()
+        if workers is not None:
+            await workers.stop()
+        await close_http_client() # close the shared Places API client
+
+app = FastAPI(lifespan=app_lifespan, default_response_class=ORJSONResponse) # start FastAPI with lifespan
+
+MAX_PAGE_SIZE = 1000 # largest page of events that can be requested at once
+MAX_NEARBY_RADIUS = 100000.0 # largest radius in meters for nearby events
+MAX_LOCATION_POINTS = 500 # most points in one /locations:batch request
 
 
 # CORS settings
@@ -32,10 +64,28 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-DB-Round-Trips", "ETag", "Server-Timing"],
 )
 
+# time each request and count its database round trips, returned in the Server-Timing and X-DB-Round-Trips headers
+# streamed responses are timed until their headers are sent
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    stats = RequestStats()
+    request_stats.set(stats)
+    start = perf_counter()
+    response = await call_next(request)
+    duration_ms = (perf_counter() - start) * 1000
+    route = getattr(request.scope.get('route'), 'path', 'unmatched') # the route template, so ids don't make every path unique
+    metrics.observe(f'route:{request.method} {route}', duration_ms)
+    response.headers['X-DB-Round-Trips'] = str(stats.db_round_trips)
+    response.headers['Server-Timing'] = stats.server_timing(duration_ms)
+    log_request(request.method, route, response.status_code, duration_ms, stats)
+    return response
+
 def setup_maps_info(): #prepare maps_info by dependency injection
-    maps = MapsInfo()
+    maps = MapsInfo(cache=location_cache, single_flight=places_single_flight, venues=venue_catalog,
+                    limiter=places_limiter, shared_limiter=places_shared_limiter, breaker=places_breaker)
     yield maps
 
 
@@ -43,102 +93,288 @@ def setup_maps_info(): #prepare maps_info by dependency injection
 async def read_root():
     return {"Hello": "World"}
 
-# Get all events
+# Runtime metrics for sizing and tuning
+@app.get("/metrics", response_description="Get runtime metrics")
+async def get_metrics():
+    return {
+        'db_pool': pool_metrics.snapshot(), # connection pool checkouts and waits
+        'db_client': dict(client_metrics), # clients created and reconnects after health checks
+        'location_cache': location_cache.stats(), # /locations cache hits and misses
+        'venue_catalog': venue_catalog.stats() if venue_catalog else None, # /locations answered from saved venues
+        'places_coalescing': places_single_flight.stats(), # Places searches shared between concurrent requests
+        'places_quota': { # Places rate limits and circuit breaker
+            'limiter': places_limiter.stats() if places_limiter else None,
+            'shared_limiter': places_shared_limiter.stats() if places_shared_limiter else None,
+            'breaker': places_breaker.stats(),
+        },
+        'event_cache': event_cache.stats(), # events served without a database read
+        'event_stats_cache': stats_cache.stats(), # /events/stats served without an aggregation
+        'external_info': external_info.stats(), # events being enriched with external data
+        **metrics.snapshot(), # route, MongoDB command and Places latency histograms, and counters
+    }
+
+# Get all events, keyset paginated with an optional projection, or streamed as NDJSON
 @app.get("/events", response_model=list[LiveEvent], response_model_by_alias=False, response_model_exclude_none=True,
          response_description="Get a list of all live events")
-async def list_events(db=Depends(connect_to_db)) -> list[LiveEvent]:
+async def list_events(request: Request,
+                      limit: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of events to return"),
+                      cursor: Optional[str] = Query(default=None, description="next_cursor from the previous page"),
+                      fields: Optional[str] = Query(default=None, description="Comma separated list of fields to return"),
+                      sort: Optional[Literal['_id', 'event_date', 'name']] = Query(default=None, description="Field to page through the events by, the filtered field or _id by default"),
+                      order: Literal['asc', 'desc'] = Query(default=event_query.DEFAULT_ORDER, description="Sort order"),
+                      date_from: Optional[date] = Query(default=None, alias='from', description="Earliest event date"),
+                      date_to: Optional[date] = Query(default=None, alias='to', description="Latest event date"),
+                      name: Optional[str] = Query(default=None, min_length=1, max_length=100, description="Case insensitive prefix of the event name"),
+                      locality: Optional[str] = Query(default=None, min_length=1, max_length=100, description="City of the event's location"),
+                      format: Literal['json', 'ndjson'] = Query(default='json', description="ndjson streams the events one per line"),
+                      db=Depends(connect_to_db)):
+    sort = sort or event_query.default_sort(date_from, date_to, name)
+    try:
+        event_query.check_sort(sort, date_from, date_to, name)
+        field_names = event_query.parse_fields(fields)
+        after_cursor = event_query.keyset_filter(event_query.decode_cursor(cursor, sort), sort, order) if cursor else {}
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    query = event_query.combine_filters(event_query.build_filter(date_from, date_to, name, locality), after_cursor)
+    sort_spec = event_query.sort_spec(sort, order)
+
     event_collection = db.get_collection("live_events")
-    events = []
-    async for event in event_collection.find():
-        print(event)
-        events.append(LiveEvent(**event))
-    #events = event_collection.findAll()
-    return events
+    projection = event_query.build_projection(field_names, extra=[event_query.SORT_FIELDS[sort], 'updated_at']) # updated_at is needed for the ETag
+    hint = event_query.index_hint(sort, locality) if indexes_ready() else None # so the plan never falls back to an in-memory sort
+    events_cursor = event_collection.find(query, projection).sort(sort_spec)
+    if hint:
+        events_cursor = events_cursor.hint(hint)
+
+    if format == 'ndjson': # stream the documents as the cursor yields them, so a full export never sits in memory
+        if limit:
+            events_cursor = events_cursor.limit(limit)
+
+        async def stream_events():
+            async for event in events_cursor:
+                yield dumps(event_query.serialize_event(event, field_names)) + b'\n'
+        return StreamingResponse(stream_events(), media_type='application/x-ndjson')
+
+    window = limit + 1 if limit else None # fetch one extra to know if there's another page
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match: # check the ETag with a summary of the page before fetching and serializing it
+        summary = await aggregate(event_collection, etags.summary_pipeline(query, sort_spec, window), **({'hint': hint} if hint else {}))
+        etag = etags.list_etag(request.query_params, summary[0] if summary else {})
+        if etags.none_match_fails(if_none_match, etag):
+            return Response(status_code=HTTPStatus.NOT_MODIFIED, headers={'ETag': etag, 'Cache-Control': etags.CACHE_CONTROL})
+
+    if window:
+        events_cursor = events_cursor.limit(window)
+    events = [event async for event in events_cursor]
+
+    headers = {
+        'ETag': etags.list_etag(request.query_params, etags.list_summary(events)),
+        'Cache-Control': etags.CACHE_CONTROL,
+    }
+    if limit and len(events) > limit:
+        events = events[:limit]
+        headers['X-Next-Cursor'] = event_query.encode_cursor(events[-1], sort)
+    return ORJSONResponse([event_query.serialize_event(event, field_names) for event in events], headers=headers)
+
+# Get events near coordinates, nearest first
+@app.get("/events/nearby", response_model=list[NearbyLiveEvent], response_model_by_alias=False, response_model_exclude_none=True,
+         response_description="Get live events near coordinates")
+async def list_nearby_events(lat: float = Query(ge=-90, le=90), lng: float = Query(ge=-180, le=180),
+                             radius: float = Query(default=5000.0, gt=0, le=MAX_NEARBY_RADIUS, description="Search radius in meters"),
+                             date_from: Optional[date] = Query(default=None, alias='from', description="Earliest event date"),
+                             date_to: Optional[date] = Query(default=None, alias='to', description="Latest event date"),
+                             limit: int = Query(default=100, ge=1, le=MAX_PAGE_SIZE),
+                             db=Depends(connect_to_db)):
+    query = event_query.build_filter(date_from, date_to)
+    event_collection = db.get_collection("live_events")
+    events = await aggregate(event_collection, [
+        {'$geoNear': { # uses the 2dsphere index on geo, and sorts by distance
+            'near': {'type': 'Point', 'coordinates': [lng, lat]},
+            'key': 'geo',
+            'distanceField': 'distance',
+            'maxDistance': radius,
+            'spherical': True,
+            'query': query,
+        }},
+        {'$limit': limit},
+    ])
+    return ORJSONResponse([event_query.serialize_event(event, model=NearbyLiveEvent) for event in events])
+
+# Counts of events per month, per city and coming up, for dashboards
+@app.get("/events/stats", response_description="Get counts of live events")
+async def event_stats(upcoming_days: int = Query(default=7, ge=1, le=90, description="Days ahead to count upcoming events for"),
+                      db=Depends(connect_to_db)):
+    return await get_event_stats(db.get_collection("live_events"), upcoming_days)
+
+# Search events by name, location and description, or autocomplete names by word prefixes
+@app.get("/events/search", response_model=list[SearchLiveEvent], response_model_by_alias=False, response_model_exclude_none=True,
+         response_description="Get live events matching a search, best match first")
+async def search_events(q: str = Query(min_length=event_documents.MIN_PREFIX, max_length=100, description="Words to search for"),
+                        mode: Literal['text', 'prefix'] = Query(default='text', description="text ranks by relevance, prefix matches the starts of name words for autocomplete"),
+                        limit: int = Query(default=20, ge=1, le=100, description="Maximum number of events to return"),
+                        cursor: Optional[str] = Query(default=None, description="X-Next-Cursor from the previous page"),
+                        fields: Optional[str] = Query(default=None, description="Comma separated list of fields to return, id, name and event_date by default"),
+                        db=Depends(connect_to_db)):
+    event_collection = db.get_collection("live_events")
+    try:
+        field_names = event_query.parse_fields(fields) or event_search.DEFAULT_FIELDS
+        search = event_search.text_search if mode == 'text' else event_search.prefix_search
+        events, next_cursor = await search(event_collection, q, limit, cursor, field_names)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    headers = {'X-Next-Cursor': next_cursor} if next_cursor else None
+    return ORJSONResponse([event_query.serialize_event(event, field_names | {'score'}, model=SearchLiveEvent) for event in events], headers=headers)
+
+# Events created, updated and deleted since a token, for clients keeping an offline copy in sync
+@app.get("/events/changes", response_description="Get the live events changed since a sync token")
+async def list_event_changes(since: Optional[str] = Query(default=None, description="next token from the previous sync, leave out to sync from scratch"),
+                             limit: int = Query(default=500, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of changes to return"),
+                             db=Depends(connect_to_db)):
+    try:
+        changes = await event_changes.get_changes(db, since, limit)
+    except event_changes.TokenExpired as e: # deletions since the token may be gone
+        raise HTTPException(status_code=HTTPStatus.GONE, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    changes['events'] = [event_query.serialize_event(event) for event in changes['events']]
+    return ORJSONResponse(changes)
 
 # Get event by id
 @app.get("/events/{event_id}", response_model=LiveEvent, response_model_by_alias=False, response_model_exclude_none=True,
          response_description="Gets a live events by id")
-async def get_event(event_id: str, db=Depends(connect_to_db)) -> LiveEvent:
-    event_collection = db.get_collection("live_events")
-    #might need to use aggregate
-    print(event_id)
-    event = await event_collection.find_one({'_id': ObjectId(event_id)})
-    if event:
-        return event
-    else:
-        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Event with that ID not found")
+async def get_event(event_id: str, request: Request, db=Depends(connect_to_db)) -> LiveEvent:
+    event = event_cache.get(event_id)
+    if event is None:
+        generation = event_cache.generation
+        event_collection = db.get_collection("live_events")
+        event = await event_collection.find_one({'_id': ObjectId(event_id)})
+        if not event:
+            raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Event with that ID not found")
+        event_cache.set(event, generation)
+
+    headers = {'ETag': etags.event_etag(event), 'Cache-Control': etags.CACHE_CONTROL}
+    if etags.none_match_fails(request.headers.get('if-none-match'), headers['ETag']): # unchanged, so skip serializing it
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return ORJSONResponse(event_query.serialize_event(event), headers=headers)
 
 # Create a new event
 @app.post("/events", response_model=LiveEvent, response_model_by_alias=False, response_model_exclude_none=True,
           response_description="Create a new live event")
 async def create_event(event:Annotated[UpdateLiveEvent, Body(embed=True)], db=Depends(connect_to_db)):
-    #exclude None values from the live event
-    print(event)
-    print('Removing none from event')
-    event = {
-        k: v for k, v in event.model_dump(by_alias=True).items() if v is not None
-    }
-    if 'event_date' in event: # convert string to date
-        event['event_date'] = datetime.strptime(event['event_date'], '%Y-%m-%d')
-    event['created_at'] = datetime.now(timezone.utc)
-    event['updated_at'] = datetime.now(timezone.utc)
-    print(event)
-
+    try:
+        event = event_documents.prepare_event(event, creating=True)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
     event_collection = db.get_collection("live_events")
     # prepare for insertion
 
-    id = (await event_collection.insert_one(event)).inserted_id
-    result_event = await event_collection.find_one({'_id': id})
-    return result_event
+    # the stored event is what was inserted plus its id, so there's no need to read it back
+    event['_id'] = ObjectId()
+    await event_collection.insert_one(event)
+    if external_info.sources: # enrich it later, queued once it's inserted so a worker can't claim the job before the event exists
+        await jobs.enqueue(db, jobs.enrich_event_job(event['_id']))
+    event_cache.invalidate(event['_id'])
+    return ORJSONResponse(event_query.serialize_event(event), headers={'ETag': etags.event_etag(event)})
+
+# Create, update and delete many events at once
+@app.post("/events:bulk", response_model=list[BulkEventResult], response_model_exclude_none=True,
+          response_description="Results of each operation, in the same order as the request")
+async def bulk_events(operations:Annotated[list[BulkEventOperation], Body(embed=True, max_length=MAX_BULK_OPERATIONS)], db=Depends(connect_to_db)):
+    event_collection = db.get_collection("live_events")
+    results = await run_bulk_operations(event_collection, operations)
+    for result in results:
+        if 'id' in result:
+            event_cache.invalidate(result['id'])
+    await event_changes.record_deletions(db, [result['id'] for result in results if result.get('status') == 'deleted'])
+    if external_info.sources:
+        await jobs.enqueue_many(db, [jobs.enrich_event_job(result['id']) for result in results if result.get('status') == 'created'])
+    return results
+
+# filter for writing an event, with the versions allowed by an If-Match header
+def conditional_filter(event_id, if_match):
+    event_filter = {'_id': ObjectId(event_id)}
+    versions = etags.if_match_versions(if_match, event_id)
+    if versions is not None:
+        if not versions: # none of the ETags are for this event
+            raise HTTPException(status_code=HTTPStatus.PRECONDITION_FAILED, detail="Event has been changed")
+        event_filter['updated_at'] = {'$in': versions}
+    return event_filter
+
+# raise the error for a conditional write that didn't match, only checking which when it's needed
+async def raise_write_failed(event_collection, event_id, if_match):
+    if if_match is not None and await event_collection.find_one({'_id': ObjectId(event_id)}, {'_id': 1}):
+        raise HTTPException(status_code=HTTPStatus.PRECONDITION_FAILED, detail="Event has been changed")
+    raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Event with that ID not found")
 
 # Update an event
 @app.patch("/events/{event_id}", response_model=LiveEvent, response_model_by_alias=False, response_model_exclude_none=True,
           response_description="Update a live event")
-async def update_event(event_id: str, event:Annotated[UpdateLiveEvent, Body(embed=True)], db=Depends(connect_to_db)):
+async def update_event(event_id: str, event:Annotated[UpdateLiveEvent, Body(embed=True)], request: Request, db=Depends(connect_to_db)):
     event_collection = db.get_collection("live_events")
 
-    #exclude None values from the live event
-    print(event)
-    print('Removing none from event')
-    event = {
-        k: v for k, v in event.model_dump(by_alias=True).items() if v is not None
-    }
+    try:
+        event = event_documents.prepare_event(event)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
     if len(event) > 0:
-        if 'event_date' in event: # convert string to date
-            event['event_date'] = datetime.strptime(event['event_date'], '%Y-%m-%d')
-
+        if_match = request.headers.get('if-match')
         update_result = await event_collection.find_one_and_update(
-            {'_id': ObjectId(event_id)},
+            conditional_filter(event_id, if_match), # only updates the version the client has when If-Match is given
             {'$set': event},
             return_document=ReturnDocument.AFTER
         )
-        print('Update result:', update_result)
+        event_cache.invalidate(event_id)
         if update_result is not None:
-            return update_result
+            return ORJSONResponse(event_query.serialize_event(update_result), headers={'ETag': etags.event_etag(update_result)})
         else:
-            raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Event with that ID not found")
+            await raise_write_failed(event_collection, event_id, if_match)
     else:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Event with that ID not found")
 
 # Delete an event
 @app.delete("/events/{event_id}", response_description="Delete a live event")
-async def delete_event(event_id: str, db=Depends(connect_to_db)):
+async def delete_event(event_id: str, request: Request, db=Depends(connect_to_db)):
     event_collection = db.get_collection("live_events")
-    delete_result = await event_collection.delete_one({'_id': ObjectId(event_id)})
+    if_match = request.headers.get('if-match')
+    delete_result = await event_collection.delete_one(conditional_filter(event_id, if_match))
+    event_cache.invalidate(event_id)
     if delete_result.deleted_count > 0:
+        await event_changes.record_deletions(db, [event_id]) # so clients syncing changes remove it
         return {"message": "Event deleted successfully"}
     else:
-        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Event with that ID not found")
+        await raise_write_failed(event_collection, event_id, if_match)
 
 @app.get("/locations", response_description="Get places based on coordinates")
-async def get_places(lat: float, lng: float, search_type: int = 1, radius: float = 50.0, maps=Depends(setup_maps_info)):
-    maps = MapsInfo()
+async def get_places(lat: float, lng: float, search_type: int = 1,
+                     radius: float = Query(default=50.0, gt=0, le=MapsInfo.MAX_SEARCH_RADIUS, description="Search radius in meters"),
+                     maps=Depends(setup_maps_info)):
     coords = {'longitude': lng, 'latitude':lat}
-    print('Search Type', SearchType(search_type))
-    return maps.get_location(coords, search_type=SearchType(search_type), search_radius=radius)
+    try:
+        return await maps.get_location(coords, search_type=SearchType(search_type), search_radius=radius)
+    except PlacesError as e: # 502 if Places failed, 503 if it wasn't asked because of the quota guards
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=e.headers())
+
+# Get places for many coordinates at once, e.g. every photo of a gallery, nearby points share one Places search
+@app.post("/locations:batch", response_description="Places near each point, in the same order as the request")
+async def get_places_batch(points:Annotated[list[Coordinates], Body(embed=True, min_length=1, max_length=MAX_LOCATION_POINTS)],
+                           search_type: Annotated[int, Body(ge=1, le=3)] = 1,
+                           radius: Annotated[float, Body(gt=0, le=MapsInfo.MAX_SEARCH_RADIUS)] = 50.0,
+                           maps=Depends(setup_maps_info)):
+    return await maps.get_locations([point.model_dump() for point in points], search_type=SearchType(search_type), search_radius=radius)
 
 handler = Mangum(app=app, lifespan="off") # Use Mangum to handle AWS Lambda events
 
+# run queued jobs until there are none left or the invocation is nearly out of time, for a Lambda on a schedule
+async def drain_jobs(time_budget:float=None):
+    db = await connect_to_db()
+    return await jobs.drain(db, time_budget=time_budget, concurrency=int(os.getenv('JOBS_DRAIN_CONCURRENCY', 4)))
+
+def jobs_handler(event, context): # Lambda entry point, e.g. an EventBridge schedule every minute
+    time_budget = None
+    if context is not None: # stop claiming jobs in time to finish the ones running
+        time_budget = context.get_remaining_time_in_millis() / 1000 - float(os.getenv('JOBS_DRAIN_MARGIN', 10))
+    # run on the process's event loop like Mangum does, a new loop every invocation would make new database and HTTP clients
+    return asyncio.get_event_loop().run_until_complete(drain_jobs(time_budget))
+
 if __name__ == "__main__":
    import uvicorn
    uvicorn.run(app, host="0.0.0.0", port=8080)
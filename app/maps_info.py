@@ -1,10 +1,19 @@
 import os
-from dotenv import load_dotenv
-import requests
 from enum import Enum
-import json
+import asyncio
+import random
 import math
+from http import HTTPStatus
+from time import perf_counter
 
+from app.circuit_breaker import CircuitBreaker
+from app.db import get_database
+from app.rate_limit import AdaptiveTokenBucket, MongoRateLimiter
+from app.single_flight import SingleFlight
+from app.telemetry import metrics, record_timing
+from app.venues import MAX_RESULTS
+
+# httpx and numpy are imported where they're used, so they stay off the cold start path of routes that don't need them
 
 
 class SearchType(Enum): # Enum for search types
@@ -13,28 +22,211 @@ class SearchType(Enum): # Enum for search types
     UNRESTRICTED = 3 # Unrestricted search type
 
 
+PLACES_URL = os.getenv('PLACES_API_URL', 'https://places.googleapis.com/v1/places:searchNearby') # Google Places Search Nearby API url, overridable for stubs
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504} # statuses worth retrying, rate limited or server errors
+
+# shared keep-alive client and concurrency limit for the Places API, these belong to the event loop they were created on
+_http_client = None
+_http_client_loop = None
+_request_semaphore = None
+_request_semaphore_loop = None
+
+# identical searches in flight at the same time share one Places request
+places_single_flight = SingleFlight(
+    window=float(os.getenv('PLACES_COALESCE_WINDOW', 0.0)),
+    wait_timeout=float(os.getenv('PLACES_COALESCE_TIMEOUT', 5.0)) or None,
+)
+
+# quota guards for the Places API, shared by every request in the process
+_places_rate = float(os.getenv('PLACES_RATE_LIMIT', 10)) # requests per second, 0 for no limit
+places_limiter = AdaptiveTokenBucket(_places_rate, float(os.getenv('PLACES_RATE_BURST', 0)) or None) if _places_rate > 0 else None
+_places_shared_rate = float(os.getenv('PLACES_SHARED_RATE_LIMIT', 0)) # requests per second across every instance, 0 to not share a limit
+places_shared_limiter = MongoRateLimiter(
+    'places', _places_shared_rate, lambda: get_database().get_collection('rate_limits'),
+) if _places_shared_rate > 0 else None
+places_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv('PLACES_BREAKER_THRESHOLD', 5)),
+    reset_timeout=float(os.getenv('PLACES_BREAKER_RESET', 30)),
+)
+
+
+# a Places search that failed, the API answered with an error or couldn't be reached
+class PlacesError(Exception):
+    status_code = HTTPStatus.BAD_GATEWAY
+
+    def __init__(self, message, upstream_status=None):
+        super().__init__(message)
+        self.upstream_status = upstream_status # status the Places API answered with, if it answered
+
+    def headers(self):
+        return None
+
+# a Places search that wasn't made, because the circuit is open or the rate limit was reached
+class PlacesUnavailable(PlacesError):
+    status_code = HTTPStatus.SERVICE_UNAVAILABLE
+
+    def __init__(self, message, retry_after:float=None):
+        super().__init__(message)
+        self.retry_after = retry_after # seconds until a search is likely to be made
+
+    def headers(self):
+        return {'Retry-After': str(math.ceil(self.retry_after))} if self.retry_after else None
+
+
+# get the shared HTTP/2 client, a new one is made if the event loop changed (e.g. Mangum running a new loop)
+def get_http_client():
+    import httpx
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client_loop is not loop:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(
+                float(os.getenv('PLACES_READ_TIMEOUT', 10.0)),
+                connect=float(os.getenv('PLACES_CONNECT_TIMEOUT', 3.0)),
+            ),
+            limits=httpx.Limits(
+                max_connections=int(os.getenv('PLACES_MAX_CONNECTIONS', 20)),
+                keepalive_expiry=float(os.getenv('PLACES_KEEPALIVE_EXPIRY', 30.0)),
+            ),
+        )
+        _http_client_loop = loop
+    return _http_client
+
+# get the semaphore bounding concurrent Places requests for the running event loop
+def get_request_semaphore():
+    global _request_semaphore, _request_semaphore_loop
+    loop = asyncio.get_running_loop()
+    if _request_semaphore is None or _request_semaphore_loop is not loop:
+        _request_semaphore = asyncio.Semaphore(int(os.getenv('PLACES_MAX_CONCURRENCY', 10)))
+        _request_semaphore_loop = loop
+    return _request_semaphore
+
+# close the shared client, on shutdown
+async def close_http_client():
+    global _http_client, _http_client_loop
+    if _http_client is not None and _http_client_loop is asyncio.get_running_loop():
+        await _http_client.aclose()
+    _http_client = None
+    _http_client_loop = None
+
+
 class MapsInfo:
     R = 6371000  # radius of Earth in meters
+    BATCH_MIN_POINTS = 64 # fewest points worth computing with haversine_batch, see benchmarks/bench_haversine.py
+    MAX_SEARCH_RADIUS = 50000.0 # largest radius the Places API accepts, in meters
 
-    def __init__(self):
-        load_dotenv() # load environment variable from .env
-
-    def get_location(self, coords, search_type:SearchType=SearchType.DEFAULT, search_radius:float=50.0):
+    def __init__(self, cache=None, single_flight=None, venues=None, limiter=None, shared_limiter=None, breaker=None):
+        self.cache = cache # optional LocationCache in front of the Places API
+        self.venues = venues # optional VenueCatalog answering searches in areas Places was already searched
+        self.single_flight = single_flight # optional SingleFlight so concurrent identical searches share a request
+        self.limiter = limiter # optional TokenBucket for the process, an AdaptiveTokenBucket also slows down after a 429
+        self.shared_limiter = shared_limiter # optional MongoRateLimiter shared with other instances
+        self.breaker = breaker # optional CircuitBreaker opened by repeated 429s and server errors
+        self.rate_limit_timeout = float(os.getenv('PLACES_RATE_LIMIT_TIMEOUT', 2.0)) # longest wait for the rate limit before giving up
+        self.max_retries = int(os.getenv('PLACES_MAX_RETRIES', 2)) # retries after the first attempt
+        self.retry_backoff = float(os.getenv('PLACES_RETRY_BACKOFF', 0.25)) # base delay in seconds, doubled every retry
+        self.retry_backoff_max = float(os.getenv('PLACES_RETRY_BACKOFF_MAX', 4.0)) # longest delay between retries
 
-        # set search radius and included types based on search type
+    # get the included types and rank preference based on search type
+    def get_search_parameters(self, search_type:SearchType):
         if search_type == SearchType.DEFAULT:
             included_types = ['event_venue','night_club']
             rank_preference = 'DISTANCE'
-        elif search_type == search_type.EXPANDED:
+        elif search_type == SearchType.EXPANDED:
             included_types = ['event_venue','night_club','bar','concert_hall','performing_arts_theater','amphitheatre','opera_house','stadium','arena',
                               'community_center','sports_activity_location']
             rank_preference = 'POPULARITY'
         else:
             included_types = []
             rank_preference = 'DISTANCE'
+        return included_types, rank_preference
+
+    async def get_location(self, coords, search_type:SearchType=SearchType.DEFAULT, search_radius:float=50.0):
+        if self.cache is not None:
+            # nearby searches share a cache entry, the distances are recalculated for the exact coordinates
+            key = self.cache.search_key(coords, search_type, search_radius)
+            cached = await self.cache.get(key)
+            if cached is not None:
+                return self.relocate(cached, coords, search_radius)
+            # searched from the cell centre so the result covers every search with the key, relocate drops what's outside each one
+            places_center, corner = self.cache.cell_center_and_corner(coords)
+            places_radius = min(self.cache.bucket_radius(search_radius) + self.haversine(places_center, corner), self.MAX_SEARCH_RADIUS)
+        else:
+            key = (coords['latitude'], coords['longitude'], search_type.name, search_radius)
+            places_center, places_radius = coords, search_radius
+
+        if self.venues is not None: # only ask Places about areas it hasn't been asked about recently
+            local = await self.search_venues(coords, search_type, search_radius)
+            if local is not None:
+                return local
+
+        try:
+            result = await self.search_places_once(key, places_center, search_type, places_radius)
+        except PlacesError:
+            fallback = await self.search_fallback(coords, search_type, search_radius)
+            if fallback is None:
+                raise
+            return fallback
+        if self.cache is not None:
+            return self.relocate(result, coords, search_radius)
+        return result
+
+    # answer a search from the venue catalog if Places was searched around here recently, None if it wasn't
+    async def search_venues(self, coords, search_type:SearchType, search_radius:float):
+        if not await self.venues.covers(coords, search_type, search_radius, self.haversine):
+            return None
+        included_types, rank_preference = self.get_search_parameters(search_type)
+        places = await self.venues.search(coords, included_types, rank_preference, search_radius)
+        if places is None:
+            return None
+        return {
+            'places': places,
+            'locationRestriction': {'circle': {'center': coords, 'radius': search_radius}},
+            'search_type': search_type.name,
+            'included_types': included_types,
+            'rank_preference': rank_preference,
+        }
+
+    # the venues saved around the coordinates when Places can't be searched, even if the area wasn't fully searched
+    # None if there are none, the result is marked stale
+    async def search_fallback(self, coords, search_type:SearchType, search_radius:float):
+        if self.venues is None:
+            return None
+        included_types, rank_preference = self.get_search_parameters(search_type)
+        places = await self.venues.search(coords, included_types, rank_preference, search_radius)
+        if not places:
+            return None
+        metrics.increment('places.fallbacks')
+        return {
+            'places': places,
+            'locationRestriction': {'circle': {'center': coords, 'radius': search_radius}},
+            'search_type': search_type.name,
+            'included_types': included_types,
+            'rank_preference': rank_preference,
+            'stale': True,
+        }
 
+    # search the Places API, sharing the request with concurrent searches for the same key
+    async def search_places_once(self, key, coords, search_type:SearchType, search_radius:float):
+        async def search():
+            result = await self.search_places(coords, search_type, search_radius)
+            if self.cache is not None:
+                await self.cache.set(key, result)
+            if self.venues is not None:
+                await self.venues.save(coords, search_type, search_radius, result)
+            return result
+
+        if self.single_flight is None:
+            return await search()
+        return await self.single_flight.do(key, search)
+
+    # search the Places API
+    async def search_places(self, coords, search_type:SearchType=SearchType.DEFAULT, search_radius:float=50.0):
+
+        # set search radius and included types based on search type
+        included_types, rank_preference = self.get_search_parameters(search_type)
 
-        url = 'https://places.googleapis.com/v1/places:searchNearby' # Google Places Search Nearby API url
         location_restriction = { # location restriction
             'circle': {
                 'center': coords, # coordinates of the center
@@ -49,15 +241,15 @@ class MapsInfo:
         field_masks = 'places.name,places.displayName,places.formatted_address,places.address_components,places.types,places.location' # fields to include in the response
         headers = { # request headers for the api
             'Content-Type': 'application/json',
-            'X-Goog-Api-Key': os.getenv('GOOGLE_MAPS_API_KEY'), # API key from .env file that's essential for the places API request
+            'X-Goog-Api-Key': os.getenv('GOOGLE_MAPS_API_KEY', ''), # API key from .env file that's essential for the places API request
             'X-Goog-FieldMask': field_masks
         }
-        r = requests.post(url, json=payload, headers=headers) # send the API request
+        r = await self.post_places(payload, headers) # send the API request
         if r.status_code == 200:
             json = r.json()
             places = json.get('places', [])
             #add calculated distance of each place location from coords
-            places = [dict(p, **{'distance': self.haversine(coords, p['location']) if 'location' in p else None}) for p in places]
+            places = self.add_distances(coords, places)
             return {
                 'places': places, # places results
                 'locationRestriction': location_restriction, # location restriction used in request
@@ -65,8 +257,178 @@ class MapsInfo:
                 'included_types': included_types, # included types to search for
                 'rank_preference': rank_preference, # rank preference used
             }
-        else:
-            return r.content
+        raise PlacesError(f'Places API answered {r.status_code}', upstream_status=r.status_code)
+
+    # copy of a search result centered on other coordinates, with the distances recalculated and only the places within the radius
+    def relocate(self, result, coords, search_radius:float):
+        places = [p for p in self.add_distances(coords, result['places']) if p['distance'] is None or p['distance'] <= search_radius]
+        if result['rank_preference'] == 'DISTANCE':
+            places.sort(key=lambda p: (p['distance'] is None, p['distance']))
+        location_restriction = {
+            'circle': {'center': coords, 'radius': search_radius}
+        }
+        return dict(result, places=places, locationRestriction=location_restriction)
+
+    # search places around many points, clustering nearby points so each cluster is one Places search
+    # returns a result for each point in order, with the places within search_radius of it
+    async def get_locations(self, points, search_type:SearchType=SearchType.DEFAULT, search_radius:float=50.0,
+                            cluster_spread:float=None, concurrency:int=None):
+        import numpy as np
+        if cluster_spread is None: # about the search radius, a wider cluster search still only returns MAX_RESULTS places
+            cluster_spread = float(os.getenv('PLACES_BATCH_CLUSTER_SPREAD', 0)) or search_radius
+        semaphore = asyncio.Semaphore(concurrency or int(os.getenv('PLACES_BATCH_CONCURRENCY', 5))) # one batch can't take every slot
+        lats = np.array([p['latitude'] for p in points], dtype=np.float64)
+        lngs = np.array([p['longitude'] for p in points], dtype=np.float64)
+        clusters = self.cluster_points(lats, lngs, cluster_spread)
+
+        async def search(center, radius):
+            async with semaphore:
+                try:
+                    return await self.get_location(center, search_type=search_type, search_radius=radius)
+                except PlacesError as e: # reported for the search's points, the other searches still get places
+                    return e
+
+        # the places of each of the cluster's points
+        async def search_cluster(members):
+            center = {'latitude': float(lats[members].mean()), 'longitude': float(lngs[members].mean())}
+            spread = float(self.haversine_batch(center, lats[members], lngs[members]).max())
+            radius = min(spread + search_radius, self.MAX_SEARCH_RADIUS) # covers every member's search circle
+            result = await search(center, radius)
+            if radius <= search_radius or isinstance(result, PlacesError) or len(result['places']) < MAX_RESULTS:
+                return self.assign_places(lats[members], lngs[members], result, search_radius)
+            # cut off at the limit, places near the points at the edge may be missing, so each point is searched on its own
+            results = await asyncio.gather(*[search({'latitude': float(lats[i]), 'longitude': float(lngs[i])}, search_radius) for i in members])
+            return [self.assign_places(lats[[i]], lngs[[i]], result, search_radius)[0] for i, result in zip(members, results)]
+
+        searches = await asyncio.gather(*[search_cluster(members) for members in clusters])
+        results = [None] * len(points)
+        for cluster, (members, assigned) in enumerate(zip(clusters, searches)):
+            for i, places in zip(members, assigned):
+                results[i] = {'index': int(i), 'latitude': float(lats[i]), 'longitude': float(lngs[i]), 'cluster': cluster, **places}
+        return results
+
+    # group points so every point is within spread meters of its cluster's first point, returns arrays of point indexes
+    def cluster_points(self, lats, lngs, spread:float):
+        import numpy as np
+        unassigned = np.arange(len(lats))
+        clusters = []
+        while len(unassigned):
+            leader = unassigned[0]
+            distances = self.haversine_batch({'latitude': lats[leader], 'longitude': lngs[leader]}, lats[unassigned], lngs[unassigned])
+            members = distances <= spread
+            clusters.append(unassigned[members])
+            unassigned = unassigned[~members]
+        return clusters
+
+    # the places of a cluster's search within search_radius of each of its points, nearest first unless ranked by popularity
+    def assign_places(self, lats, lngs, result, search_radius:float):
+        import numpy as np
+        if isinstance(result, PlacesError): # the search failed
+            return [{'error': str(result)}] * len(lats)
+        located = [p for p in result['places'] if 'location' in p]
+        if not located:
+            return [{'places': []}] * len(lats)
+        distances = self.haversine_matrix(
+            lats, lngs,
+            np.array([p['location']['latitude'] for p in located], dtype=np.float64),
+            np.array([p['location']['longitude'] for p in located], dtype=np.float64),
+        )
+        assigned = []
+        for row in distances:
+            nearby = np.flatnonzero(row <= search_radius)
+            if result['rank_preference'] == 'DISTANCE':
+                nearby = nearby[np.argsort(row[nearby], kind='stable')]
+            assigned.append({'places': [dict(located[j], distance=float(row[j])) for j in nearby]})
+        return assigned
+
+    # distances in meters between every pair of two sets of coordinates, as a len(lats1) x len(lats2) matrix
+    def haversine_matrix(self, lats1, lngs1, lats2, lngs2):
+        import numpy as np
+        lat1 = np.radians(lats1)[:, None]
+        lat2 = np.radians(lats2)[None, :]
+        d_lng = np.radians(lngs2[None, :] - lngs1[:, None])
+        a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lng / 2)**2
+        return self.R * 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    # synchronous version of get_location for scripts
+    def get_location_sync(self, coords, search_type:SearchType=SearchType.DEFAULT, search_radius:float=50.0):
+        async def get_location():
+            try:
+                return await self.get_location(coords, search_type=search_type, search_radius=search_radius)
+            finally: # the client belongs to the event loop asyncio.run makes for this call, so it can't be reused
+                await close_http_client()
+        return asyncio.run(get_location())
+
+    # send a request to the Places API, retrying rate limited and server errors with jittered exponential backoff
+    # every attempt has to get past the circuit breaker and the rate limits, PlacesUnavailable is raised if it can't
+    async def post_places(self, payload, headers):
+        import httpx
+        client = get_http_client()
+        semaphore = get_request_semaphore()
+        attempt = 0
+        while True:
+            await self.guard_places()
+            try:
+                async with semaphore: # only hold a slot while the request is in flight, not while backing off
+                    start = perf_counter()
+                    try:
+                        r = await client.post(PLACES_URL, json=payload, headers=headers)
+                    finally:
+                        self.record_attempt(perf_counter() - start)
+                metrics.increment(f'places.status.{r.status_code}')
+                self.record_status(r.status_code)
+                if r.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return r
+                delay = self.get_retry_delay(attempt, r.headers.get('Retry-After'))
+            except httpx.TransportError as e: # timeouts and connection errors
+                metrics.increment('places.transport_errors')
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise PlacesError(f'Places API unreachable: {e!r}') from e
+                delay = self.get_retry_delay(attempt)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    # wait for the rate limits, raising PlacesUnavailable if the circuit is open or the wait would be too long
+    async def guard_places(self):
+        if self.breaker is not None and not self.breaker.allow():
+            metrics.increment('places.breaker_rejections')
+            raise PlacesUnavailable('Places API circuit is open', retry_after=self.breaker.retry_after())
+        for limiter in (self.limiter, self.shared_limiter):
+            if limiter is not None and not await limiter.acquire(timeout=self.rate_limit_timeout):
+                metrics.increment('places.rate_limited')
+                raise PlacesUnavailable('Places API rate limit reached', retry_after=limiter.wait_time())
+
+    # feed a Places status to the circuit breaker and the adaptive rate limit
+    def record_status(self, status_code):
+        failed = status_code in RETRY_STATUS_CODES
+        if self.breaker is not None:
+            if failed:
+                self.breaker.record_failure()
+            else: # other errors are about the request, not the API's health
+                self.breaker.record_success()
+        if isinstance(self.limiter, AdaptiveTokenBucket):
+            if status_code == HTTPStatus.TOO_MANY_REQUESTS:
+                self.limiter.throttle()
+            elif not failed:
+                self.limiter.recover()
+
+    # time of one Places request, for the latency histogram and the request's Server-Timing
+    def record_attempt(self, duration):
+        duration_ms = duration * 1000
+        metrics.observe('places', duration_ms)
+        record_timing('places', duration_ms)
+
+    # full jitter backoff, but never sooner than the server asked for with Retry-After
+    def get_retry_delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.retry_backoff * 2 ** attempt, self.retry_backoff_max))
+        if retry_after is not None:
+            try:
+                delay = max(delay, min(float(retry_after), self.retry_backoff_max))
+            except ValueError: # Retry-After can also be an http date, just use the backoff then
+                pass
+        return delay
 
     # get the distance between two coordinates using Haversine formula
     def haversine(self, coords1, coords2):
@@ -83,4 +445,55 @@ class MapsInfo:
         distance = self.R * c
 
         #distance = self.R * 2 * math.asin(math.sqrt(math.sin(d_lat / 2) ** 2 + math.sin(d_lng / 2) ** 2 * math.cos(math.radians(lat1)) * math.cos(math.radians(lat2))))
-        return distance
\ No newline at end of file
+        return distance
+
+    # get the distances in meters from coords to arrays of latitudes and longitudes in one vectorized pass
+    def haversine_batch(self, coords, lats, lngs):
+        import numpy as np
+        lat1 = np.radians(coords['latitude'])
+        lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+        d_lat = lat2 - lat1
+        d_lng = np.radians(np.asarray(lngs, dtype=np.float64) - coords['longitude'])
+
+        a = np.sin(d_lat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lng / 2)**2
+        return self.R * 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0))) # clip for rounding errors at antipodes
+
+    # get the indexes and distances of the n nearest coordinates to coords, nearest first
+    def nearest(self, coords, lats, lngs, n:int=10, max_distance:float=None):
+        import numpy as np
+        distances = self.haversine_batch(coords, lats, lngs)
+        if max_distance is not None:
+            candidates = np.flatnonzero(distances <= max_distance)
+        else:
+            candidates = np.arange(len(distances))
+        if n < len(candidates): # only partially sort, the rest don't need ordering
+            candidates = candidates[np.argpartition(distances[candidates], n)[:n]]
+        order = candidates[np.argsort(distances[candidates], kind='stable')]
+        return order, distances[order]
+
+    # get the n nearest items (places or events) to coords, location(item) gives the item's coordinates or None
+    def nearest_items(self, coords, items, n:int=10, max_distance:float=None, location=lambda item: item.get('location')):
+        import numpy as np
+        located = [(item, loc) for item, loc in ((item, location(item)) for item in items) if loc]
+        if not located:
+            return []
+        lats = np.fromiter((loc['latitude'] for item, loc in located), dtype=np.float64, count=len(located))
+        lngs = np.fromiter((loc['longitude'] for item, loc in located), dtype=np.float64, count=len(located))
+        order, distances = self.nearest(coords, lats, lngs, n=n, max_distance=max_distance)
+        return [dict(located[i][0], distance=float(d)) for i, d in zip(order, distances)]
+
+    # copy of the places with the distance from coords added, None for places without a location
+    def add_distances(self, coords, places):
+        if len(places) < self.BATCH_MIN_POINTS: # numpy's overhead costs more than it saves for a page of places
+            return [dict(p, distance=self.haversine(coords, p['location']) if 'location' in p else None) for p in places]
+        located = [i for i, p in enumerate(places) if 'location' in p]
+        distances = [None] * len(places)
+        if located:
+            batch = self.haversine_batch(
+                coords,
+                [places[i]['location']['latitude'] for i in located],
+                [places[i]['location']['longitude'] for i in located],
+            )
+            for i, d in zip(located, batch.tolist()):
+                distances[i] = d
+        return [dict(p, distance=d) for p, d in zip(places, distances)]
@@ -0,0 +1,88 @@
+import asyncio
+import argparse
+from pymongo import UpdateOne
+
+from app.db import get_database, ensure_indexes
+from app import event_documents
+
+# one-off data migrations, run with: python -m app.migrations <name>
+
+
+# set the fields build_set(doc) returns on every document matching query, in _id order and in batches so no single write gets too large
+# the query must stop matching a document once it's set, so reruns skip what was already backfilled
+async def backfill(collection, query, projection, build_set, label, batch_size:int=500):
+    updated = 0
+    last_id = None
+    while True:
+        batch_query = dict(query) if last_id is None else dict(query, _id={'$gt': last_id})
+        batch = [doc async for doc in collection.find(batch_query, projection).sort('_id', 1).limit(batch_size)]
+        if not batch:
+            break
+        await collection.bulk_write([UpdateOne({'_id': doc['_id']}, {'$set': build_set(doc)}) for doc in batch], ordered=False)
+        updated += len(batch)
+        last_id = batch[-1]['_id']
+        print('Backfilled', label, 'for', updated, 'events')
+    return updated
+
+
+# add the GeoJSON geo field to events saved before it existed, events without coordinates get geo: None
+async def backfill_event_geo(db, batch_size:int=500):
+    return await backfill(
+        db.get_collection('live_events'), {'geo': {'$exists': False}}, {'location': 1},
+        lambda event: {'geo': event_documents.geo_point(event.get('location'))},
+        'geo', batch_size,
+    )
+
+# add the lower case name and locality used to filter and sort event lists to events saved before they existed
+async def backfill_event_query_fields(db, batch_size:int=500):
+    return await backfill(
+        db.get_collection('live_events'), {'locality': {'$exists': False}}, {'name': 1, 'location': 1},
+        lambda event: {
+            'name_lower': event_documents.name_lower(event.get('name')),
+            'locality': event_documents.locality(event.get('location')),
+        },
+        'query fields', batch_size,
+    )
+
+# add the location name and name prefixes used by /events/search to events saved before they existed
+async def backfill_event_search_fields(db, batch_size:int=500):
+    return await backfill(
+        db.get_collection('live_events'), {'name_prefixes': {'$exists': False}}, {'name': 1, 'location': 1},
+        lambda event: {
+            'name_prefixes': event_documents.name_prefixes(event.get('name')),
+            'location_name': event_documents.location_name(event.get('location')),
+        },
+        'search fields', batch_size,
+    )
+
+# set updated_at on events saved before it was kept, from created_at or the id's timestamp, so /events/changes returns them
+async def backfill_event_updated_at(db, batch_size:int=500):
+    return await backfill(
+        db.get_collection('live_events'), {'updated_at': None}, {'created_at': 1}, # missing or null
+        lambda event: {'updated_at': event.get('created_at') or event['_id'].generation_time},
+        'updated_at', batch_size,
+    )
+
+
+MIGRATIONS = {
+    'event_geo': backfill_event_geo,
+    'event_query_fields': backfill_event_query_fields,
+    'event_updated_at': backfill_event_updated_at,
+    'event_search_fields': backfill_event_search_fields,
+}
+
+async def main(names, batch_size):
+    db = get_database()
+    await ensure_indexes(db)
+    for name in names:
+        print('Running migration', name)
+        await MIGRATIONS[name](db, batch_size=batch_size)
+    await db.client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run data migrations')
+    parser.add_argument('names', nargs='*', choices=list(MIGRATIONS), default=list(MIGRATIONS))
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.names, args.batch_size))
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field, ConfigDict, model_validator, field_serializer, AfterValidator, PlainSerializer, WithJsonSchema
 from datetime import datetime, timezone, date
-from typing import Optional, Any, Union
+from typing import Optional, Any, Union, Literal
 from typing_extensions import Annotated
 from bson import ObjectId
 
@@ -49,6 +49,12 @@ class LiveEvent(MongoDBModel):
     def serialize_date(self, d: date, _info):
         return d.strftime('%Y-%m-%d') if d else None
 
+class NearbyLiveEvent(LiveEvent): # live event with the distance from the searched coordinates
+    distance: Optional[float] = Field(default=None, description="Distance in meters from the searched coordinates")
+
+class SearchLiveEvent(LiveEvent): # live event found by a text search
+    score: Optional[float] = Field(default=None, description="Text search relevance, higher is better")
+
 class UpdateLiveEvent(BaseModel): # update model for image data because of group id
     name: Optional[str] = Field(default=None, description="Event name")
     description: Optional[str] = Field(default=None, description="Description of the event")
@@ -59,15 +65,18 @@ class UpdateLiveEvent(BaseModel): # update model for image data because of group
 
     data: dict = Field(description="Embedded external data about the event", default=None)
 
-
-
-
-
-
-
-
-
-
-
-
-
+class BulkEventOperation(BaseModel): # one operation of a bulk request
+    op: Literal['create', 'update', 'delete'] = Field(description="Operation to run")
+    id: Optional[str] = Field(default=None, description="Id of the event to update or delete")
+    event: Optional[UpdateLiveEvent] = Field(default=None, description="Event to create, or fields to update")
+
+class BulkEventResult(BaseModel): # result of one operation of a bulk request, in the same order as the request
+    index: int = Field(description="Position of the operation in the request")
+    op: str = Field(description="Operation that was run")
+    id: Optional[str] = Field(default=None, description="Id of the event")
+    status: Literal['created', 'updated', 'deleted', 'error'] = Field(description="Outcome of the operation")
+    error: Optional[str] = Field(default=None, description="Why the operation failed")
+
+class Coordinates(BaseModel): # a point to search for places around
+    latitude: float = Field(ge=-90, le=90, description="Latitude in degrees")
+    longitude: float = Field(ge=-180, le=180, description="Longitude in degrees")
@@ -0,0 +1,151 @@
+import asyncio
+import time
+import logging
+from datetime import datetime, timezone
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+# token bucket rate limit for calls to an external API, tokens refill at rate per second up to capacity
+class TokenBucket:
+    def __init__(self, rate:float, capacity:float=None):
+        self.rate = rate # tokens added per second
+        self.capacity = capacity if capacity is not None else max(rate, 1.0) # most tokens saved up, the largest burst allowed
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.waits = 0 # acquires that had to wait for a token
+        self.rejections = 0 # acquires that gave up
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # take tokens if there are enough now, without waiting
+    def try_acquire(self, tokens:float=1.0):
+        self.refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    # seconds until there will be enough tokens
+    def wait_time(self, tokens:float=1.0):
+        self.refill()
+        return max(tokens - self.tokens, 0.0) / self.rate if self.rate > 0 else float('inf')
+
+    # wait for tokens, giving up and returning False if that would take longer than timeout seconds
+    async def acquire(self, tokens:float=1.0, timeout:float=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        while not self.try_acquire(tokens):
+            delay = self.wait_time(tokens)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                self.rejections += 1
+                return False
+            waited = True
+            await asyncio.sleep(delay)
+        if waited:
+            self.waits += 1
+        return True
+
+    def stats(self):
+        self.refill()
+        return {
+            'tokens': self.tokens,
+            'waits': self.waits,
+            'rejections': self.rejections,
+        }
+
+
+# token bucket whose rate backs off when the API says it's over quota, and creeps back up while calls succeed
+class AdaptiveTokenBucket(TokenBucket):
+    def __init__(self, rate:float, capacity:float=None, min_rate:float=None, decrease:float=0.5, increase:float=0.05):
+        super().__init__(rate, capacity)
+        self.max_rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate * 0.1
+        self.decrease = decrease # share of the rate kept after a throttle
+        self.increase = increase # share of the max rate added back after a success
+        self.throttles = 0
+
+    # slow down, after a 429
+    def throttle(self):
+        self.refill() # tokens so far were earned at the old rate
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.throttles += 1
+
+    # speed back up towards the max rate, after a success
+    def recover(self):
+        if self.rate < self.max_rate:
+            self.refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.increase)
+
+    def stats(self):
+        return dict(super().stats(), rate=self.rate, max_rate=self.max_rate, throttles=self.throttles)
+
+
+# rate limit shared between instances, counting calls per fixed window in a Mongo document
+# one round trip per call, so it's meant for slow external APIs, and it lets calls through if Mongo can't be reached
+class MongoRateLimiter:
+    def __init__(self, name, rate:float, collection_getter, window:float=1.0):
+        self.name = name # calls with the same name share the limit
+        self.rate = rate # calls per second across every instance
+        self.window = window # seconds counted together, longer windows allow bigger bursts
+        self.limit = max(int(rate * window), 1) # calls allowed in a window
+        self.collection_getter = collection_getter # returns the rate_limits collection
+        self.waits = 0
+        self.rejections = 0
+        self.errors = 0
+
+    def current_window(self):
+        return int(time.time() // self.window)
+
+    # count a call in the current window, True if it's within the limit
+    async def try_acquire(self):
+        window = self.current_window()
+        expires_at = datetime.fromtimestamp((window + 1) * self.window, timezone.utc) # removed by a TTL index
+        for attempt in range(2): # two instances starting the window at once race on the upsert
+            try:
+                doc = await self.collection_getter().find_one_and_update(
+                    {'_id': f'{self.name}:{window}'},
+                    {'$inc': {'count': 1}, '$setOnInsert': {'expires_at': expires_at}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+                return doc['count'] <= self.limit
+            except DuplicateKeyError:
+                continue
+            except PyMongoError as e: # better to go over the shared limit than to stop calling the API
+                self.errors += 1
+                logger.warning('Shared rate limit %s failed: %s', self.name, e)
+                return True
+        return True
+
+    # seconds until the next window
+    def wait_time(self):
+        return (self.current_window() + 1) * self.window - time.time()
+
+    # wait for a window with room, giving up and returning False if that would take longer than timeout seconds
+    async def acquire(self, timeout:float=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        while not await self.try_acquire():
+            delay = self.wait_time()
+            if deadline is not None and time.monotonic() + delay > deadline:
+                self.rejections += 1
+                return False
+            waited = True
+            await asyncio.sleep(delay)
+        if waited:
+            self.waits += 1
+        return True
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'waits': self.waits,
+            'rejections': self.rejections,
+            'errors': self.errors,
+        }
@@ -0,0 +1,22 @@
+import orjson
+from bson.objectid import ObjectId
+from bson.decimal128 import Decimal128
+from fastapi.responses import JSONResponse
+
+# fast JSON encoding of responses, datetimes and dates are handled natively by orjson
+
+
+# encode the BSON types orjson doesn't know about
+def default(obj):
+    if isinstance(obj, (ObjectId, Decimal128)):
+        return str(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def dumps(content):
+    return orjson.dumps(content, default=default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+
+
+# JSON response encoded with orjson, for content that's already been validated so FastAPI doesn't do it again
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
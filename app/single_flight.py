@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+
+# an in flight call shared by everyone asking for the same key
+class _Call:
+    def __init__(self, loop, task):
+        self.loop = loop
+        self.task = task
+        self.finished_at = None # set when the call finished successfully and can still be shared
+
+
+# deduplicates concurrent calls for the same key so they share one result
+class SingleFlight:
+    def __init__(self, window:float=0.0, wait_timeout:float=None):
+        self.window = window # seconds a finished result is still shared with callers arriving just after it
+        self.wait_timeout = wait_timeout # longest a caller waits on a shared call before making its own, None to always wait
+        self._calls = {}
+        self.leaders = 0 # calls that were made
+        self.followers = 0 # calls that shared another call's result
+        self.timeouts = 0 # followers that gave up waiting and made their own call
+
+    # run fn() for the key, or wait for the call already running for it
+    async def do(self, key, fn):
+        loop = asyncio.get_running_loop()
+        call = self._calls.get(key)
+        if call is not None and call.loop is loop and self.is_shareable(call):
+            self.followers += 1
+            if call.task.done():
+                return call.task.result()
+            try:
+                # shield so a follower timing out or disconnecting doesn't cancel the call for everyone else
+                return await asyncio.wait_for(asyncio.shield(call.task), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                return await fn() # the shared call is too slow, don't let it hold this caller up
+
+        self.leaders += 1
+        call = _Call(loop, loop.create_task(fn()))
+        self._calls[key] = call
+        call.task.add_done_callback(lambda task: self._finished(key, call))
+        return await asyncio.shield(call.task)
+
+    def is_shareable(self, call):
+        if not call.task.done():
+            return True
+        return call.finished_at is not None and time.monotonic() - call.finished_at < self.window
+
+    def _finished(self, key, call):
+        if call.task.cancelled() or call.task.exception() is not None: # errors are never shared after the fact
+            self._forget(key, call)
+        elif self.window > 0:
+            call.finished_at = time.monotonic()
+            call.loop.call_later(self.window, self._forget, key, call)
+        else:
+            self._forget(key, call)
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call: # a newer call may have taken the key
+            del self._calls[key]
+
+    def stats(self):
+        return {
+            'in_flight': sum(1 for call in self._calls.values() if not call.task.done()),
+            'leaders': self.leaders,
+            'followers': self.followers,
+            'timeouts': self.timeouts,
+        }
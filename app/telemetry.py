@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import random
+import bisect
+import logging
+import threading
+from contextvars import ContextVar
+from pymongo import monitoring
+
+# per request statistics, collected while the request is handled, and process wide latency histograms
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'BandpicsEventApi') # CloudWatch namespace of the embedded metrics
+METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', 0.01)) # share of requests logged as embedded metrics
+METRICS_SLOW_REQUEST_MS = float(os.getenv('METRICS_SLOW_REQUEST_MS', 1000)) # requests at least this slow are always logged
+
+# histogram bucket upper bounds in milliseconds, anything slower falls in the last (infinite) bucket
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+logger = logging.getLogger(__name__)
+
+
+# one line of JSON per log record, so CloudWatch can search it and pick up embedded metrics
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'timestamp': int(record.created * 1000),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {}) # structured fields passed with extra={'fields': ...}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, separators=(',', ':'))
+
+# send the app's logs to stdout as JSON, once, without touching the root logger (the Lambda runtime owns that)
+def configure_logging():
+    app_logger = logging.getLogger('app')
+    if getattr(app_logger, '_json_configured', False):
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    app_logger.addHandler(handler)
+    app_logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    app_logger.propagate = False
+    app_logger._json_configured = True
+
+
+# latency histogram with fixed buckets, cheap enough to update on every request
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    # upper bound of the bucket the quantile falls in, the max for the last bucket
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return float(self.buckets[i]) if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avg_ms': self.total / self.count if self.count else 0.0,
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'p99_ms': self.quantile(0.99),
+            'max_ms': self.max,
+            'buckets': {('le_%g' % bound): count for bound, count in zip(self.buckets, self.counts)} | {'inf': self.counts[-1]},
+        }
+
+
+# process wide histograms and counters by name, e.g. 'route:GET /events' or 'places.status.200'
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock() # pymongo may publish command events from its own threads
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def observe(self, name, value_ms):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value_ms)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'latency': {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+
+metrics = Metrics()
+
+
+class RequestStats:
+    def __init__(self):
+        self.db_round_trips = 0 # commands sent to MongoDB
+        self.timings = {} # name -> total milliseconds, for the Server-Timing header
+
+    def add_timing(self, name, duration_ms):
+        self.timings[name] = self.timings.get(name, 0.0) + duration_ms
+
+    # Server-Timing header value, total is the time the whole request took
+    def server_timing(self, total_ms):
+        parts = ['%s;dur=%.1f' % (name, duration) for name, duration in self.timings.items()]
+        if self.db_round_trips:
+            parts.append('db-calls;desc="%d"' % self.db_round_trips)
+        parts.append('total;dur=%.1f' % total_ms)
+        return ', '.join(parts)
+
+
+# stats for the request being handled, None outside of a request
+request_stats: ContextVar = ContextVar('request_stats', default=None)
+
+# count a MongoDB round trip against the current request
+def record_db_round_trip():
+    stats = request_stats.get()
+    if stats is not None:
+        stats.db_round_trips += 1
+
+# time spent on something (e.g. 'db', 'places') during the current request
+def record_timing(name, duration_ms):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.add_timing(name, duration_ms)
+
+
+# log a request as CloudWatch embedded metrics, sampled so steady state costs almost nothing, errors and slow requests always
+def log_request(method, route, status, duration_ms, stats):
+    if status < 500 and duration_ms < METRICS_SLOW_REQUEST_MS and random.random() >= METRICS_SAMPLE_RATE:
+        return
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    fields = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Route']],
+                'Metrics': [
+                    {'Name': 'Latency', 'Unit': 'Milliseconds'},
+                    {'Name': 'DbTime', 'Unit': 'Milliseconds'},
+                    {'Name': 'DbRoundTrips', 'Unit': 'Count'},
+                    {'Name': 'PlacesTime', 'Unit': 'Milliseconds'},
+                ],
+            }],
+        },
+        'Route': f'{method} {route}',
+        'Status': status,
+        'SampleRate': 1.0 if status >= 500 or duration_ms >= METRICS_SLOW_REQUEST_MS else METRICS_SAMPLE_RATE,
+        'Latency': round(duration_ms, 3),
+        'DbTime': round(stats.timings.get('db', 0.0), 3),
+        'DbRoundTrips': stats.db_round_trips,
+        'PlacesTime': round(stats.timings.get('places', 0.0), 3),
+    }
+    logger.info('request', extra={'fields': fields})
+
+
+# pymongo listener counting and timing the commands sent for each request, commands run in the context of the awaiting request
+class CommandCounter(monitoring.CommandListener):
+    def started(self, event):
+        record_db_round_trip()
+
+    def succeeded(self, event):
+        self.finished(event)
+
+    def failed(self, event):
+        metrics.increment(f'mongo.{event.command_name}.failed')
+        self.finished(event)
+
+    def finished(self, event):
+        duration_ms = event.duration_micros / 1000
+        metrics.observe(f'mongo.{event.command_name}', duration_ms)
+        record_timing('db', duration_ms)
+
+
+command_counter = CommandCounter()
@@ -0,0 +1,153 @@
+import os
+import logging
+from datetime import timedelta
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from app.db import get_database, aggregate
+from app.event_documents import now, geo_point
+from app.location_cache import geohash
+
+logger = logging.getLogger(__name__)
+
+# the fields searches ask Places for, as Places returns them (camelCase) and as the field mask names them, kept as they come
+PLACE_FIELDS = ('displayName', 'formattedAddress', 'addressComponents', 'formatted_address', 'address_components', 'types', 'location')
+MAX_RESULTS = 20 # the most places a Places search returns, local searches return as many
+
+
+# catalog of the venues Places searches have returned, so later searches in the same area can be answered locally
+# venues are keyed by their Places name, and each search records the circle it covered for its search type
+class VenueCatalog:
+    def __init__(self, coverage_ttl:float=7 * 86400.0, precision:int=6, venues_getter=None, coverage_getter=None):
+        self.coverage_ttl = coverage_ttl # seconds a searched area is trusted before Places is asked again
+        self.precision = precision # geohash characters of the cells coverage is looked up by (6 is about 1.2km x 0.6km)
+        self.venues_getter = venues_getter # returns the venues collection
+        self.coverage_getter = coverage_getter # returns the venue_coverage collection
+        self.local_hits = 0 # searches answered from the catalog
+        self.misses = 0 # searches the catalog didn't cover
+        self.saves = 0 # Places results saved
+        self.errors = 0
+
+    # the fresh searched circles for the cell the coordinates are in, [] if there are none or the catalog can't be read
+    async def get_coverage(self, coords, search_type):
+        try:
+            return [doc async for doc in self.coverage_getter().find({
+                'cell': geohash(coords['latitude'], coords['longitude'], self.precision),
+                'search_type': search_type.name,
+                'expires_at': {'$gt': now()},
+            }, {'center': 1, 'radius': 1})]
+        except PyMongoError as e: # the catalog is best effort, fall through to the Places API
+            self.errors += 1
+            logger.warning('Venue coverage read failed: %s', e)
+            return []
+
+    # whether a fresh search covered the whole circle around the coordinates, distance(a, b) gives the meters between two points
+    async def covers(self, coords, search_type, search_radius:float, distance):
+        coverage = await self.get_coverage(coords, search_type)
+        if any(distance(coords, circle['center']) + search_radius <= circle['radius'] for circle in coverage):
+            return True
+        self.misses += 1
+        return False
+
+    # venues within the radius of the coordinates, of the included types, nearest first or most popular first
+    async def search(self, coords, included_types, rank_preference, search_radius:float):
+        query = {'types': {'$in': included_types}} if included_types else {}
+        pipeline = [
+            {'$geoNear': { # uses the 2dsphere index on geo
+                'near': {'type': 'Point', 'coordinates': [coords['longitude'], coords['latitude']]},
+                'key': 'geo',
+                'distanceField': 'distance',
+                'maxDistance': search_radius,
+                'spherical': True,
+                'query': query,
+            }},
+        ]
+        if rank_preference == 'POPULARITY': # venues Places never ranked by popularity go last
+            pipeline += [
+                {'$addFields': {'popularity_missing': {'$eq': [{'$ifNull': ['$popularity', None]}, None]}}},
+                {'$sort': {'popularity_missing': 1, 'popularity': 1, 'distance': 1}},
+            ]
+        pipeline += [
+            {'$limit': MAX_RESULTS},
+            {'$project': {'_id': 0, 'name': '$_id', 'distance': 1, **{field: 1 for field in PLACE_FIELDS}}},
+        ]
+        try:
+            places = await aggregate(self.venues_getter(), pipeline)
+        except PyMongoError as e:
+            self.errors += 1
+            logger.warning('Venue search failed: %s', e)
+            return None
+        self.local_hits += 1
+        return places
+
+    # radius of the circle a Places search fully covered, None if it was cut off at MAX_RESULTS places
+    # a search ranked by distance that was cut off still covered the circle out to its farthest place
+    def covered_radius(self, search_radius:float, result):
+        places = result['places']
+        if len(places) < MAX_RESULTS:
+            return search_radius
+        if result.get('rank_preference') == 'DISTANCE':
+            distances = [place['distance'] for place in places if place.get('distance') is not None]
+            if distances:
+                return min(max(distances), search_radius)
+        return None
+
+    # save the places of a Places search and the circle it covered, if it covered one
+    async def save(self, coords, search_type, search_radius:float, result):
+        saved_at = now()
+        writes = []
+        for rank, place in enumerate(result['places']):
+            if 'name' not in place:
+                continue
+            update = {
+                '$set': dict({field: place[field] for field in PLACE_FIELDS if field in place}, geo=geo_point(place), updated_at=saved_at),
+                '$setOnInsert': {'created_at': saved_at},
+            }
+            if result.get('rank_preference') == 'POPULARITY':
+                update['$min'] = {'popularity': rank} # best rank seen in a popularity search
+            writes.append(UpdateOne({'_id': place['name']}, update, upsert=True))
+        try:
+            if writes:
+                await self.venues_getter().bulk_write(writes, ordered=False)
+            covered_radius = self.covered_radius(search_radius, result)
+            if covered_radius is not None: # venues past the cut off may be missing, so later searches there still ask Places
+                cell = geohash(coords['latitude'], coords['longitude'], self.precision)
+                await self.coverage_getter().update_one(
+                    {'_id': f'{cell}:{search_type.name}:{coords["latitude"]:.5f},{coords["longitude"]:.5f}:{covered_radius:g}'},
+                    {'$set': {
+                        'cell': cell,
+                        'search_type': search_type.name,
+                        'center': coords,
+                        'radius': covered_radius,
+                        'searched_at': saved_at,
+                        'expires_at': saved_at + timedelta(seconds=self.coverage_ttl),
+                    }},
+                    upsert=True,
+                )
+            self.saves += 1
+        except PyMongoError as e:
+            self.errors += 1
+            logger.warning('Saving venues failed: %s', e)
+
+    def stats(self):
+        return {
+            'local_hits': self.local_hits,
+            'misses': self.misses,
+            'saves': self.saves,
+            'errors': self.errors,
+        }
+
+
+# the catalog uses the shared database client
+def get_venues_collection():
+    return get_database().get_collection('venues')
+
+def get_coverage_collection():
+    return get_database().get_collection('venue_coverage')
+
+venue_catalog = VenueCatalog(
+    coverage_ttl=float(os.getenv('VENUE_COVERAGE_TTL', 7 * 86400)),
+    precision=int(os.getenv('VENUE_COVERAGE_PRECISION', 6)),
+    venues_getter=get_venues_collection,
+    coverage_getter=get_coverage_collection,
+) if os.getenv('VENUE_CATALOG', 'true').lower() in ('1', 'true', 'yes') else None
@@ -0,0 +1,43 @@
+# Micro-benchmark of the scalar haversine against the vectorized batch, and of finding the nearest points
+# run with: python -m benchmarks.bench_haversine
+import random
+import timeit
+
+import numpy as np
+
+from app.maps_info import MapsInfo
+
+SIZES = [10, 1_000, 100_000]
+
+
+def random_points(n, seed=1):
+    rng = random.Random(seed)
+    return [{'latitude': rng.uniform(-90, 90), 'longitude': rng.uniform(-180, 180)} for i in range(n)]
+
+
+def time_call(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def main():
+    maps_info = MapsInfo()
+    coords = {'latitude': 49.2827, 'longitude': -123.1207}
+    print(f'{"points":>8} {"scalar":>12} {"batch":>12} {"batch+extract":>14} {"scalar top10":>13} {"nearest top10":>14} {"speedup":>8}')
+    for n in SIZES:
+        points = random_points(n)
+        lats = np.array([p['latitude'] for p in points])
+        lngs = np.array([p['longitude'] for p in points])
+        number = max(1, 10_000 // n)
+
+        scalar = time_call(lambda: [maps_info.haversine(coords, p) for p in points], number)
+        batch = time_call(lambda: maps_info.haversine_batch(coords, lats, lngs), number)
+        batch_extract = time_call(lambda: maps_info.add_distances(coords, [{'location': p} for p in points]), number)
+        scalar_nearest = time_call(lambda: sorted(points, key=lambda p: maps_info.haversine(coords, p))[:10], number)
+        nearest = time_call(lambda: maps_info.nearest(coords, lats, lngs, n=10), number)
+
+        print(f'{n:>8} {scalar * 1e6:>10.1f}us {batch * 1e6:>10.1f}us {batch_extract * 1e6:>12.1f}us '
+              f'{scalar_nearest * 1e6:>11.1f}us {nearest * 1e6:>12.1f}us {scalar / batch:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
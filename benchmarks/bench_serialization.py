@@ -0,0 +1,69 @@
+# Per-event cost of serializing a list of events, the old response_model path against the orjson path
+# run with: python -m benchmarks.bench_serialization
+import json
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from app.models import LiveEvent
+from app.event_query import serialize_event
+from app.responses import dumps
+
+EVENT_COUNT = 10_000
+
+
+def make_events(n):
+    return [{
+        '_id': ObjectId(),
+        'name': 'event %d' % i,
+        'description': 'description of event %d' % i,
+        'event_date': datetime(2025, 1, 1),
+        'created_at': datetime(2025, 1, 1, 12, 30, 15, 123000),
+        'updated_at': datetime(2025, 1, 1, 12, 30, 15, 123000),
+        'location': {'displayName': {'text': 'Some Place'}, 'location': {'latitude': 49.28, 'longitude': -123.12}},
+        'geo': {'type': 'Point', 'coordinates': [-123.12, 49.28]},
+    } for i in range(n)]
+
+
+response_adapter = TypeAdapter(list[LiveEvent])
+
+# what list_events did before: build models, then FastAPI validates against response_model, serializes,
+# runs jsonable_encoder and encodes with json.dumps
+def before(docs):
+    events = [LiveEvent(**doc) for doc in docs]
+    content = [event.model_dump(by_alias=True, exclude_none=True) for event in events]
+    validated = response_adapter.validate_python(content)
+    serialized = response_adapter.dump_python(validated, mode='json', by_alias=False, exclude_none=True)
+    return json.dumps(jsonable_encoder(serialized), ensure_ascii=False, separators=(',', ':')).encode()
+
+# validate once straight from the BSON document and encode with orjson
+def after(docs):
+    return dumps([serialize_event(doc) for doc in docs])
+
+
+def time_per_event(fn, docs, repeat=5):
+    best = min(timing(fn, docs) for i in range(repeat))
+    return best / len(docs)
+
+def timing(fn, docs):
+    start = time.perf_counter()
+    fn(docs)
+    return time.perf_counter() - start
+
+
+def main():
+    docs = make_events(EVENT_COUNT)
+    assert json.loads(before(docs)) == json.loads(after(docs)), "both paths should give the same JSON"
+    before_cost = time_per_event(before, docs)
+    after_cost = time_per_event(after, docs)
+    print(f'{EVENT_COUNT} events')
+    print(f'before (response_model + jsonable_encoder): {before_cost * 1e6:8.2f}us per event')
+    print(f'after (validate once + orjson):             {after_cost * 1e6:8.2f}us per event')
+    print(f'speedup: {before_cost / after_cost:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# Time to first response of the Lambda handler from a fresh interpreter, like a cold start
+# run with: python -m benchmarks.cold_start [--runs 10] [--path /]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# runs in the fresh interpreter, importing the handler and sending it one API Gateway (HTTP API) event
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+from app.main import handler
+imported = time.perf_counter()
+event = {
+    'version': '2.0',
+    'routeKey': '$default',
+    'rawPath': sys.argv[1],
+    'rawQueryString': '',
+    'headers': {'host': 'localhost', 'user-agent': 'cold-start-benchmark'},
+    'requestContext': {
+        'http': {'method': 'GET', 'path': sys.argv[1], 'protocol': 'HTTP/1.1', 'sourceIp': '127.0.0.1', 'userAgent': 'cold-start-benchmark'},
+        'stage': '$default',
+    },
+    'isBase64Encoded': False,
+}
+class Context:
+    aws_request_id = 'benchmark'
+    function_name = 'benchmark'
+    def get_remaining_time_in_millis(self):
+        return 30000
+response = handler(event, Context())
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_response': done - imported, 'total': done - start, 'status': response['statusCode']}))
+'''
+
+
+def run_once(path):
+    result = subprocess.run(
+        [sys.executable, '-c', CHILD, path],
+        capture_output=True, text=True, env=dict(os.environ, PYTHONWARNINGS='ignore'),
+    )
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lambda cold start benchmark')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', default='/')
+    args = parser.parse_args()
+
+    run_once(args.path) # make sure bytecode is compiled, as it is in the image
+    runs = [run_once(args.path) for i in range(args.runs)]
+    print(f'{args.runs} cold starts of GET {args.path} (status {runs[0]["status"]})')
+    for key in ['import', 'first_response', 'total']:
+        values = [run[key] * 1000 for run in runs]
+        print(f'{key:<16} median {statistics.median(values):8.1f}ms  min {min(values):8.1f}ms  max {max(values):8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
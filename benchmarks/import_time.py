@@ -0,0 +1,59 @@
+# Breakdown of the time spent importing the Lambda handler, from python -X importtime
+# run with: python -m benchmarks.import_time [--module app.main] [--top 25]
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+
+# import the module in a fresh interpreter and get (self us, cumulative us, depth, name) for every import
+def measure_imports(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, env=dict(os.environ, PYTHONWARNINGS='ignore'),
+    )
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2 # nested imports are indented two spaces per level
+        imports.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time breakdown')
+    parser.add_argument('--module', default='app.main')
+    parser.add_argument('--top', type=int, default=25)
+    args = parser.parse_args()
+
+    imports = measure_imports(args.module)
+    end = next(i for i, (self_us, cumulative, depth, name) in enumerate(imports) if name == args.module)
+    start = end
+    while start > 0 and imports[start - 1][2] > 0: # nested imports are listed before the module that imported them
+        start -= 1
+    imports = imports[start:end + 1] # only what importing the module caused, not the interpreter's startup
+    total = imports[-1][1]
+    print(f'import {args.module}: {total / 1000:.1f}ms\n')
+
+    # time by top level package, from each module's own time
+    packages = defaultdict(int)
+    for self_us, cumulative, depth, name in imports:
+        packages[name.split('.')[0]] += self_us
+    print(f'{"package":<30} {"ms":>8} {"%":>6}')
+    for package, self_us in sorted(packages.items(), key=lambda p: -p[1])[:args.top]:
+        print(f'{package:<30} {self_us / 1000:>8.1f} {self_us / total * 100:>5.1f}%')
+
+    # the slowest imports made directly by the app's own modules
+    print(f'\n{"imported by the app":<40} {"cumulative ms":>14}')
+    direct = [(cumulative, name) for self_us, cumulative, depth, name in imports if 0 < depth <= 2 and not name.startswith('app')]
+    for cumulative, name in sorted(direct, reverse=True)[:args.top]:
+        print(f'{name:<40} {cumulative / 1000:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
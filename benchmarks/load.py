@@ -0,0 +1,286 @@
+# Throughput and latency of the API endpoints, in process through the ASGI transport or through uvicorn
+# against mongomock or a real MongoDB seeded with live events, with a stub Places server for /locations
+# run with: python -m benchmarks.load [--events 1000] [--mode asgi|uvicorn] [--mongo-uri mongodb://localhost] [--compare old.json]
+import os
+os.environ.setdefault('LOG_LEVEL', 'WARNING') # keep the sampled request logs out of the report
+os.environ.setdefault('EVENT_CACHE_WATCH', 'false')
+os.environ.setdefault('VENUE_CATALOG', 'false') # measure /locations against the stub Places server, mongomock can't run $geoNear anyway
+os.environ.setdefault('PLACES_RATE_LIMIT', '0') # the stub has no quota, a limit would measure the limiter instead of the app
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import uvicorn
+from bson import ObjectId
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from app import maps_info
+from app.db import connect_to_db, ensure_indexes
+from app.main import app
+
+CENTER = (49.2827, -123.1207) # events and searches are spread around here
+SPREAD = 0.2 # degrees around the center
+SEED_BATCH_SIZE = 10_000
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def random_coords(rng):
+    return CENTER[0] + rng.uniform(-SPREAD, SPREAD), CENTER[1] + rng.uniform(-SPREAD, SPREAD)
+
+# a live event document as the API stores it
+def make_event(i, rng):
+    lat, lng = random_coords(rng)
+    created = datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i)
+    return {
+        '_id': ObjectId(),
+        'name': 'event %d' % i,
+        'description': 'description of event %d' % i,
+        'event_date': datetime(2025, 1, 1) + timedelta(days=rng.randrange(365)),
+        'created_at': created,
+        'updated_at': created,
+        'location': {'displayName': {'text': 'venue %d' % (i % 500)}, 'location': {'latitude': lat, 'longitude': lng}},
+        'geo': {'type': 'Point', 'coordinates': [lng, lat]},
+    }
+
+# fill live_events with count events, returning their ids so requests can pick existing events
+async def seed(db, count, reuse=False):
+    collection = db.get_collection('live_events')
+    if reuse and await collection.count_documents({}) == count:
+        return [doc['_id'] async for doc in collection.find({}, {'_id': 1})]
+    await collection.delete_many({})
+    rng = random.Random(42)
+    ids = []
+    for start in range(0, count, SEED_BATCH_SIZE):
+        batch = [make_event(i, rng) for i in range(start, min(start + SEED_BATCH_SIZE, count))]
+        await collection.insert_many(batch, ordered=False)
+        ids += [event['_id'] for event in batch]
+    return ids
+
+
+# stub of the Places Search Nearby API, a few places around the searched point after an optional delay
+def places_stub(latency):
+    async def search_nearby(request: Request):
+        body = await request.json()
+        center = body['locationRestriction']['circle']['center']
+        if latency:
+            await asyncio.sleep(latency)
+        return JSONResponse({'places': [{
+            'name': 'places/stub%d' % i,
+            'displayName': {'text': 'Stub Place %d' % i},
+            'formatted_address': '%d Stub St' % i,
+            'types': ['event_venue'],
+            'location': {'latitude': center['latitude'] + i * 0.0001, 'longitude': center['longitude'] + i * 0.0001},
+        } for i in range(5)]})
+    return Starlette(routes=[Route('/v1/places:searchNearby', search_nearby, methods=['POST'])])
+
+# run an ASGI app with uvicorn on a free local port, in this event loop
+async def start_server(asgi_app):
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host='127.0.0.1', port=0, lifespan='off', log_level='warning', access_log=False,
+                                           timeout_keep_alive=60)) # the load generator shares the loop, don't drop its idle connections
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, f'http://127.0.0.1:{port}'
+
+async def stop_server(server, task):
+    server.should_exit = True
+    await task
+
+
+# the requests to benchmark, (name, needs a real MongoDB, make the request from a random generator and the event ids)
+def endpoints():
+    def nearby(rng, ids):
+        lat, lng = random_coords(rng)
+        return 'GET', f'/events/nearby?lat={lat}&lng={lng}&radius=2000&limit=20', None
+
+    def locations(rng, ids):
+        lat, lng = random_coords(rng)
+        return 'GET', f'/locations?lat={lat}&lng={lng}', None
+
+    def locations_batch(rng, ids): # a gallery of photos taken around a few venues
+        venues = [random_coords(rng) for i in range(3)]
+        points = [{'latitude': lat + rng.uniform(-0.0005, 0.0005), 'longitude': lng + rng.uniform(-0.0005, 0.0005)}
+                  for lat, lng in (rng.choice(venues) for i in range(50))]
+        return 'POST', '/locations:batch', {'points': points}
+
+    return [
+        ('list_page', False, lambda rng, ids: ('GET', '/events?limit=100', None)),
+        ('list_page_by_date', False, lambda rng, ids: ('GET', '/events?limit=100&sort=event_date', None)),
+        ('list_projected', False, lambda rng, ids: ('GET', '/events?limit=100&fields=name,event_date', None)),
+        ('list_ndjson', False, lambda rng, ids: ('GET', '/events?limit=1000&format=ndjson', None)),
+        ('get_event', False, lambda rng, ids: ('GET', f'/events/{rng.choice(ids)}', None)),
+        ('nearby', True, nearby), # $geoNear isn't supported by mongomock
+        ('create_event', False, lambda rng, ids: ('POST', '/events', {'event': {'name': 'bench event', 'event_date': '2025-06-01'}})),
+        ('update_event', False, lambda rng, ids: ('PATCH', f'/events/{rng.choice(ids)}', {'event': {'description': 'updated %d' % rng.randrange(1000)}})),
+        ('locations', False, locations),
+        ('locations_batch', False, locations_batch),
+    ]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+# send requests from concurrency workers until count are done, returning the latency summary
+async def run_endpoint(client, make_request, ids, count, concurrency, warmup):
+    rng = random.Random(7)
+    for i in range(warmup):
+        method, path, body = make_request(rng, ids)
+        await client.request(method, path, json=body)
+
+    latencies = []
+    statuses = {}
+    remaining = count
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            method, path, body = make_request(rng, ids)
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            await response.aread()
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': latencies[-1] if latencies else 0.0,
+        'statuses': statuses,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+# print each endpoint's change against a baseline results file
+def compare(baseline, current):
+    print(f'\ncompared to {baseline["meta"]["commit"]}:')
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        changes = []
+        for key in ['p50_ms', 'p95_ms', 'p99_ms', 'rps']:
+            change = (result[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+            changes.append(f'{key} {change:+6.1f}%')
+        print(f'{name:<18} ' + '  '.join(changes))
+
+
+async def run(args):
+    if args.mongo_uri: # the app connects itself, exactly as it would in production
+        os.environ['MONGO_DB_CONNECTION_STRING'] = args.mongo_uri
+        os.environ['MONGO_DB_NAME'] = args.db
+        db = await connect_to_db()
+        await ensure_indexes(db)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        db = AsyncMongoMockClient()[args.db]
+        async def mock_db():
+            return db
+        app.dependency_overrides[connect_to_db] = mock_db
+
+    print(f'seeding {args.events} events...')
+    ids = await seed(db, args.events, reuse=args.reuse)
+
+    stub_server, stub_task, stub_url = await start_server(places_stub(args.places_latency / 1000))
+    maps_info.PLACES_URL = stub_url + '/v1/places:searchNearby'
+
+    server = None
+    if args.mode == 'uvicorn':
+        server, server_task, base_url = await start_server(app)
+        transport = None
+    else:
+        base_url = 'http://bench'
+        transport = httpx.ASGITransport(app=app)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    results = {}
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, limits=limits, timeout=30) as client:
+            for name, needs_mongo, make_request in endpoints():
+                if args.only and name not in args.only:
+                    continue
+                if needs_mongo and not args.mongo_uri:
+                    print(f'{name:<18} skipped, needs a real MongoDB')
+                    continue
+                result = await run_endpoint(client, make_request, ids, args.requests, args.concurrency, args.warmup)
+                results[name] = result
+                print(f'{name:<18} {result["rps"]:8.1f} rps  p50 {result["p50_ms"]:7.2f}ms  p95 {result["p95_ms"]:7.2f}ms  '
+                      f'p99 {result["p99_ms"]:7.2f}ms  statuses {result["statuses"]}')
+    finally:
+        if server is not None:
+            await stop_server(server, server_task)
+        await stop_server(stub_server, stub_task)
+        app.dependency_overrides.pop(connect_to_db, None)
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'mode': args.mode,
+            'mongo': 'real' if args.mongo_uri else 'mock',
+            'events': args.events,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'places_latency_ms': args.places_latency,
+            'python': platform.python_version(),
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Event API load and latency benchmark')
+    parser.add_argument('--events', type=int, default=1000, help='live events to seed, 1k to 1M')
+    parser.add_argument('--mode', choices=['asgi', 'uvicorn'], default='asgi', help='call the app in process or through uvicorn')
+    parser.add_argument('--mongo-uri', default=os.getenv('MONGO_BENCH_URI'), help='real MongoDB to seed, mongomock if not given')
+    parser.add_argument('--db', default='event_api_bench', help='database to seed, its live_events are replaced')
+    parser.add_argument('--reuse', action='store_true', help='keep the seeded events if the count already matches')
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=20, help='requests per endpoint before measuring')
+    parser.add_argument('--places-latency', type=float, default=0.0, help='milliseconds the stub Places server waits')
+    parser.add_argument('--only', nargs='*', help='endpoints to run, all by default')
+    parser.add_argument('--output', help='results file, benchmarks/results/load-<commit>.json by default')
+    parser.add_argument('--compare', help='results file from an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    output = args.output or os.path.join(RESULTS_DIR, 'load-%s.json' % results['meta']['commit'])
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f'results written to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
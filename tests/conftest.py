@@ -2,10 +2,19 @@ from pytest import fixture
 from unittest.mock import MagicMock, AsyncMock
 #from mongomock import MongoClient
 from mongomock_motor import AsyncMongoMockClient
+from mongomock.collection import BulkOperationBuilder
 from fastapi.testclient import TestClient
 from bson import ObjectId
 from datetime import datetime
 
+# pymongo passes a sort argument to bulk updates and replaces that mongomock doesn't accept yet, so drop it
+def _without_sort(method):
+    def wrapper(self, *args, sort=None, **kwargs):
+        return method(self, *args, **kwargs)
+    return wrapper
+BulkOperationBuilder.add_update = _without_sort(BulkOperationBuilder.add_update)
+BulkOperationBuilder.add_replace = _without_sort(BulkOperationBuilder.add_replace)
+
 class MockMongoClient:
     def __init__(self, db):
         self.db = db
@@ -19,6 +28,40 @@ class MockMongoClient:
     def get_collection(self, name): # Mocking get_collection because the MockMongoClient doesn't have it
         return self.db.get_collection(name)
 
+# Collection wrapper that records the calls made, standing in for the pymongo CommandCounter listener
+class CountingCollection:
+    def __init__(self, collection, calls):
+        self.collection = collection
+        self.calls = calls
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+        def counted(*args, **kwargs):
+            from app.telemetry import record_db_round_trip
+            self.calls.append(name)
+            record_db_round_trip()
+            return attr(*args, **kwargs)
+        return counted
+
+# DB with an event that records the collection calls made, for checking round trips
+@fixture
+def mock_mongodb_counted():
+    calls = []
+    async def mock_get_mongodb():
+        from app.main import app
+        mock_client = AsyncMongoMockClient()
+        await mock_client.db.live_events.insert_one(dict(test_event))
+        app.db = mock_client.db
+
+        client = MockMongoClient(mock_client.db)
+        client.get_collection = lambda name: CountingCollection(mock_client.db.get_collection(name), calls)
+        return client
+
+    mock_get_mongodb.calls = calls
+    return mock_get_mongodb
+
 #empty db for testing
 @fixture
 def mock_mongodb():
@@ -45,6 +88,23 @@ test_event = {
     'updated_at':test_created_at,
 }
 
+# DB with an event, kept between requests for testing a sequence of requests
+@fixture
+def mock_mongodb_live_events_persistent():
+    mock_client = AsyncMongoMockClient()
+    initialized = []
+
+    async def mock_get_mongodb():
+        from app.main import app
+
+        if not initialized:
+            initialized.append(True)
+            await mock_client.db.live_events.insert_one(dict(test_event))
+        app.db = mock_client.db
+        return MockMongoClient(mock_client.db)
+
+    return mock_get_mongodb
+
 # DB with event groups for testing
 @fixture
 def mock_mongodb_live_events_initialized():
@@ -63,8 +123,48 @@ def mock_mongodb_live_events_initialized():
 
     return mock_get_mongodb
 
+# DB with several events for testing pagination, kept between requests
+@fixture
+def mock_mongodb_live_events_many():
+    mock_client = AsyncMongoMockClient()
+    initialized = []
+
+    async def mock_get_mongodb():
+        from app.main import app
+
+        if initialized:
+            app.db = mock_client.db
+            return MockMongoClient(mock_client.db)
+        initialized.append(True)
+
+        await mock_client.db.live_events.insert_many([{
+            '_id': ObjectId('aaaaaaaaaaaaaaaaaaaaaa%02d' % i),
+            'name': 'event %d' % i,
+            'name_lower': 'event %d' % i,
+            'description': 'event description %d' % i,
+            'event_date': datetime(2025, 1, 5 - i) if i < 5 else None, # dates in reverse order of ids, the last two have no date
+            'locality': 'vancouver' if i % 2 else 'victoria',
+            'created_at': test_created_at,
+            'updated_at': test_created_at,
+        } for i in range(1, 7)])
+
+        app.db = mock_client.db #to set the app's db to the mock db
+
+        return MockMongoClient(mock_client.db)
+
+    return mock_get_mongodb
 
 
+# clear the process wide caches so tests don't see each other's events
+@fixture(autouse=True)
+def clear_caches():
+    from app.event_cache import event_cache
+    from app.event_stats import stats_cache
+    event_cache.clear()
+    stats_cache.clear()
+    yield
+    event_cache.clear()
+    stats_cache.clear()
 
 @fixture
 def client():
@@ -0,0 +1,31 @@
+import unittest
+from unittest.mock import patch
+
+from app.circuit_breaker import CircuitBreaker
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.allow(), "failures that aren't consecutive shouldn't open the circuit"
+        breaker.record_failure()
+        assert not breaker.allow(), "consecutive failures should open the circuit"
+        assert breaker.stats()['opens'] == 1 and breaker.stats()['rejections'] == 1
+
+    def test_trial_call(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        with patch('app.circuit_breaker.time.monotonic', return_value=100.0):
+            breaker.record_failure()
+        with patch('app.circuit_breaker.time.monotonic', return_value=130.0):
+            assert breaker.allow(), "a trial call should be allowed after the reset timeout"
+            assert not breaker.allow(), "only one trial call should be allowed"
+            breaker.record_failure()
+            assert breaker.state == 'open' and breaker.retry_after() == 30, "a failed trial should open the circuit again"
+        with patch('app.circuit_breaker.time.monotonic', return_value=160.0):
+            assert breaker.allow()
+            breaker.record_success()
+            assert breaker.state == 'closed' and breaker.allow(), "a successful trial should close the circuit"
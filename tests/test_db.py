@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import patch, MagicMock, AsyncMock
+from pymongo.errors import AutoReconnect
+
+from app import db
+
+
+class TestDb(unittest.IsolatedAsyncioTestCase):
+    def tearDown(self):
+        db._client = None # don't leak the shared client between tests
+
+    def test_client_options_from_env(self):
+        env = {'MONGO_MAX_POOL_SIZE': '25', 'MONGO_SERVER_SELECTION_TIMEOUT_MS': '2000'}
+        with patch.dict('os.environ', env):
+            options = db.get_client_options()
+
+        assert options['maxPoolSize'] == 25, "max pool size should come from the environment"
+        assert options['serverSelectionTimeoutMS'] == 2000, "server selection timeout should come from the environment"
+
+    def test_client_is_shared(self):
+        db._client = None
+        client = db.get_client()
+
+        assert db.get_client() is client, "the same client should be returned on every call"
+        assert db.get_database().client is client, "database handles should share the one client"
+
+    def test_pool_metrics(self):
+        metrics = db.PoolMetrics()
+        metrics.connection_check_out_started(MagicMock())
+        metrics.connection_checked_out(MagicMock(duration=0.25))
+        snapshot = metrics.snapshot()
+
+        assert snapshot['connections_in_use'] == 1, "checked out connection should be counted as in use"
+        assert snapshot['waiting'] == 0, "nothing should be waiting after the checkout"
+        assert snapshot['wait_time_max_ms'] == 250, "wait time should be tracked"
+
+        metrics.connection_checked_in(MagicMock())
+        assert metrics.snapshot()['connections_in_use'] == 0, "checked in connection should no longer be in use"
+
+    async def test_client_per_event_loop(self):
+        db._client = None
+        client = db.get_client()
+        db._client_loop = object() # as if the client was made by an earlier invocation's loop
+
+        assert db.get_client() is not client, "a new event loop should get a new client"
+        assert db.get_client() is db.get_client(), "the client should be reused on the same loop"
+        with patch.object(client, 'close', AsyncMock()) as close:
+            await db.ensure_healthy_client()
+        close.assert_awaited_once()
+        assert db._replaced_clients == [], "the replaced client should be closed"
+
+    async def test_new_client_not_checked(self):
+        db._client = None
+        db._last_used = 0.0 # as on a cold start
+        with patch('pymongo.asynchronous.database.AsyncDatabase.command', AsyncMock(return_value={'ok': 1})) as ping:
+            await db.ensure_healthy_client()
+        ping.assert_not_awaited()
+
+    async def test_client_after_fork(self):
+        db._client = None
+        client = db.get_client()
+        db._client_pid = -1 # as if the client was made by the parent process
+
+        assert db.get_client() is not client, "a forked process should get a new client"
+
+    async def test_healthy_client_reused(self):
+        db._client = None
+        client = db.get_client()
+        db._last_used = 0.0 # idle for a long time, so it's checked
+        with patch('pymongo.asynchronous.database.AsyncDatabase.command', AsyncMock(return_value={'ok': 1})) as ping:
+            assert await db.ensure_healthy_client() is client, "a healthy client should be reused"
+            ping.assert_awaited_once_with('ping')
+            assert await db.ensure_healthy_client() is client
+            assert ping.await_count == 1, "a recently used client shouldn't be checked again"
+
+    async def test_stale_client_replaced(self):
+        db._client = None
+        client = db.get_client()
+        db._last_used = 0.0
+        reconnects = db.client_metrics['reconnects']
+        with patch('pymongo.asynchronous.database.AsyncDatabase.command', AsyncMock(side_effect=AutoReconnect('connection reset'))):
+            new_client = await db.ensure_healthy_client()
+
+        assert new_client is not client, "a stale client should be replaced"
+        assert db.client_metrics['reconnects'] == reconnects + 1, "reconnect should be counted"
@@ -0,0 +1,62 @@
+import unittest
+import asyncio
+from unittest.mock import MagicMock
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+from app.event_cache import EventCache, watch_event_changes
+
+
+# change stream standing in for collection.watch
+class MockChangeStream:
+    def __init__(self, changes):
+        self.changes = changes
+        self.resume_token = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.changes:
+            raise OperationFailure('stream closed', code=40573) # end the watcher
+        self.resume_token = {'_data': 'token'}
+        return self.changes.pop(0)
+
+
+class TestEventCache(unittest.IsolatedAsyncioTestCase):
+    def test_read_racing_write_not_cached(self):
+        cache = EventCache()
+        event = {'_id': ObjectId(), 'name': 'test'}
+
+        generation = cache.generation # read starts
+        cache.invalidate(event['_id']) # a write happens during the read
+        cache.set(event, generation)
+
+        assert cache.get(event['_id']) is None, "event read before a write should not be cached"
+        cache.set(event, cache.generation)
+        assert cache.get(event['_id']) == event, "event should be cached"
+        assert cache.stats()['hits'] == 1, "hit should be counted"
+
+    async def test_watch_event_changes(self):
+        cache = EventCache()
+        updated = {'_id': ObjectId(), 'name': 'updated'}
+        untouched = {'_id': ObjectId(), 'name': 'untouched'}
+        cache.set(updated)
+        cache.set(untouched)
+
+        async def watch(*args, **kwargs):
+            return MockChangeStream([{'operationType': 'update', 'documentKey': {'_id': updated['_id']}}])
+        collection = MagicMock()
+        collection.watch = watch
+
+        await asyncio.wait_for(watch_event_changes(collection, cache, retry_delay=0), 1)
+
+        assert cache.get(updated['_id']) is None, "changed event should be evicted"
+        assert cache.get(untouched['_id']) == untouched, "other events should stay cached"
+        assert cache.stats()['invalidations'] == 1
@@ -0,0 +1,57 @@
+import asyncio
+import unittest
+from datetime import datetime, timezone, timedelta
+from unittest.mock import patch
+
+from bson.objectid import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+from app import event_changes
+
+
+class TestEventChanges(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient().db
+        self.start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=1)
+        await self.db.live_events.insert_many([
+            {'_id': ObjectId('aaaaaaaaaaaaaaaaaaaaaa%02d' % i), 'name': 'event %d' % i, 'updated_at': self.start + timedelta(minutes=i // 2)}
+            for i in range(5)
+        ])
+
+    async def sync(self, since=None, limit=500):
+        with patch('app.event_changes.SETTLE_TIME', 0):
+            return await event_changes.get_changes(self.db, since, limit)
+
+    async def test_paginated_in_change_order(self):
+        await event_changes.record_deletions(self.db, ['aaaaaaaaaaaaaaaaaaaaaa09'])
+        seen = []
+        since = None
+        while True:
+            changes = await self.sync(since, limit=2)
+            seen += [event['name'] for event in changes['events']] + [deleted['id'] for deleted in changes['deleted']]
+            since = changes['next']
+            if not changes['has_more']:
+                break
+        assert seen == ['event 0', 'event 1', 'event 2', 'event 3', 'event 4', 'aaaaaaaaaaaaaaaaaaaaaa09'], "every change should be returned once, in order"
+
+        changes = await self.sync(since)
+        assert changes['events'] == [] and changes['deleted'] == [], "nothing changed since the last sync"
+        await asyncio.sleep(0.01) # a later millisecond than the last sync
+        await self.db.live_events.update_one({'name': 'event 1'}, {'$set': {'updated_at': datetime.now(timezone.utc)}})
+        changes = await self.sync(since)
+        assert [event['name'] for event in changes['events']] == ['event 1'], "only the updated event should be returned"
+
+    async def test_unsettled_changes_wait(self):
+        await self.db.live_events.update_one({'name': 'event 4'}, {'$set': {'updated_at': datetime.now(timezone.utc)}})
+        with patch('app.event_changes.SETTLE_TIME', 60):
+            changes = await event_changes.get_changes(self.db)
+        assert [event['name'] for event in changes['events']] == ['event 0', 'event 1', 'event 2', 'event 3'], "a change that may still be landing should wait"
+
+    async def test_tokens(self):
+        with self.assertRaises(event_changes.TokenExpired):
+            event_changes.decode_token(event_changes.encode_token(datetime.now(timezone.utc) - timedelta(seconds=event_changes.TOMBSTONE_TTL + 60)))
+        with self.assertRaises(ValueError):
+            event_changes.decode_token('not a token')
+        changed_at = datetime(2025, 1, 1, 12, 30, tzinfo=timezone.utc)
+        with patch('app.event_changes.TOMBSTONE_TTL', 10 * 365 * 86400):
+            assert event_changes.decode_token(event_changes.encode_token(changed_at, ObjectId('aaaaaaaaaaaaaaaaaaaaaa01'))) == (changed_at, ObjectId('aaaaaaaaaaaaaaaaaaaaaa01'))
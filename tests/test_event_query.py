@@ -0,0 +1,115 @@
+import os
+import unittest
+from datetime import date, datetime
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+from app import event_query, event_documents
+from app.db import INDEXES
+
+
+class TestEventQuery(unittest.TestCase):
+    def test_build_filter(self):
+        query = event_query.build_filter(date(2025, 1, 1), None, 'The (Band)', ' Vancouver ')
+        assert query == {
+            'event_date': {'$gte': datetime(2025, 1, 1)},
+            'name_lower': {'$regex': r'^the\ \(band\)'},
+            'locality': 'vancouver',
+        }, "filter doesn't match"
+
+    def test_keyset_filter_desc(self):
+        last_id = ObjectId()
+        position = {'id': last_id, 'value': datetime(2025, 1, 1)}
+        assert event_query.keyset_filter(position, 'event_date', 'desc') == {'$or': [
+            {'event_date': {'$lt': datetime(2025, 1, 1)}},
+            {'event_date': datetime(2025, 1, 1), '_id': {'$lt': last_id}},
+            {'event_date': None},
+        ]}, "events without a date should come after every dated event"
+        assert event_query.keyset_filter({'id': last_id, 'value': None}, 'event_date', 'desc') == {
+            'event_date': None, '_id': {'$lt': last_id},
+        }, "only events without a date should be left"
+
+    def test_derived_fields(self):
+        location = {'addressComponents': [
+            {'longText': 'Main St', 'types': ['route']},
+            {'longText': 'Vancouver', 'types': ['locality', 'political']},
+        ]}
+        event = event_documents.derive_fields({'name': 'The Band', 'location': location})
+        assert event['name_lower'] == 'the band', "name should be lower cased"
+        assert event['locality'] == 'vancouver', "locality should come from the address components"
+
+    def test_check_sort(self):
+        for sort, filter_args in [
+            ('name', {'date_from': date(2025, 1, 1)}),
+            ('event_date', {'name': 'event'}),
+            ('_id', {'date_to': date(2025, 1, 1)}),
+            ('event_date', {'date_from': date(2025, 1, 1), 'name': 'event'}),
+        ]:
+            with self.assertRaises(ValueError, msg=f'{filter_args} sorted by {sort} would sort in memory'):
+                event_query.check_sort(sort, **filter_args)
+        assert event_query.default_sort(date_from=date(2025, 1, 1)) == 'event_date', "a date range should be sorted by date"
+        assert event_query.default_sort(name='event') == 'name', "a name prefix should be sorted by name"
+
+    def test_index_hints(self):
+        indexes = {index.document['name']: list(index.document['key']) for index in INDEXES['live_events']}
+        indexes['_id_'] = ['_id']
+        for sort, field in event_query.SORT_FIELDS.items():
+            for locality in [None, 'vancouver']:
+                keys = indexes.get(event_query.index_hint(sort, locality))
+                expected = (['locality'] if locality else []) + ([field, '_id'] if field != '_id' else ['_id'])
+                assert keys == expected, f"sort by {sort} with locality {locality} should have an index, equality first, then the sort"
+
+# supported filter and sort combinations of listings, a range filter is always on the sort field
+LIST_QUERIES = [
+    ({}, sort) for sort in event_query.SORT_FIELDS
+] + [
+    ({'locality': 'vancouver'}, sort) for sort in event_query.SORT_FIELDS
+] + [
+    ({'date_from': date(2025, 3, 1), 'date_to': date(2025, 6, 1)}, 'event_date'),
+    ({'locality': 'vancouver', 'date_from': date(2025, 3, 1)}, 'event_date'),
+    ({'name': 'event 1'}, 'name'),
+    ({'locality': 'vancouver', 'name': 'event 1'}, 'name'),
+]
+
+
+# the list queries against a real MongoDB, as mongomock can't explain; set MONGO_TEST_URI to run them
+@unittest.skipUnless(os.getenv('MONGO_TEST_URI'), 'needs a real MongoDB in MONGO_TEST_URI')
+class TestEventQueryIndexes(unittest.TestCase):
+    def setUp(self):
+        self.client = MongoClient(os.getenv('MONGO_TEST_URI'))
+        self.db = self.client['event_query_index_test']
+        self.client.drop_database(self.db.name)
+        collection = self.db.live_events
+        collection.create_indexes(INDEXES['live_events'])
+        collection.insert_many([event_documents.derive_fields({
+            'name': 'event %d' % i,
+            'event_date': datetime(2025, 1 + i % 12, 1),
+            'location': {'locality': ['Vancouver', 'Victoria', 'Seattle'][i % 3]},
+        }) for i in range(300)])
+
+    def tearDown(self):
+        self.client.drop_database(self.db.name)
+        self.client.close()
+
+    def stages(self, plan):
+        yield plan['stage']
+        for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+            if child:
+                yield from self.stages(child)
+
+    def test_list_queries_use_indexes(self):
+        for filter_args, sort in LIST_QUERIES:
+            event_query.check_sort(sort, filter_args.get('date_from'), filter_args.get('date_to'), filter_args.get('name'))
+            hint = event_query.index_hint(sort, filter_args.get('locality'))
+            for order in ['asc', 'desc']:
+                query = event_query.build_filter(**filter_args)
+                first = self.db.live_events.find(query).sort(event_query.sort_spec(sort, order)).hint(hint).limit(10)
+                last = list(first.clone())[-1]
+                position = event_query.decode_cursor(event_query.encode_cursor(last, sort), sort)
+                next_page = event_query.combine_filters(query, event_query.keyset_filter(position, sort, order))
+                for cursor in [first, self.db.live_events.find(next_page).sort(event_query.sort_spec(sort, order)).hint(hint).limit(10)]:
+                    plan = cursor.explain()['queryPlanner']['winningPlan']
+                    stages = set(self.stages(plan.get('queryPlan', plan)))
+                    assert 'COLLSCAN' not in stages, f"collection scan for {filter_args} sorted by {sort} {order}"
+                    assert 'SORT' not in stages, f"in-memory sort for {filter_args} sorted by {sort} {order}"
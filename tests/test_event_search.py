@@ -0,0 +1,43 @@
+import unittest
+from unittest.mock import patch, AsyncMock
+
+from bson.objectid import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+from app import event_documents, event_search
+
+
+class TestEventSearch(unittest.IsolatedAsyncioTestCase):
+    def test_derived_fields(self):
+        event = event_documents.derive_fields({'name': 'Jazz Fest!', 'location': {'displayName': {'text': 'The Commodore'}}})
+        assert event['name_prefixes'] == ['fe', 'fes', 'fest', 'ja', 'jaz', 'jazz'], "every word's prefixes should be kept"
+        assert event['location_name'] == 'The Commodore', "the Places display name should be indexed"
+        assert len(max(event_documents.name_prefixes('a' * 40), key=len)) == event_documents.MAX_PREFIX
+
+    async def test_prefix_search(self):
+        collection = AsyncMongoMockClient().db.live_events
+        await collection.insert_many([event_documents.derive_fields({'name': name}) for name in
+                                      ['Jazz Fest', 'Jazz Night', 'Folk Fest', 'Late Jazz Festival', 'Rock Night']])
+
+        events, cursor = await event_search.prefix_search(collection, 'jaz fes', limit=1, fields={'id', 'name'})
+        assert [event['name'] for event in events] == ['Jazz Fest'] and cursor, "every word should match, in name order"
+        events, cursor = await event_search.prefix_search(collection, 'jaz fes', limit=1, cursor=cursor, fields={'id', 'name'})
+        assert [event['name'] for event in events] == ['Late Jazz Festival'] and cursor is None, "the next page should follow the cursor"
+        assert 'location' not in events[0], "only the requested fields should be returned"
+        with self.assertRaises(ValueError):
+            await event_search.prefix_search(collection, 'a b', limit=10)
+
+    async def test_text_search_pipeline(self):
+        docs = [{'_id': ObjectId(), 'name': 'event %d' % i, 'score': 3.0 - i} for i in range(3)]
+        with patch('app.event_search.aggregate', new=AsyncMock(return_value=docs)) as aggregate:
+            events, cursor = await event_search.text_search(None, 'jazz', limit=2, fields={'id', 'name'})
+
+        assert events == docs[:2] and event_search.decode_score_cursor(cursor) == (2.0, docs[1]['_id']), "the cursor should be the last score and id"
+        pipeline = aggregate.call_args.args[1]
+        assert pipeline[0] == {'$match': {'$text': {'$search': 'jazz'}}}, "the text index should be searched first"
+        assert {'$sort': {'score': -1, '_id': 1}} in pipeline, "events should be ranked by score"
+        assert pipeline[-1] == {'$project': {'_id': 1, 'name': 1, 'score': 1}}, "only the requested fields should be returned"
+
+        with patch('app.event_search.aggregate', new=AsyncMock(return_value=[])) as aggregate:
+            await event_search.text_search(None, 'jazz', limit=2, cursor=cursor)
+        assert aggregate.call_args.args[1][2] == {'$match': {'$or': [{'score': {'$lt': 2.0}}, {'score': 2.0, '_id': {'$gt': docs[1]['_id']}}]}}
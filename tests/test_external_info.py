@@ -0,0 +1,59 @@
+import time
+import asyncio
+import unittest
+
+from mongomock_motor import AsyncMongoMockClient
+
+from app.external_info import ExternalInfo, LocalFakeSource, load_sources
+
+
+class TestExternalInfo(unittest.IsolatedAsyncioTestCase):
+    async def test_enrich_event(self):
+        db = AsyncMongoMockClient().db
+        event_id = (await db.live_events.insert_one({'name': 'The Band', 'data': {'tickets': 'sold out'}})).inserted_id
+        setlists = LocalFakeSource(result={'songs': 12}, rate=0)
+        setlists.name = 'setlists'
+        info = ExternalInfo([LocalFakeSource(rate=0), setlists])
+
+        data = await info.enrich_event(db.live_events, event_id)
+
+        assert data == {'fake': {'name': 'The Band'}, 'setlists': {'songs': 12}}, "every source's data should be returned"
+        event = await db.live_events.find_one({'_id': event_id})
+        assert event['data'] == {'tickets': 'sold out', 'fake': {'name': 'The Band'}, 'setlists': {'songs': 12}}, "data should be merged"
+        assert 'updated_at' in event, "enriching should change the event's version"
+
+    async def test_sources_run_concurrently(self):
+        info = ExternalInfo([LocalFakeSource(delay=0.1, rate=0), LocalFakeSource(delay=0.1, rate=0)])
+        start = time.monotonic()
+        await info.enrich({'name': 'event'})
+        assert time.monotonic() - start < 0.19, "sources should be fetched at the same time"
+
+    async def test_failing_sources_skipped(self):
+        slow = LocalFakeSource(delay=1, timeout=0.05, rate=0)
+        slow.name = 'slow'
+        broken = LocalFakeSource(result=RuntimeError('down'), rate=0)
+        broken.name = 'broken'
+        info = ExternalInfo([slow, broken, LocalFakeSource(rate=0)])
+        assert await info.enrich({'name': 'event'}) == {'fake': {'name': 'event'}}, "failed sources should be left out"
+
+    async def test_results_cached(self):
+        source = LocalFakeSource(rate=0)
+        info = ExternalInfo([source])
+        await info.enrich({'name': 'event'})
+        await info.enrich({'name': 'event'})
+        assert source.calls == 1, "the same event should be served from the cache"
+        await info.enrich({'name': 'other event'})
+        assert source.calls == 2, "a different event should be fetched"
+
+    async def test_rate_limited(self):
+        source = LocalFakeSource(rate=1, burst=1, timeout=0.05)
+        source.cache_key = lambda event: None # don't cache, so every call reaches the limiter
+        info = ExternalInfo([source])
+        assert await info.enrich({'name': 'event'}) != {}, "first call should be allowed"
+        assert await info.enrich({'name': 'event'}) == {}, "second call should be rate limited"
+        assert source.calls == 1, "rate limited calls shouldn't reach the source"
+
+    def test_load_sources(self):
+        sources = load_sources('fake, app.external_info:LocalFakeSource')
+        assert [type(source) for source in sources] == [LocalFakeSource, LocalFakeSource], "sources should load by name or path"
+        assert load_sources('') == [], "no sources by default"
@@ -0,0 +1,112 @@
+import asyncio
+import unittest
+from datetime import timedelta
+from unittest.mock import patch
+
+from mongomock_motor import AsyncMongoMockClient
+
+from app import jobs
+from app.event_documents import now
+from app.external_info import ExternalInfo, LocalFakeSource
+
+
+class TestJobs(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient().db
+        await self.db.jobs.create_index('key', unique=True, sparse=True) # mongomock ignores partial filters
+        self.calls = []
+        self.failures = 0
+
+        async def record(db, payload):
+            if self.failures > 0:
+                self.failures -= 1
+                raise RuntimeError('temporary failure')
+            self.calls.append(payload)
+
+        patcher = patch.dict(jobs.HANDLERS, {'record': record})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_enqueue_idempotent(self):
+        assert await jobs.enqueue(self.db, jobs.new_job('record', {'n': 1}, key='once')) is not None, "job should be added"
+        assert await jobs.enqueue(self.db, jobs.new_job('record', {'n': 1}, key='once')) is None, "same key should be skipped"
+        await jobs.enqueue_many(self.db, [jobs.new_job('record', {'n': 1}, key='once'), jobs.new_job('record', {'n': 2}, key='twice')])
+        assert await self.db.jobs.count_documents({}) == 2, "only new keys should be added"
+
+    async def test_drain(self):
+        for i in range(3):
+            await jobs.enqueue(self.db, jobs.new_job('record', {'n': i}))
+        await jobs.enqueue(self.db, jobs.new_job('record', {'n': 3}, delay=60))
+
+        assert await jobs.drain(self.db) == {'done': 3, 'failed': 0}, "visible jobs should be run"
+        assert self.calls == [{'n': 0}, {'n': 1}, {'n': 2}], "jobs should run in order"
+        assert await self.db.jobs.count_documents({'status': 'done'}) == 3, "jobs should be marked done"
+        assert await self.db.jobs.count_documents({'status': 'queued'}) == 1, "delayed job should wait"
+
+    async def test_retry_with_backoff(self):
+        self.failures = 1
+        job_id = await jobs.enqueue(self.db, jobs.new_job('record', {'n': 1}, max_attempts=2))
+        with patch('app.jobs.retry_delay', return_value=0):
+            assert await jobs.drain(self.db, max_jobs=1) == {'done': 0, 'failed': 1}
+            job = await self.db.jobs.find_one({'_id': job_id})
+            assert (job['status'], job['error']) == ('queued', 'temporary failure'), "failed job should be queued again"
+            assert await jobs.drain(self.db) == {'done': 1, 'failed': 0}, "retry should succeed"
+
+    async def test_gives_up(self):
+        self.failures = 5
+        job_id = await jobs.enqueue(self.db, jobs.new_job('record', {'n': 1}, max_attempts=2))
+        with patch('app.jobs.retry_delay', return_value=0):
+            await jobs.drain(self.db)
+        job = await self.db.jobs.find_one({'_id': job_id})
+        assert (job['status'], job['attempts']) == ('failed', 2), "job should fail after its attempts"
+
+    async def test_visibility_timeout(self):
+        job_id = await jobs.enqueue(self.db, jobs.new_job('record', {'n': 1}))
+        claimed = await jobs.claim(self.db)
+        assert claimed['_id'] == job_id
+        assert await jobs.claim(self.db) is None, "claimed job should be hidden"
+
+        await self.db.jobs.update_one({'_id': job_id}, {'$set': {'run_at': now() - timedelta(seconds=1)}}) # the lease ran out
+        reclaimed = await jobs.claim(self.db)
+        assert reclaimed['attempts'] == 2, "abandoned job should be claimed again"
+        await jobs.run_job(self.db, claimed) # the first worker finally finishing mustn't touch the new lease
+        assert (await self.db.jobs.find_one({'_id': job_id}))['status'] == 'running', "stale worker shouldn't finish the job"
+        await jobs.run_job(self.db, reclaimed)
+        assert (await self.db.jobs.find_one({'_id': job_id}))['status'] == 'done'
+
+    async def test_abandoned_last_attempt(self):
+        job_id = await jobs.enqueue(self.db, jobs.new_job('record', {'n': 1}, max_attempts=1))
+        assert (await jobs.claim(self.db))['attempts_left'] == 0 # the worker dies here
+
+        await self.db.jobs.update_one({'_id': job_id}, {'$set': {'run_at': now() - timedelta(seconds=1)}}) # the lease ran out
+        assert await jobs.claim(self.db) is None, "a job with no attempts left shouldn't be claimed again"
+        job = await self.db.jobs.find_one({'_id': job_id})
+        assert job['status'] == 'failed', "an abandoned last attempt should fail the job"
+        assert 'finished_at' in job, "failed jobs should be removed by the retention TTL"
+
+    async def test_worker_pool_stops_after_lost_cancel(self):
+        cancels = []
+        async def claim(db):
+            while True:
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancels.append(True)
+                    if len(cancels) > 1:
+                        raise
+                    # the first cancel is lost, like in the driver's server selection
+
+        with patch('app.jobs.claim', side_effect=claim):
+            pool = jobs.JobWorkerPool(self.db, concurrency=1)
+            pool.start()
+            await asyncio.sleep(0)
+            await asyncio.wait_for(pool.stop(cancel_interval=0.05), timeout=5)
+        assert len(cancels) == 2, "a worker that lost a cancel should be cancelled again"
+        assert pool._tasks == []
+
+    async def test_enrich_event_job(self):
+        event_id = (await self.db.live_events.insert_one({'name': 'The Band'})).inserted_id
+        await jobs.enqueue(self.db, jobs.enrich_event_job(event_id))
+        with patch('app.jobs.external_info', ExternalInfo([LocalFakeSource(rate=0)])):
+            assert await jobs.drain(self.db) == {'done': 1, 'failed': 0}
+        assert (await self.db.live_events.find_one({'_id': event_id}))['data'] == {'fake': {'name': 'The Band'}}, "event should be enriched"
@@ -0,0 +1,103 @@
+import unittest
+from unittest.mock import patch
+import time
+import math
+
+from mongomock_motor import AsyncMongoMockClient
+
+from app.cache import TTLCache
+from app.location_cache import LocationCache, geohash
+from app.maps_info import MapsInfo, SearchType
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a') # a is now the most recently used
+        cache.set('c', 3)
+
+        assert cache.get('b') is None, "least recently used entry should be evicted"
+        assert cache.get('a') == 1, "recently used entry should be kept"
+        assert cache.stats()['evictions'] == 1, "eviction should be counted"
+
+    def test_ttl(self):
+        cache = TTLCache(ttl=60)
+        cache.set('a', 1)
+        with patch('time.monotonic', return_value=time.monotonic() + 120):
+            assert cache.get('a') is None, "expired entry should not be returned"
+        assert cache.stats()['expirations'] == 1, "expiration should be counted"
+
+
+class TestLocationCache(unittest.IsolatedAsyncioTestCase):
+    def test_geohash(self):
+        assert geohash(42.6, -5.6, 5) == 'ezs42', "geohash doesn't match"
+        assert geohash(49.2827, -123.1207, 8) == geohash(49.28271, -123.12071, 8), "coordinates a metre apart should share a cell"
+
+    def test_search_key(self):
+        cache = LocationCache(radius_bucket=25)
+        coords = {'latitude': 49.2827, 'longitude': -123.1207}
+
+        assert cache.search_key(coords, SearchType.DEFAULT, 40) == cache.search_key(coords, SearchType.DEFAULT, 50), "radii in the same bucket should share a key"
+        assert cache.search_key(coords, SearchType.DEFAULT, 50) != cache.search_key(coords, SearchType.DEFAULT, 60), "radii in different buckets should not share a key"
+        assert cache.search_key(coords, SearchType.DEFAULT, 50) != cache.search_key(coords, SearchType.EXPANDED, 50), "search types should not share a key"
+
+    async def test_get_location_cached(self):
+        calls = []
+
+        async def mock_search_places(coords, search_type, search_radius):
+            calls.append(coords)
+            return {
+                'places': [{'name': 'places/1', 'location': {'latitude': 49.2828, 'longitude': -123.1208}}],
+                'locationRestriction': {'circle': {'center': coords, 'radius': search_radius}},
+                'search_type': search_type.name,
+                'included_types': [],
+                'rank_preference': 'DISTANCE',
+            }
+
+        maps_info = MapsInfo(cache=LocationCache())
+        maps_info.search_places = mock_search_places
+        first = await maps_info.get_location({'latitude': 49.2827, 'longitude': -123.1207})
+        coords = {'latitude': 49.28271, 'longitude': -123.12071}
+        second = await maps_info.get_location(coords)
+
+        assert len(calls) == 1, "nearby search should be answered from the cache"
+        assert second['locationRestriction']['circle']['center'] == coords, "cached result should be centered on the caller"
+        assert math.isclose(second['places'][0]['distance'], maps_info.haversine(coords, second['places'][0]['location'])), "distance should be recalculated"
+        assert second['places'][0]['distance'] != first['places'][0]['distance'], "distance should be for the exact coordinates"
+        assert maps_info.cache.stats()['hits'] == 1, "cache hit should be counted"
+
+    async def test_get_location_within_radius(self):
+        searches = []
+
+        async def mock_search_places(coords, search_type, search_radius):
+            searches.append((coords, search_radius))
+            return { # places every ~11m going north of the searched centre, up to the searched radius
+                'places': [{'name': 'places/%d' % i, 'location': {'latitude': coords['latitude'] + i * 0.0001, 'longitude': coords['longitude']}}
+                           for i in range(int(search_radius / 11))],
+                'search_type': search_type.name,
+                'included_types': [],
+                'rank_preference': 'DISTANCE',
+            }
+
+        maps_info = MapsInfo(cache=LocationCache(precision=8, radius_bucket=25))
+        maps_info.search_places = mock_search_places
+        points = [{'latitude': 49.2827, 'longitude': -123.1207}, {'latitude': 49.28262, 'longitude': -123.12101}] # opposite corners of the same cell
+        for coords in points:
+            result = await maps_info.get_location(coords, search_radius=30.0)
+            distances = [place['distance'] for place in result['places']]
+            assert distances and max(distances) <= 30.0, "every place should be within the requested radius"
+            center, radius = searches[0]
+            assert maps_info.haversine(center, coords) + 30.0 <= radius, "the cached search should cover the caller's circle"
+        assert len(searches) == 1, "searches in the same cell should share the cached result"
+
+    async def test_shared_tier(self):
+        collection = AsyncMongoMockClient().db.location_cache
+        result = {'places': [], 'rank_preference': 'DISTANCE'}
+
+        await LocationCache(collection_getter=lambda: collection).set('key', result)
+        other_instance = LocationCache(collection_getter=lambda: collection)
+
+        assert await other_instance.get('key') == result, "result should be shared through Mongo"
+        assert other_instance.stats()['mongo_hits'] == 1, "shared tier hit should be counted"
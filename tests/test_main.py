@@ -1,4 +1,4 @@
-from unittest.mock import MagicMock, AsyncMock
+from unittest.mock import MagicMock, AsyncMock, patch, ANY
 from io import BytesIO, BufferedReader
 from PIL import Image
 import pytest
@@ -7,6 +7,7 @@ from datetime import datetime, timezone
 from http import HTTPStatus
 
 from bson.objectid import ObjectId
+import json
 
 from app.main import app, setup_maps_info
 from app.db import connect_to_db
@@ -24,6 +25,143 @@ async def test_list_images(client, mock_mongodb_live_events_initialized):
     assert len(json) > 0, "No events found" # check if any events are present
     assert json[0]['name'] == 'test', "Event name does not match"
 
+# test list_events pagination
+@pytest.mark.asyncio
+async def test_list_events_paginated(client, mock_mongodb_live_events_many):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_many
+    for sort in ['_id', 'event_date']:
+        names = []
+        cursor = None
+        while True:
+            params = {'limit': 4, 'sort': sort}
+            if cursor:
+                params['cursor'] = cursor
+            response = client.get("/events", params=params)
+            assert response.status_code == HTTPStatus.OK
+            json = response.json()
+            assert len(json) <= 4, "Page is larger than the limit"
+            names += [event['name'] for event in json]
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+        assert len(names) == 6, "All events should be returned across the pages"
+        assert len(set(names)) == 6, "Events should not repeat across pages"
+        if sort == 'event_date':
+            assert names[:2] == ['event 5', 'event 6'], "Events without a date should sort first"
+            assert names[2] == 'event 4', "Events should be sorted by date"
+
+# test list_events pagination in descending order, events without a date come last
+@pytest.mark.asyncio
+async def test_list_events_paginated_desc(client, mock_mongodb_live_events_many):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_many
+    for sort in ['_id', 'event_date', 'name']:
+        names = []
+        cursor = None
+        while True:
+            params = {'limit': 2, 'sort': sort, 'order': 'desc'}
+            if cursor:
+                params['cursor'] = cursor
+            response = client.get("/events", params=params)
+            assert response.status_code == HTTPStatus.OK
+            names += [event['name'] for event in response.json()]
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+        assert len(set(names)) == 6, "All events should be returned once across the pages"
+        if sort == 'event_date':
+            assert names == ['event 1', 'event 2', 'event 3', 'event 4', 'event 6', 'event 5'], "Events should be latest first"
+        else:
+            assert names == ['event 6', 'event 5', 'event 4', 'event 3', 'event 2', 'event 1'], "Events should be in descending order"
+
+# test list_events filters
+@pytest.mark.asyncio
+async def test_list_events_filters(client, mock_mongodb_live_events_many):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_many
+    response = client.get("/events", params={'from': '2025-01-02', 'to': '2025-01-03', 'sort': 'event_date'})
+    assert [event['name'] for event in response.json()] == ['event 3', 'event 2'], "Events should be in the date range"
+
+    response = client.get("/events", params={'name': 'EVENT 1'})
+    assert [event['name'] for event in response.json()] == ['event 1'], "Name should match as a case insensitive prefix"
+    response = client.get("/events", params={'name': 'event.'})
+    assert response.json() == [], "Name prefix should be matched literally"
+
+    response = client.get("/events", params={'from': '2025-01-02', 'sort': 'name'})
+    assert response.status_code == HTTPStatus.BAD_REQUEST, "a date range sorted by name would be sorted in memory"
+
+    response = client.get("/events", params={'locality': 'Vancouver', 'limit': 2, 'sort': 'name', 'order': 'desc'})
+    assert [event['name'] for event in response.json()] == ['event 5', 'event 3'], "Events should be in the locality"
+    response = client.get("/events", params={'locality': 'Vancouver', 'limit': 2, 'sort': 'name', 'order': 'desc',
+                                             'cursor': response.headers['X-Next-Cursor']})
+    assert [event['name'] for event in response.json()] == ['event 1'], "Filters should apply to every page"
+
+# test event_stats counts in one aggregation, memoized until an event is written
+@pytest.mark.asyncio
+async def test_event_stats(client, mock_mongodb_live_events_many):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_many
+    from app import event_stats
+    with patch('app.event_stats.aggregate', wraps=event_stats.aggregate) as aggregate:
+        response = client.get("/events/stats")
+        assert response.status_code == HTTPStatus.OK
+        json = response.json()
+        assert json['total'] == 6, "every event should be counted"
+        assert json['per_month'] == {'2025-01': 4}, "dated events should be counted by month"
+        assert json['per_locality'] == {'vancouver': 3, 'victoria': 3}, "events should be counted by locality"
+        assert json['upcoming'] == {'days': 7, 'count': 0}, "past events aren't upcoming"
+
+        assert client.get("/events/stats").json() == json, "stats should be the same"
+        assert aggregate.call_count == 1, "stats should be memoized"
+
+        client.post("/events", json={'event': {'name': 'new event', 'event_date': '2025-02-01'}})
+        json = client.get("/events/stats").json()
+        assert aggregate.call_count == 2, "a write should invalidate the stats"
+        assert json['total'] == 7 and json['per_month']['2025-02'] == 1, "new event should be counted"
+
+# test list_events with an invalid cursor
+@pytest.mark.asyncio
+async def test_list_events_invalid_cursor(client, mock_mongodb_live_events_many):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_many
+    response = client.get("/events", params={'cursor': 'not a cursor', 'limit': 2})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+# test list_events with a projection
+@pytest.mark.asyncio
+async def test_list_events_fields(client, mock_mongodb_live_events_many):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_many
+    response = client.get("/events", params={'fields': 'name'})
+    assert response.status_code == HTTPStatus.OK
+    json = response.json()
+    assert set(json[0].keys()) == {'id', 'name'}, "Only the requested fields should be returned"
+
+    response = client.get("/events", params={'fields': 'name,password'})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+# test list_events streaming as NDJSON
+@pytest.mark.asyncio
+async def test_list_events_ndjson(client, mock_mongodb_live_events_many):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_many
+    response = client.get("/events", params={'format': 'ndjson', 'fields': 'name,event_date'})
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 6, "All events should be streamed"
+    assert lines[0]['name'] == 'event 1', "Event name does not match"
+
+# test list_nearby_events, mongomock doesn't support $geoNear so the aggregation is mocked
+@pytest.mark.asyncio
+async def test_list_nearby_events(client, mock_mongodb_live_events_initialized, get_event_id):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_initialized
+    nearby_event = {'_id': get_event_id, 'name': 'test', 'event_date': datetime(2025, 1, 1), 'distance': 12.5}
+    with patch('app.main.aggregate', AsyncMock(return_value=[nearby_event])) as mock_aggregate:
+        response = client.get("/events/nearby", params={'lat': 49.28, 'lng': -123.12, 'radius': 1000, 'from': '2025-01-01', 'to': '2025-01-31'})
+
+    assert response.status_code == HTTPStatus.OK
+    json = response.json()
+    assert json[0]['distance'] == 12.5, "Distance should be returned"
+    geo_near = mock_aggregate.call_args[0][1][0]['$geoNear']
+    assert geo_near['near']['coordinates'] == [-123.12, 49.28], "Coordinates should be longitude first"
+    assert geo_near['maxDistance'] == 1000
+    assert geo_near['query']['event_date'] == {'$gte': datetime(2025, 1, 1), '$lte': datetime(2025, 1, 31)}, "Dates should be filtered"
+
 # test get_event
 @pytest.mark.asyncio
 async def test_get_event(client, mock_mongodb_live_events_initialized, get_event_id):
@@ -45,6 +183,79 @@ async def test_get_event_404(client, mock_mongodb_live_events_initialized):
     json = response.json()
     assert response.status_code == HTTPStatus.NOT_FOUND
 
+# test get_event with If-None-Match
+@pytest.mark.asyncio
+async def test_get_event_not_modified(client, mock_mongodb_live_events_initialized, get_event_id):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_initialized
+    response = client.get("/events/" + str(get_event_id))
+    etag = response.headers['ETag']
+    assert 'max-age' in response.headers['Cache-Control'], "Cache-Control should be set"
+
+    response = client.get("/events/" + str(get_event_id), headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    assert response.content == b'', "Body should be empty"
+
+    response = client.get("/events/" + str(get_event_id), headers={'If-None-Match': '"something-else"'})
+    assert response.status_code == HTTPStatus.OK
+
+# test list_events with If-None-Match
+@pytest.mark.asyncio
+async def test_list_events_not_modified(client, mock_mongodb_live_events_many):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_many
+    for params in [{}, {'limit': 2, 'sort': 'event_date'}]:
+        response = client.get("/events", params=params)
+        etag = response.headers['ETag']
+
+        response = client.get("/events", params=params, headers={'If-None-Match': etag})
+        assert response.status_code == HTTPStatus.NOT_MODIFIED, "Unchanged list should not be modified"
+
+        response = client.get("/events", params=dict(params, fields='name'), headers={'If-None-Match': etag})
+        assert response.status_code == HTTPStatus.OK, "Different query should have a different ETag"
+
+    response = client.get("/events", params={'limit': 2, 'sort': 'event_date'})
+    etag = response.headers['ETag']
+    client.patch("/events/aaaaaaaaaaaaaaaaaaaaaa05", json={'event': {'name': 'changed'}}) # event 5 is on the first page
+    response = client.get("/events", params={'limit': 2, 'sort': 'event_date'}, headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.OK, "Changed list should be returned"
+    assert response.json()[0]['name'] == 'changed'
+
+# test update_event and delete_event with If-Match
+@pytest.mark.asyncio
+async def test_conditional_writes(client, mock_mongodb_live_events_persistent, get_event_id):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_persistent
+    etag = client.get("/events/" + str(get_event_id)).headers['ETag']
+
+    response = client.patch("/events/" + str(get_event_id), json={'event': {'name': 'first'}}, headers={'If-Match': etag})
+    assert response.status_code == HTTPStatus.OK
+    new_etag = response.headers['ETag']
+    assert new_etag != etag, "ETag should change after an update"
+
+    response = client.patch("/events/" + str(get_event_id), json={'event': {'name': 'second'}}, headers={'If-Match': etag})
+    assert response.status_code == HTTPStatus.PRECONDITION_FAILED, "Update with an old ETag should fail"
+    response = client.delete("/events/" + str(get_event_id), headers={'If-Match': etag})
+    assert response.status_code == HTTPStatus.PRECONDITION_FAILED, "Delete with an old ETag should fail"
+
+    response = client.delete("/events/" + str(get_event_id), headers={'If-Match': new_etag})
+    assert response.status_code == HTTPStatus.OK
+    response = client.delete("/events/" + str(get_event_id), headers={'If-Match': new_etag})
+    assert response.status_code == HTTPStatus.NOT_FOUND, "Deleted event should not be found"
+
+# test get_event is served from the cache until the event changes
+@pytest.mark.asyncio
+async def test_get_event_cached(client, mock_mongodb_live_events_persistent, get_event_id):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_persistent
+    response = client.get("/events/" + str(get_event_id))
+    assert response.status_code == HTTPStatus.OK
+
+    await app.db.get_collection('live_events').update_one({'_id': get_event_id}, {'$set': {'name': 'changed elsewhere'}})
+    response = client.get("/events/" + str(get_event_id))
+    assert response.json()['name'] == 'test', "Event should be served from the cache"
+
+    client.patch("/events/" + str(get_event_id), json={'event': {'description': 'updated here'}})
+    response = client.get("/events/" + str(get_event_id))
+    assert response.json()['name'] == 'changed elsewhere', "Update should invalidate the cached event"
+    assert response.json()['description'] == 'updated here'
+
 # test create_event
 @pytest.mark.asyncio
 async def test_create_event(client, mock_mongodb):
@@ -64,6 +275,92 @@ async def test_create_event(client, mock_mongodb):
     assert json['name'] == event_name, "Event name does not match"
     assert json['event_date'] == event_date, "Event date does not match"
 
+# test create_event makes a single round trip
+@pytest.mark.asyncio
+async def test_create_event_round_trips(client, mock_mongodb_counted):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_counted
+    response = client.post("/events", json={'event': {'name': 'new event', 'event_date': '2025-01-01'}})
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['name'] == 'new event', "Event name does not match"
+    assert response.json()['id'], "Event id should be returned"
+    assert mock_mongodb_counted.calls == ['insert_one'], "Event should not be read back after inserting"
+    assert response.headers['X-DB-Round-Trips'] == '1', "Round trips should be counted"
+
+# test create_event queues the event's enrichment when there are sources, alongside the insert
+@pytest.mark.asyncio
+async def test_create_event_enriched(client, mock_mongodb_counted):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_counted
+    from app.external_info import external_info, LocalFakeSource
+    with patch.object(external_info, 'sources', [LocalFakeSource()]), \
+         patch('app.main.jobs.enqueue', AsyncMock(side_effect=lambda db, job: inserted.append(list(mock_mongodb_counted.calls)))) as enqueue:
+        inserted = []
+        response = client.post("/events", json={'event': {'name': 'new event'}})
+    assert response.status_code == HTTPStatus.OK
+    assert inserted == [['insert_one']], "the job should be queued after the event is inserted"
+    job = enqueue.call_args.args[1]
+    assert job['type'] == 'enrich_event' and job['payload'] == {'event_id': response.json()['id']}, "created event should be enriched"
+    assert mock_mongodb_counted.calls == ['insert_one'], "the event should only be inserted"
+
+# test update_event makes a single round trip
+@pytest.mark.asyncio
+async def test_update_event_round_trips(client, mock_mongodb_counted, get_event_id):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_counted
+    response = client.patch("/events/" + str(get_event_id), json={'event': {'name': 'updated event'}})
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['name'] == 'updated event', "Event name does not match"
+    assert mock_mongodb_counted.calls == ['find_one_and_update'], "Event should be updated and returned in one call"
+    assert response.headers['X-DB-Round-Trips'] == '1', "Round trips should be counted"
+
+# test create_event with a location adds the geo point
+@pytest.mark.asyncio
+async def test_create_event_geo(client, mock_mongodb):
+    app.dependency_overrides[connect_to_db] = mock_mongodb
+    event = {
+        'event':{
+            'name': 'event with location',
+            'location': {'displayName': {'text': 'Some Place'}, 'location': {'latitude': 49.28, 'longitude': -123.12}},
+        }
+    }
+    response = client.post("/events", json=event)
+    assert response.status_code == HTTPStatus.OK
+
+    stored = await app.db.get_collection('live_events').find_one({'_id': ObjectId(response.json()['id'])})
+    assert stored['geo'] == {'type': 'Point', 'coordinates': [-123.12, 49.28]}, "geo point should be stored"
+
+# test create_event with an invalid date
+@pytest.mark.asyncio
+async def test_create_event_invalid_date(client, mock_mongodb):
+    app.dependency_overrides[connect_to_db] = mock_mongodb
+    response = client.post("/events", json={'event': {'name': 'new event', 'event_date': '01/01/2025'}})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+# test bulk_events
+@pytest.mark.asyncio
+async def test_bulk_events(client, mock_mongodb_live_events_many):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_many
+    operations = [
+        {'op': 'create', 'event': {'name': 'bulk event', 'event_date': '2025-02-01'}},
+        {'op': 'update', 'id': 'aaaaaaaaaaaaaaaaaaaaaa01', 'event': {'name': 'updated event'}},
+        {'op': 'delete', 'id': 'aaaaaaaaaaaaaaaaaaaaaa02'},
+        {'op': 'create', 'event': {'name': 'bad date', 'event_date': 'tomorrow'}},
+        {'op': 'delete', 'id': 'bbbbbbbbbbbbbbbbbbbbbbbb'},
+        {'op': 'update', 'id': 'not an id', 'event': {'name': 'updated event'}},
+    ]
+    with patch('app.bulk_events.BULK_CHUNK_SIZE', 4): # make sure results stay in order across chunks
+        response = client.post("/events:bulk", json={'operations': operations})
+    assert response.status_code == HTTPStatus.OK
+    json = response.json()
+
+    assert [result['index'] for result in json] == list(range(len(operations))), "Results should be in request order"
+    assert [result['status'] for result in json] == ['created', 'updated', 'deleted', 'error', 'error', 'error']
+    event_collection = app.db.get_collection('live_events')
+    created = await event_collection.find_one({'_id': ObjectId(json[0]['id'])})
+    assert created['name'] == 'bulk event', "Event should be created"
+    assert created['event_date'] == datetime(2025, 2, 1), "Event date should be parsed"
+    updated = await event_collection.find_one({'_id': ObjectId('aaaaaaaaaaaaaaaaaaaaaa01')})
+    assert updated['name'] == 'updated event', "Event should be updated"
+    assert await event_collection.find_one({'_id': ObjectId('aaaaaaaaaaaaaaaaaaaaaa02')}) is None, "Event should be deleted"
+
 # test update_event
 @pytest.mark.asyncio
 async def test_update_event(client, mock_mongodb_live_events_initialized, get_event_id):
@@ -97,6 +394,42 @@ async def test_delete_event(client, mock_mongodb_live_events_initialized, get_ev
     event = await event_collection.find_one({'_id': get_event_id})
     assert event is None, "Event not deleted"
 
+# test search_events autocompletes created events
+@pytest.mark.asyncio
+async def test_search_events(client, mock_mongodb):
+    app.dependency_overrides[connect_to_db] = mock_mongodb
+    response = client.post("/events", json={'event': {'name': 'Jazz Fest', 'description': 'all weekend', 'event_date': '2025-06-01'}})
+    assert response.status_code == HTTPStatus.OK
+
+    db = app.db
+    app.dependency_overrides[connect_to_db] = lambda: db
+    response = client.get("/events/search", params={'q': 'jazz fe', 'mode': 'prefix'})
+    assert response.status_code == HTTPStatus.OK
+    assert response.json() == [{'id': ANY, 'name': 'Jazz Fest', 'event_date': '2025-06-01'}], "matches should be projected for a typeahead"
+    assert client.get("/events/search", params={'q': 'blues', 'mode': 'prefix'}).json() == []
+    assert client.get("/events/search", params={'q': 'j', 'mode': 'prefix'}).status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+# test get_event_changes returns deletions as tombstones
+@pytest.mark.asyncio
+async def test_get_event_changes(client, mock_mongodb_live_events_initialized, get_event_id):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_live_events_initialized
+    with patch('app.event_changes.SETTLE_TIME', 0):
+        response = client.get("/events/changes")
+        assert response.status_code == HTTPStatus.OK
+        json = response.json()
+        assert [event['id'] for event in json['events']] == [str(get_event_id)], "a sync from scratch should return every event"
+        assert json['has_more'] is False
+
+        db = app.db
+        app.dependency_overrides[connect_to_db] = lambda: db # keep the same database for the next requests
+        assert client.delete("/events/" + str(get_event_id)).status_code == HTTPStatus.OK
+        response = client.get("/events/changes", params={'since': json['next']})
+    assert response.status_code == HTTPStatus.OK
+    json = response.json()
+    assert json['events'] == [] and [deleted['id'] for deleted in json['deleted']] == [str(get_event_id)], "the deletion should be synced"
+
+    assert client.get("/events/changes", params={'since': 'nope'}).status_code == HTTPStatus.BAD_REQUEST
+
 # test get_places
 @pytest.mark.asyncio
 async def test_get_places(client, mock_maps_info):
@@ -105,4 +438,83 @@ async def test_get_places(client, mock_maps_info):
     response = client.get(f"/locations/?lat=12.3&lng=45.6")
     assert response.status_code == HTTPStatus.OK
 
+    response = client.get("/locations", params={'lat': 12.3, 'lng': 45.6, 'radius': 60000})
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY, "the radius should be within what Places accepts"
+
+# test get_places maps Places failures to gateway errors instead of passing them on
+@pytest.mark.asyncio
+async def test_get_places_unavailable(client):
+    from app.maps_info import MapsInfo, PlacesError, PlacesUnavailable
+    maps = MapsInfo()
+    app.dependency_overrides[setup_maps_info] = lambda: maps
+
+    maps.get_location = AsyncMock(side_effect=PlacesUnavailable('Places API circuit is open', retry_after=12.5))
+    response = client.get("/locations?lat=12.3&lng=45.6")
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers['Retry-After'] == '13', "clients should be told when to retry"
+
+    maps.get_location = AsyncMock(side_effect=PlacesError('Places API answered 500', upstream_status=500))
+    response = client.get("/locations?lat=12.3&lng=45.6")
+    assert response.status_code == HTTPStatus.BAD_GATEWAY
+    assert response.json() == {'detail': 'Places API answered 500'}, "the Places response shouldn't be passed on"
+
+
+# test get_places_batch returns a result for each point
+@pytest.mark.asyncio
+async def test_get_places_batch(client):
+    from app.maps_info import MapsInfo
+    maps = MapsInfo()
+    maps.get_location = AsyncMock(return_value={'places': [{'name': 'venue', 'location': {'latitude': 12.3, 'longitude': 45.6}}], 'rank_preference': 'DISTANCE'})
+    app.dependency_overrides[setup_maps_info] = lambda: maps
+
+    points = [{'latitude': 12.3, 'longitude': 45.6}, {'latitude': 12.3001, 'longitude': 45.6}]
+    response = client.post("/locations:batch", json={'points': points, 'radius': 100})
+    assert response.status_code == HTTPStatus.OK
+    json = response.json()
+    assert [result['index'] for result in json] == [0, 1], "there should be a result for each point"
+    assert maps.get_location.call_count == 1, "nearby points should share a search"
+    assert json[1]['places'][0]['name'] == 'venue', "places should be assigned to each point"
+
+    response = client.post("/locations:batch", json={'points': [{'latitude': 100, 'longitude': 0}]})
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+# test get_metrics
+@pytest.mark.asyncio
+async def test_get_metrics(client):
+    response = client.get("/metrics")
+    assert response.status_code == HTTPStatus.OK
+    json = response.json()
+    assert 'db_pool' in json, "db pool metrics not found"
+    assert 'wait_time_max_ms' in json['db_pool'], "pool wait time not found"
+    assert 'latency' in json, "latency histograms not found"
+
+# test requests are timed by route template and get a Server-Timing header
+@pytest.mark.asyncio
+async def test_request_timing(client, mock_mongodb_counted, get_event_id):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_counted
+    response = client.get("/events/" + str(get_event_id))
+    assert response.status_code == HTTPStatus.OK
+    assert 'total;dur=' in response.headers['Server-Timing'], "Server-Timing should have the total time"
+    latency = client.get("/metrics").json()['latency']
+    assert latency['route:GET /events/{event_id}']['count'] >= 1, "latency should be recorded by route template"
+
+# test jobs_handler reuses the event loop, so warm invocations keep their database client
+def test_jobs_handler_reuses_loop():
+    import asyncio
+    from app.main import jobs_handler
+    loops = []
+
+    async def drain_jobs(time_budget=None):
+        loops.append(asyncio.get_running_loop())
+        return {'done': 0, 'failed': 0}
 
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with patch('app.main.drain_jobs', drain_jobs):
+            jobs_handler({}, None)
+            jobs_handler({}, None)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    assert loops == [loop, loop], "every invocation should run on the same loop"
@@ -1,10 +1,14 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
-from app.maps_info import MapsInfo, SearchType
+from app.maps_info import MapsInfo, SearchType, PlacesError, PlacesUnavailable
+from app.circuit_breaker import CircuitBreaker
+from app.venues import MAX_RESULTS
+from app.telemetry import metrics
 import math
+import httpx
 
-class TestMapsInfo(unittest.TestCase):
+class TestMapsInfo(unittest.IsolatedAsyncioTestCase):
     def test_haversine_same_coords(self):
         coords1 = {'latitude':12.34, 'longitude':56.78}
         coords2 = {'latitude':12.34, 'longitude':56.78}
@@ -28,20 +32,11 @@ class TestMapsInfo(unittest.TestCase):
         assert distance == half_circumference, "Distance should be half the circumference of the Earth if coords are opposite"
 
 
-    def mocked_post_request(*args, **kwargs):
-        # Mocking requests.post to simulate the behaviour in get_location
-        class mock_post():
-            def __init__(self, json_data, status_code, content=None):
-                self.json_data = json_data # Mock json data
-                self.status_code = status_code # Mock status code
-                self.content = content # Mock content
-
-            def json(self):
-                return self.json_data
-
-        if 'places.googleapis.com' in args[0]:
+    def mocked_places_api(self, request):
+        # Mocking the Places API to simulate the behaviour in get_location
+        if 'places.googleapis.com' in str(request.url):
             # places.name,places.displayName,places.formatted_address,places.types,places.location
-            return mock_post(status_code=200, json_data={
+            return httpx.Response(200, json={
                 'places':[{
                     'name':'apsdoifjas34asdfasdf',
                     'displayName':'Test Place',
@@ -54,19 +49,20 @@ class TestMapsInfo(unittest.TestCase):
                 }]
             })
         else:
-            return mock_post(status=400, json_data={}, content='Bad Request')
+            return httpx.Response(400, content=b'Bad Request')
 
-    @patch('requests.post', side_effect=mocked_post_request)
-    def test_get_location(self, mock_post):
-        coords = {'latitude':12.34, 'longitude':56.78}
+    def mock_http_client(self, handler):
+        # patch the shared client with one using a mock transport
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        return patch('app.maps_info.get_http_client', return_value=client)
 
-        # Mock the API key
-        with patch('os.getenv') as mock_getenv:
-            mock_getenv.return_value = 'abc123'
+    async def test_get_location(self):
+        coords = {'latitude':12.34, 'longitude':56.78}
 
         maps_info = MapsInfo()
         search_radius = 50.0
-        location_results = maps_info.get_location(coords=coords, search_type=SearchType.DEFAULT, search_radius=search_radius)
+        with self.mock_http_client(self.mocked_places_api):
+            location_results = await maps_info.get_location(coords=coords, search_type=SearchType.DEFAULT, search_radius=search_radius)
 
         # location_restriction that should be used in the request
         location_restriction = {
@@ -80,3 +76,192 @@ class TestMapsInfo(unittest.TestCase):
         assert 'places' in location_results, "places not found in results"
         assert len(location_results['places']) > 0, "places should return at least one result"
 
+    async def test_get_location_retries(self):
+        coords = {'latitude':12.34, 'longitude':56.78}
+        responses = [httpx.Response(503), httpx.Response(429, headers={'Retry-After': '0'})]
+
+        def flaky_places_api(request): # fails twice before succeeding
+            return responses.pop(0) if responses else self.mocked_places_api(request)
+
+        maps_info = MapsInfo()
+        maps_info.retry_backoff = 0 # don't wait between retries in tests
+        with self.mock_http_client(flaky_places_api):
+            location_results = await maps_info.get_location(coords=coords)
+
+        assert len(responses) == 0, "failed requests should be retried"
+        counters = metrics.snapshot()['counters']
+        assert counters.get('places.status.503', 0) >= 1, "Places statuses should be counted"
+        assert len(location_results['places']) > 0, "places should return at least one result after retrying"
+
+    async def test_get_location_gives_up(self):
+        coords = {'latitude':12.34, 'longitude':56.78}
+        calls = []
+
+        def down_places_api(request):
+            calls.append(request)
+            return httpx.Response(500, content=b'Server Error')
+
+        maps_info = MapsInfo()
+        maps_info.retry_backoff = 0
+        with self.mock_http_client(down_places_api):
+            with self.assertRaises(PlacesError) as raised:
+                await maps_info.get_location(coords=coords)
+
+        assert len(calls) == maps_info.max_retries + 1, "should stop after the max retries"
+        assert raised.exception.upstream_status == 500, "the Places status should be kept"
+        assert raised.exception.status_code == 502, "a failed search should be a bad gateway"
+
+    async def test_breaker_opens(self):
+        coords = {'latitude':12.34, 'longitude':56.78}
+        calls = []
+
+        def overloaded_places_api(request):
+            calls.append(request)
+            return httpx.Response(429)
+
+        maps_info = MapsInfo(breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+        maps_info.retry_backoff = 0
+        with self.mock_http_client(overloaded_places_api):
+            with self.assertRaises(PlacesUnavailable) as raised:
+                await maps_info.get_location(coords=coords)
+            with self.assertRaises(PlacesUnavailable):
+                await maps_info.get_location(coords=coords)
+
+        assert len(calls) == 2, "retries should stop once the circuit opens"
+        assert raised.exception.status_code == 503, "an open circuit should be unavailable"
+        assert raised.exception.headers()['Retry-After'] == '60', "clients should be told when to retry"
+        assert maps_info.breaker.stats()['rejections'] == 2
+
+    async def test_breaker_falls_back_to_venues(self):
+        coords = {'latitude':12.34, 'longitude':56.78}
+        venues = MagicMock()
+        venues.covers = AsyncMock(return_value=False)
+        venues.search = AsyncMock(return_value=[{'name': 'places/a', 'distance': 10.0}])
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record_failure()
+        maps_info = MapsInfo(venues=venues, breaker=breaker)
+
+        location_results = await maps_info.get_location(coords=coords)
+
+        assert location_results['stale'] is True, "fallback results should be marked stale"
+        assert location_results['places'] == [{'name': 'places/a', 'distance': 10.0}], "saved venues should be returned"
+        venues.search.return_value = []
+        with self.assertRaises(PlacesUnavailable):
+            await maps_info.get_location(coords=coords)
+
+    def test_get_location_sync(self):
+        coords = {'latitude':12.34, 'longitude':56.78}
+
+        maps_info = MapsInfo()
+        with self.mock_http_client(self.mocked_places_api), patch('app.maps_info.close_http_client', new=AsyncMock()) as close_http_client:
+            location_results = maps_info.get_location_sync(coords)
+
+        assert len(location_results['places']) > 0, "places should return at least one result"
+        close_http_client.assert_awaited_once() # a client left open on the call's closed event loop would leak
+
+    def test_haversine_batch_matches_scalar(self):
+        coords = {'latitude':49.2827, 'longitude':-123.1207}
+        points = [{'latitude':12.34, 'longitude':56.78}, {'latitude':-33.86, 'longitude':151.21}, {'latitude':49.2827, 'longitude':-123.1207}]
+
+        maps_info = MapsInfo()
+        distances = maps_info.haversine_batch(coords, [p['latitude'] for p in points], [p['longitude'] for p in points])
+
+        for point, distance in zip(points, distances):
+            assert math.isclose(distance, maps_info.haversine(coords, point), abs_tol=1e-6), "batch distance should match the scalar distance"
+
+    def test_nearest_items(self):
+        coords = {'latitude':49.2827, 'longitude':-123.1207}
+        items = [
+            {'name':'far', 'location':{'latitude':49.30, 'longitude':-123.10}},
+            {'name':'no location'},
+            {'name':'nearest', 'location':{'latitude':49.2828, 'longitude':-123.1208}},
+            {'name':'near', 'location':{'latitude':49.2840, 'longitude':-123.1210}},
+        ]
+
+        maps_info = MapsInfo()
+        nearest = maps_info.nearest_items(coords, items, n=2)
+
+        assert [item['name'] for item in nearest] == ['nearest', 'near'], "items should be the n nearest, nearest first"
+        assert nearest[0]['distance'] < nearest[1]['distance'], "distances should be included"
+
+        nearby = maps_info.nearest_items(coords, items, n=10, max_distance=500)
+        assert len(nearby) == 2, "items further than max_distance should be excluded"
+
+    def test_add_distances(self):
+        coords = {'latitude':49.2827, 'longitude':-123.1207}
+        places = [{'location':{'latitude':49.2827 + i / 1000, 'longitude':-123.1207}} for i in range(100)] + [{'name':'no location'}]
+
+        maps_info = MapsInfo()
+        for count in [5, len(places)]: # scalar path for a few places and batch path for many
+            with_distances = maps_info.add_distances(coords, places[-count:])
+            assert with_distances[-1]['distance'] is None, "place without a location should have no distance"
+            for place in with_distances[:-1]:
+                assert math.isclose(place['distance'], maps_info.haversine(coords, place['location']), abs_tol=1e-6), "distance doesn't match"
+
+    def places_around(self, coords, n=3):
+        return {
+            'places': [{'name': 'place %d' % i, 'location': {'latitude': coords['latitude'] + i * 0.0003, 'longitude': coords['longitude']}} for i in range(n)],
+            'rank_preference': 'DISTANCE',
+        }
+
+    async def test_get_locations_clustered(self):
+        maps_info = MapsInfo()
+        searches = []
+        async def get_location(coords, search_type=SearchType.DEFAULT, search_radius=50.0):
+            searches.append((coords, search_radius))
+            return self.places_around(coords)
+
+        points = [
+            {'latitude': 49.2800, 'longitude': -123.1200},
+            {'latitude': 45.0000, 'longitude': -75.0000}, # far from the others
+            {'latitude': 49.2801, 'longitude': -123.1200},
+            {'latitude': 49.2800, 'longitude': -123.1201},
+        ]
+        with patch.object(maps_info, 'get_location', side_effect=get_location):
+            results = await maps_info.get_locations(points, search_radius=50.0, cluster_spread=100.0)
+
+        assert len(searches) == 2, "nearby points should share a search"
+        assert [r['index'] for r in results] == [0, 1, 2, 3], "results should be in the order of the points"
+        assert results[0]['cluster'] == results[2]['cluster'] == results[3]['cluster'] != results[1]['cluster'], "points should be clustered"
+        assert max(radius for coords, radius in searches) > 50.0, "cluster search should cover every point's radius"
+        for result in results:
+            distances = [place['distance'] for place in result['places']]
+            assert distances == sorted(distances), "places should be nearest first"
+            assert all(d <= 50.0 for d in distances), "places should be within the radius of the point"
+            assert result['places'], "point should get places"
+
+    async def test_get_locations_cut_off(self):
+        maps_info = MapsInfo()
+        searches = []
+        async def get_location(coords, search_type=SearchType.DEFAULT, search_radius=50.0):
+            searches.append((coords, search_radius))
+            return self.places_around(coords, n=MAX_RESULTS if search_radius > 50.0 else 3)
+
+        points = [{'latitude': 49.2800, 'longitude': -123.1200}, {'latitude': 49.2803, 'longitude': -123.1200}]
+        with patch.object(maps_info, 'get_location', side_effect=get_location):
+            results = await maps_info.get_locations(points, search_radius=50.0)
+
+        assert len(searches) == 3, "a cluster search cut off at the limit should be searched again for each point"
+        assert [radius for coords, radius in searches[1:]] == [50.0, 50.0]
+        for point, result in zip(points, results):
+            assert result['places'][0]['location'] == point, "points should get the places of their own search"
+
+    async def test_get_locations_failed_search(self):
+        maps_info = MapsInfo()
+        with patch.object(maps_info, 'get_location', AsyncMock(side_effect=PlacesError('Places API answered 500'))):
+            results = await maps_info.get_locations([{'latitude': 49.28, 'longitude': -123.12}])
+        assert results[0]['error'] == 'Places API answered 500', "failed searches should be reported per point"
+
+    def test_haversine_matrix(self):
+        import numpy as np
+        maps_info = MapsInfo()
+        a = [{'latitude': 49.28, 'longitude': -123.12}, {'latitude': 45.0, 'longitude': -75.0}]
+        b = [{'latitude': 49.29, 'longitude': -123.10}, {'latitude': 51.5, 'longitude': 0.0}, {'latitude': -33.9, 'longitude': 151.2}]
+        matrix = maps_info.haversine_matrix(
+            np.array([p['latitude'] for p in a]), np.array([p['longitude'] for p in a]),
+            np.array([p['latitude'] for p in b]), np.array([p['longitude'] for p in b]),
+        )
+        assert matrix.shape == (2, 3)
+        for i, p in enumerate(a):
+            for j, q in enumerate(b):
+                assert math.isclose(matrix[i, j], maps_info.haversine(p, q), rel_tol=1e-9), "matrix should match haversine"
@@ -0,0 +1,66 @@
+import unittest
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+from app.migrations import backfill_event_geo, backfill_event_query_fields, backfill_event_updated_at, backfill_event_search_fields
+
+
+class TestMigrations(unittest.IsolatedAsyncioTestCase):
+    async def test_backfill_event_geo(self):
+        db = AsyncMongoMockClient().db
+        await db.live_events.insert_many(
+            [{'name': 'event %d' % i, 'location': {'latitude': 49.0 + i / 100, 'longitude': -123.0}} for i in range(5)] +
+            [{'name': 'no location'}]
+        )
+
+        updated = await backfill_event_geo(db, batch_size=2)
+
+        assert updated == 6, "every event should be backfilled"
+        event = await db.live_events.find_one({'name': 'event 1'})
+        assert event['geo'] == {'type': 'Point', 'coordinates': [-123.0, 49.01]}, "geo point doesn't match"
+        event = await db.live_events.find_one({'name': 'no location'})
+        assert event['geo'] is None, "event without a location should get an empty geo"
+        assert await backfill_event_geo(db) == 0, "rerunning should skip backfilled events"
+
+    async def test_backfill_event_query_fields(self):
+        db = AsyncMongoMockClient().db
+        await db.live_events.insert_many([
+            {'name': 'The Band', 'location': {'address_components': [{'long_name': 'Vancouver', 'types': ['locality']}]}},
+            {'name': 'No Location'},
+        ])
+
+        assert await backfill_event_query_fields(db, batch_size=1) == 2, "every event should be backfilled"
+        event = await db.live_events.find_one({'name': 'The Band'})
+        assert (event['name_lower'], event['locality']) == ('the band', 'vancouver'), "derived fields don't match"
+        event = await db.live_events.find_one({'name': 'No Location'})
+        assert event['locality'] is None, "event without a location should get an empty locality"
+        assert await backfill_event_query_fields(db) == 0, "rerunning should skip backfilled events"
+
+    async def test_backfill_event_updated_at(self):
+        db = AsyncMongoMockClient().db
+        await db.live_events.insert_many([
+            {'name': 'created', 'created_at': datetime(2025, 1, 1)},
+            {'_id': ObjectId.from_datetime(datetime(2024, 6, 1)), 'name': 'old'},
+            {'name': 'current', 'updated_at': datetime(2025, 2, 1)},
+        ])
+
+        assert await backfill_event_updated_at(db, batch_size=1) == 2, "only events without updated_at should be backfilled"
+        event = await db.live_events.find_one({'name': 'created'})
+        assert event['updated_at'] == datetime(2025, 1, 1), "updated_at should default to created_at"
+        event = await db.live_events.find_one({'name': 'old'})
+        assert event['updated_at'] == datetime(2024, 6, 1), "updated_at should fall back to the id's timestamp"
+        assert await backfill_event_updated_at(db) == 0, "rerunning should skip backfilled events"
+
+    async def test_backfill_event_search_fields(self):
+        db = AsyncMongoMockClient().db
+        await db.live_events.insert_many([
+            {'name': 'The Band', 'location': {'displayName': {'text': 'The Venue'}}},
+            {'description': 'no name'},
+        ])
+
+        assert await backfill_event_search_fields(db, batch_size=1) == 2, "every event should be backfilled"
+        event = await db.live_events.find_one({'name': 'The Band'})
+        assert (event['name_prefixes'], event['location_name']) == (['ba', 'ban', 'band', 'th', 'the'], 'The Venue')
+        assert await backfill_event_search_fields(db) == 0, "rerunning should skip backfilled events"
@@ -0,0 +1,54 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from mongomock_motor import AsyncMongoMockClient
+
+from app.rate_limit import TokenBucket, AdaptiveTokenBucket, MongoRateLimiter
+
+
+class TestTokenBucket(unittest.IsolatedAsyncioTestCase):
+    def test_burst(self):
+        bucket = TokenBucket(rate=1, capacity=3)
+        assert [bucket.try_acquire() for i in range(4)] == [True, True, True, False], "only the capacity should be allowed at once"
+
+    async def test_acquire_waits(self):
+        bucket = TokenBucket(rate=20, capacity=1)
+        bucket.try_acquire()
+        start = time.monotonic()
+        assert await bucket.acquire(), "acquire should wait for a token"
+        assert time.monotonic() - start >= 0.04, "acquire should wait for the refill"
+        assert bucket.stats()['waits'] == 1, "wait should be counted"
+
+    async def test_acquire_timeout(self):
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.try_acquire()
+        assert not await bucket.acquire(timeout=0.01), "acquire should give up rather than wait past the timeout"
+        assert bucket.stats()['rejections'] == 1, "rejection should be counted"
+
+
+class TestAdaptiveTokenBucket(unittest.TestCase):
+    def test_throttle_and_recover(self):
+        bucket = AdaptiveTokenBucket(rate=10, min_rate=2, increase=0.1)
+        bucket.throttle()
+        assert bucket.rate == 5, "a throttle should halve the rate"
+        bucket.throttle()
+        bucket.throttle()
+        assert bucket.rate == 2, "the rate shouldn't go below the min rate"
+        for i in range(20):
+            bucket.recover()
+        assert bucket.rate == 10, "successes should bring the rate back to the max rate"
+        assert bucket.stats()['throttles'] == 3
+
+
+class TestMongoRateLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_shared_limit(self):
+        db = AsyncMongoMockClient().db
+        limiters = [MongoRateLimiter('places', 2, lambda: db.rate_limits) for i in range(2)] # two instances
+        with patch('app.rate_limit.time.time', return_value=600.0):
+            allowed = [await limiter.try_acquire() for limiter in limiters + limiters]
+            assert not await limiters[0].acquire(timeout=0.01), "acquire should give up rather than wait past the timeout"
+        assert allowed == [True, True, False, False], "instances should share the limit"
+        assert (await db.rate_limits.find_one({'_id': 'places:600'}))['count'] == 5
+        with patch('app.rate_limit.time.time', return_value=601.0):
+            assert await limiters[1].try_acquire(), "the next window should have room again"
@@ -0,0 +1,90 @@
+import unittest
+import asyncio
+
+from app.single_flight import SingleFlight
+from app.location_cache import LocationCache
+from app.maps_info import MapsInfo
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_share_result(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        results = await asyncio.gather(*[single_flight.do('key', fn) for i in range(10)])
+
+        assert len(calls) == 1, "concurrent calls for the same key should share one call"
+        assert results == ['result'] * 10, "every caller should get the result"
+        assert single_flight.stats()['followers'] == 9, "shared calls should be counted"
+
+    async def test_finished_calls_not_shared(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            return len(calls)
+
+        assert await single_flight.do('key', fn) == 1
+        assert await single_flight.do('key', fn) == 2, "a finished call should not be shared without a window"
+
+    async def test_errors_shared_but_not_kept(self):
+        single_flight = SingleFlight(window=60)
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError('failed')
+
+        results = await asyncio.gather(*[single_flight.do('key', fn) for i in range(3)], return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results), "concurrent callers should all get the error"
+        assert len(calls) == 1
+
+        with self.assertRaises(ValueError):
+            await single_flight.do('key', fn)
+        assert len(calls) == 2, "a failed call should not be shared after it finished"
+
+    async def test_slow_call_timeout(self):
+        single_flight = SingleFlight(wait_timeout=0.01)
+
+        async def slow():
+            await asyncio.sleep(1)
+            return 'slow'
+
+        async def fast():
+            return 'fast'
+
+        leader = asyncio.create_task(single_flight.do('key', slow))
+        await asyncio.sleep(0)
+        assert await single_flight.do('key', fast) == 'fast', "follower should make its own call if the shared one is too slow"
+        assert single_flight.stats()['timeouts'] == 1
+        leader.cancel()
+
+    async def test_get_location_coalesced(self):
+        calls = []
+
+        async def mock_search_places(coords, search_type, search_radius):
+            calls.append(coords)
+            await asyncio.sleep(0.01)
+            return {
+                'places': [{'name': 'places/1', 'location': {'latitude': 49.2828, 'longitude': -123.1208}}],
+                'locationRestriction': {'circle': {'center': coords, 'radius': search_radius}},
+                'search_type': search_type.name,
+                'included_types': [],
+                'rank_preference': 'DISTANCE',
+            }
+
+        maps_info = MapsInfo(cache=LocationCache(), single_flight=SingleFlight())
+        maps_info.search_places = mock_search_places
+        points = [{'latitude': 49.2827, 'longitude': -123.1207}, {'latitude': 49.28271, 'longitude': -123.12071}]
+        results = await asyncio.gather(*[maps_info.get_location(points[i % 2]) for i in range(6)])
+
+        assert len(calls) == 1, "concurrent searches for the same cell should share one request"
+        for i, result in enumerate(results):
+            assert result['locationRestriction']['circle']['center'] == points[i % 2], "shared result should be centered on each caller"
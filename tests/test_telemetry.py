@@ -0,0 +1,60 @@
+import json
+import logging
+import unittest
+from unittest.mock import patch, MagicMock
+
+from app import telemetry
+from app.telemetry import Histogram, Metrics, RequestStats, JsonFormatter
+
+
+class TestTelemetry(unittest.TestCase):
+    def test_histogram_quantiles(self):
+        histogram = Histogram()
+        for value in [1] * 90 + [40] * 9 + [20000]:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        assert snapshot['count'] == 100, "every value should be counted"
+        assert snapshot['p50_ms'] == 1, "median should be in the fastest bucket"
+        assert snapshot['p95_ms'] == 50, "p95 should be the upper bound of its bucket"
+        assert snapshot['p99_ms'] == 50, "p99 should be the upper bound of its bucket"
+        assert snapshot['max_ms'] == 20000, "max should be kept"
+        assert snapshot['buckets']['inf'] == 1, "values past the last bucket should be counted"
+
+    def test_server_timing(self):
+        stats = RequestStats()
+        stats.add_timing('db', 1.5)
+        stats.add_timing('db', 2.0)
+        stats.db_round_trips = 2
+        assert stats.server_timing(10) == 'db;dur=3.5, db-calls;desc="2", total;dur=10.0', "timings should be summed by name"
+
+    def test_command_listener_times_commands(self):
+        metrics = Metrics()
+        stats = RequestStats()
+        token = telemetry.request_stats.set(stats)
+        try:
+            with patch.object(telemetry, 'metrics', metrics):
+                event = MagicMock(command_name='find', duration_micros=2500)
+                telemetry.command_counter.started(event)
+                telemetry.command_counter.succeeded(event)
+        finally:
+            telemetry.request_stats.reset(token)
+        assert stats.db_round_trips == 1, "command should be counted"
+        assert stats.timings['db'] == 2.5, "command time should be added to the request"
+        assert metrics.snapshot()['latency']['mongo.find']['count'] == 1, "command time should be in its histogram"
+
+    def test_log_request_sampled(self):
+        with patch.object(telemetry.logger, 'info') as info:
+            with patch.object(telemetry, 'METRICS_SAMPLE_RATE', 0.0):
+                telemetry.log_request('GET', '/events', 200, 5, RequestStats())
+                assert not info.called, "fast successful requests should be sampled out"
+                telemetry.log_request('GET', '/events', 500, 5, RequestStats())
+        fields = info.call_args.kwargs['extra']['fields']
+        assert fields['Route'] == 'GET /events', "route should be a dimension"
+        assert fields['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Route']], "metrics should be in embedded metric format"
+
+    def test_json_formatter(self):
+        record = logging.LogRecord('app.test', logging.INFO, __file__, 1, 'hello %s', ('world',), None)
+        record.fields = {'Latency': 1.5}
+        entry = json.loads(JsonFormatter().format(record))
+        assert entry['message'] == 'hello world', "message should be formatted"
+        assert entry['Latency'] == 1.5, "fields should be at the top level for embedded metrics"
@@ -0,0 +1,102 @@
+import unittest
+from unittest.mock import patch, AsyncMock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from app.maps_info import MapsInfo, SearchType
+from app.venues import VenueCatalog, MAX_RESULTS
+
+
+ADDRESS_COMPONENTS = [{'longText': 'Vancouver', 'shortText': 'Vancouver', 'types': ['locality', 'political']}]
+
+
+def places_result(rank_preference='POPULARITY'):
+    return {
+        'places': [
+            {'name': 'places/a', 'displayName': {'text': 'A'}, 'formattedAddress': '1 Main St, Vancouver', 'addressComponents': ADDRESS_COMPONENTS,
+             'types': ['bar'], 'location': {'latitude': 49.2801, 'longitude': -123.1201}},
+            {'name': 'places/b', 'displayName': {'text': 'B'}, 'types': ['night_club'], 'location': {'latitude': 49.2802, 'longitude': -123.1202}},
+        ],
+        'search_type': 'DEFAULT',
+        'included_types': ['bar', 'night_club'],
+        'rank_preference': rank_preference,
+    }
+
+
+class TestVenueCatalog(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = AsyncMongoMockClient().db
+        self.catalog = VenueCatalog(venues_getter=lambda: self.db.venues, coverage_getter=lambda: self.db.venue_coverage)
+        self.coords = {'latitude': 49.28, 'longitude': -123.12}
+
+    async def test_save(self):
+        await self.catalog.save(self.coords, SearchType.DEFAULT, 500.0, places_result())
+        await self.catalog.save(self.coords, SearchType.DEFAULT, 500.0, dict(places_result(), places=places_result()['places'][::-1]))
+
+        venues = {venue['_id']: venue async for venue in self.db.venues.find()}
+        assert set(venues) == {'places/a', 'places/b'}, "venues should be upserted by their Places name"
+        assert venues['places/a']['popularity'] == 0 and venues['places/b']['popularity'] == 0, "the best rank seen should be kept"
+        assert venues['places/a']['geo'] == {'type': 'Point', 'coordinates': [-123.1201, 49.2801]}, "venues should get a GeoJSON point"
+        assert venues['places/a']['formattedAddress'] == '1 Main St, Vancouver', "the address should be saved as Places returns it"
+        assert venues['places/a']['addressComponents'] == ADDRESS_COMPONENTS
+        assert await self.db.venue_coverage.count_documents({}) == 1, "searching the same circle again should refresh its coverage"
+
+    async def test_save_cut_off(self):
+        places = [
+            {'name': f'places/{i}', 'types': ['bar'], 'location': {'latitude': 49.28 + i * 0.0001, 'longitude': -123.12}, 'distance': i * 11.1}
+            for i in range(MAX_RESULTS)
+        ]
+        distance = MapsInfo().haversine
+        await self.catalog.save(self.coords, SearchType.DEFAULT, 5000.0, dict(places_result('POPULARITY'), places=places))
+
+        assert await self.db.venues.count_documents({}) == MAX_RESULTS, "the venues of a cut off search should still be saved"
+        assert await self.db.venue_coverage.count_documents({}) == 0, "a popularity search cut off at the limit shouldn't cover its circle"
+        assert not await self.catalog.covers({'latitude': 49.29, 'longitude': -123.12}, SearchType.DEFAULT, 50.0, distance)
+
+        await self.catalog.save(self.coords, SearchType.DEFAULT, 5000.0, dict(places_result('DISTANCE'), places=places))
+        coverage = await self.db.venue_coverage.find_one()
+        assert coverage['radius'] == places[-1]['distance'], "a distance search cut off at the limit should cover out to its farthest place"
+        assert await self.catalog.covers(self.coords, SearchType.DEFAULT, 100.0, distance)
+        assert not await self.catalog.covers(self.coords, SearchType.DEFAULT, 500.0, distance), "past the farthest place Places should be asked"
+
+    async def test_covers(self):
+        await self.catalog.save(self.coords, SearchType.DEFAULT, 500.0, places_result())
+        distance = MapsInfo().haversine
+
+        assert await self.catalog.covers({'latitude': 49.2805, 'longitude': -123.12}, SearchType.DEFAULT, 100.0, distance), "a circle inside a searched one should be covered"
+        assert not await self.catalog.covers(self.coords, SearchType.DEFAULT, 1000.0, distance), "a larger circle shouldn't be covered"
+        assert not await self.catalog.covers(self.coords, SearchType.EXPANDED, 100.0, distance), "coverage should be per search type"
+
+    async def test_search_pipeline(self):
+        with patch('app.venues.aggregate', new=AsyncMock(return_value=[{'name': 'places/a'}])) as aggregate:
+            places = await self.catalog.search(self.coords, ['bar'], 'POPULARITY', 100.0)
+
+        assert places == [{'name': 'places/a'}]
+        pipeline = aggregate.call_args.args[1]
+        assert pipeline[0]['$geoNear']['query'] == {'types': {'$in': ['bar']}}, "the included types should filter the venues"
+        assert pipeline[0]['$geoNear']['maxDistance'] == 100.0
+        assert pipeline[2]['$sort'] == {'popularity_missing': 1, 'popularity': 1, 'distance': 1}, "popularity searches should sort by rank"
+
+    async def test_get_location_answered_locally(self):
+        maps_info = MapsInfo(venues=self.catalog)
+        maps_info.search_places = AsyncMock(return_value=places_result())
+
+        async def geo_near(collection, pipeline): # mongomock can't run $geoNear, so apply the pipeline's projection to every venue
+            project = pipeline[-1]['$project']
+            return [
+                dict({field: venue[field] for field in project if field in venue}, name=venue['_id'], distance=maps_info.haversine(self.coords, venue['location']))
+                async for venue in collection.find()
+            ]
+
+        with patch('app.venues.aggregate', new=geo_near):
+            first = await maps_info.get_location(self.coords, search_radius=500.0)
+            second = await maps_info.get_location({'latitude': 49.2801, 'longitude': -123.12}, search_radius=50.0)
+
+        assert first == places_result(), "an area that wasn't searched should be searched with Places"
+        assert maps_info.search_places.await_count == 1, "a covered area shouldn't be searched with Places again"
+        assert second['rank_preference'] == 'DISTANCE'
+        local = {place['name']: place for place in second['places']}
+        assert local['places/a']['formattedAddress'] == '1 Main St, Vancouver', "the address should come back like a Places answer"
+        assert local['places/a']['addressComponents'] == ADDRESS_COMPONENTS
+        assert local['places/a']['displayName'] == {'text': 'A'}
+        assert self.catalog.stats() == {'local_hits': 1, 'misses': 1, 'saves': 1, 'errors': 0}